@@ -1,8 +1,15 @@
 # app.py — Lyra Engine Prototype (Streamlit Edition, GPT-4o + Hermes fallback)
 
-import os, json, html, time, streamlit as st
+import os, json, time, uuid, streamlit as st
+from functools import lru_cache
 from personas import get_persona
 from llm_router import call_with_fallback
+from context_builder import pack_history
+from deliberation.participating_models import PARTICIPATING_MODELS
+from message_store import ChatMessage, MessageStore, ensure_store, render_body_html
+from conversation_db import get_conversation_db, new_owner_key
+from log_import import LogImportError, import_chat_log
+from components.session_link import session_link_from_url, set_session_link_in_url
 
 
 # ================== 定数（人格から取得） ==================
@@ -12,8 +19,8 @@ SYSTEM_PROMPT = persona.system_prompt
 STARTER_HINT = persona.starter_hint
 PARTNER_NAME = persona.name
 
-MAX_LOG = 500
-DISPLAY_LIMIT = 20000  # 20K文字の表示上限（保存はフル）
+MAX_LOG = 500          # 会話ログの保持件数（先頭の system は常に残す）
+LOG_PAGE_SIZE = 30     # 会話表示は末尾からこの件数ずつ
 
 # ================== ページ設定 ==================
 st.set_page_config(page_title="Lyra Engine Prototype", layout="wide")
@@ -27,6 +34,37 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+def new_log(messages=()) -> MessageStore:
+    """会話ログ（先頭の system を固定した、MAX_LOG 件のリングバッファ）。"""
+    log = MessageStore(max_len=MAX_LOG, pinned=1)
+    if DB is not None:
+        # 最初の保存より前にリングから捨てられる発言も、DB には書けるように残してもらう
+        log.hold_evicted(0)
+    log.extend(messages or [ChatMessage("system", SYSTEM_PROMPT)])
+    return log
+
+
+# 会話の保存先（CONVERSATION_DB=off なら None）。会話は URL の ?sid=&key= で再開できる
+DB = get_conversation_db()
+
+
+def save_log(meta=None) -> None:
+    """まだ保存していない発言（と直近の呼び出し情報）を DB に追記する。"""
+    if DB is not None:
+        DB.sync(
+            st.session_state["_sid"],
+            st.session_state["_sid_key"],
+            st.session_state["messages"],
+            meta=meta,
+            persona=PARTNER_NAME,
+        )
+
+
+def new_session() -> dict:
+    """新しい会話のセッション ID と持ち主の鍵。"""
+    return {"_sid": uuid.uuid4().hex, "_sid_key": new_owner_key()}
+
+
 # ================== session_state 初期化 ==================
 if "user_input" not in st.session_state:
     st.session_state["user_input"] = ""
@@ -40,6 +78,7 @@ DEFAULTS = {
     "_clear_input": False,
     "_do_reset": False,
     "_ask_reset": False,
+    "_log_pages": 1,
 }
 for k, v in DEFAULTS.items():
     if k not in st.session_state:
@@ -58,12 +97,30 @@ if st.session_state.get("_do_reset"):
         "_busy": False,
         "_do_send": False,
         "_ask_reset": False,
-        "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
+        "_log_pages": 1,
+        "messages": new_log(),
+        **new_session(),
     })
 
 # ================== 会話状態 ==================
+if "_sid" not in st.session_state or "_sid_key" not in st.session_state:
+    st.session_state.update(new_session())
 if "messages" not in st.session_state:
-    st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
+    # URL の sid と鍵が合う保存済みの会話があれば、system と末尾 MAX_LOG 件だけ読み込んで再開する
+    url_sid, url_key = session_link_from_url()
+    resumed = (
+        DB.load_store(url_sid, url_key, max_len=MAX_LOG, pinned=1)
+        if DB is not None and url_sid and url_key
+        else None
+    )
+    if resumed is not None:
+        st.session_state.update({"_sid": url_sid, "_sid_key": url_key})
+    st.session_state["messages"] = resumed if resumed is not None else new_log()
+else:
+    # 以前の list のままのセッションは 1 度だけ移し替える
+    ensure_store(st.session_state, max_len=MAX_LOG, pinned=1)
+if DB is not None:
+    set_session_link_in_url(st.session_state["_sid"], st.session_state["_sid_key"])
 
 # ================== シークレット ==================
 OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY", ""))
@@ -129,18 +186,19 @@ with st.expander("接続テスト（任意）", expanded=False):
 # ================== 送信関数（エンジン本体） ==================
 def engine_say(user_text: str):
     """現在のペルソナと会話するためのコア関数。LLMの詳細は llm_router 側に隠蔽。"""
-    # ログ丸め
-    if len(st.session_state["messages"]) > MAX_LOG:
-        base_sys = st.session_state["messages"][0]
-        st.session_state["messages"] = [base_sys] + st.session_state["messages"][-(MAX_LOG - 1):]
-
-    # ユーザー発言を履歴に追加
-    st.session_state["messages"].append({"role": "user", "content": user_text})
+    # ユーザー発言を履歴に追加（MAX_LOG を超えた古い発言はストア側で捨てられる）
+    st.session_state["messages"].append(ChatMessage("user", user_text))
 
-    # 送るコンテキスト（system + 直近）
+    # 送るコンテキスト（system + トークン予算に収まる直近の履歴）
     base = st.session_state["messages"]
-    max_slice = 60
-    convo = [base[0]] + base[-max_slice:]
+    main_info = PARTICIPATING_MODELS["gpt4o"]
+    convo = pack_history(
+        [base[0]],
+        base[1:],
+        budget_tokens=main_info.context_budget,
+        reserve_tokens=int(max_tokens),
+        model=main_info.tokenizer_model,
+    )
 
     with st.spinner(f"{PARTNER_NAME}が考えています…"):
         reply, meta = call_with_fallback(
@@ -155,27 +213,42 @@ def engine_say(user_text: str):
     if not reply.strip():
         reply = "（返答の生成に失敗しました…）"
 
-    st.session_state["messages"].append({"role": "assistant", "content": reply})
+    st.session_state["messages"].append(ChatMessage("assistant", reply))
+    save_log(meta)
 
 # ================== 会話表示 ==================
+# ChatMessage でない発言（古いセッションの dict）の本文 HTML だけここでキャッシュする
+cached_body_html = lru_cache(maxsize=4096)(render_body_html)
+
+
+def bubble_html(m) -> str:
+    """発言 1 つ分の HTML。本文は ChatMessage が追加時に作ったエスケープ済みのものを使う。"""
+    txt = m.body_html if isinstance(m, ChatMessage) else cached_body_html(m["content"])
+    label = "あなた" if m["role"] == "user" else PARTNER_NAME
+    return f"<div class='chat-bubble {m['role']}'><b>{label}：</b><br>{txt}</div>\n"
+
+
+def load_older_log() -> None:
+    st.session_state["_log_pages"] += 1
+
+
 st.subheader("会話")
-dialog = [m for m in st.session_state["messages"] if m["role"] in ("user", "assistant")]
-
-for m in dialog:
-    role = m["role"]
-    raw = m["content"].strip()
-    shown = raw if len(raw) <= DISPLAY_LIMIT else (raw[:DISPLAY_LIMIT] + " …[truncated]")
-    txt = html.escape(shown)
-    if role == "user":
-        st.markdown(
-            f"<div class='chat-bubble user'><b>あなた：</b><br>{txt}</div>",
-            unsafe_allow_html=True,
-        )
-    else:
-        st.markdown(
-            f"<div class='chat-bubble assistant'><b>{PARTNER_NAME}：</b><br>{txt}</div>",
-            unsafe_allow_html=True,
-        )
+# 先頭の system を除いたビュー（コピーしない）
+dialog = st.session_state["messages"][1:]
+
+# 表示は末尾の数ページだけ（古い発言はボタンで遡る）
+log_start = max(0, len(dialog) - st.session_state["_log_pages"] * LOG_PAGE_SIZE)
+if log_start > 0:
+    st.button(
+        f"さらに前の {min(log_start, LOG_PAGE_SIZE)} 件を表示（全 {len(dialog)} 件）",
+        on_click=load_older_log,
+    )
+st.markdown(
+    "".join(
+        bubble_html(m) for m in dialog[log_start:] if m["role"] in ("user", "assistant")
+    ),
+    unsafe_allow_html=True,
+)
 
 # ================== デバッグ情報 ==================
 show_dbg = st.checkbox("デバッグを表示", False)
@@ -251,7 +324,7 @@ if c_show.button(
     disabled=(st.session_state["_busy"] or st.session_state["_ask_reset"]),
 ):
     st.info("最近10件の会話を下に表示します。")
-    recent = [m for m in st.session_state["messages"] if m["role"] in ("user", "assistant")][-10:]
+    recent = [m for m in st.session_state["messages"][-10:] if m["role"] in ("user", "assistant")]
     for m in recent:
         role_label = "あなた" if m["role"] == "user" else PARTNER_NAME
         st.write(f"**{role_label}**：{m['content'].strip()}")
@@ -259,16 +332,40 @@ if c_show.button(
 # ================== 保存・読込 ==================
 st.markdown("---")
 st.subheader("会話ログの保存")
-st.download_button(
-    "JSON をダウンロード",
-    json.dumps(st.session_state["messages"], ensure_ascii=False, indent=2),
-    file_name="lyra_chat_log.json",
-    mime="application/json",
-    use_container_width=True,
-)
+
+def build_export() -> None:
+    """
+    ダウンロード用の JSON を作る（押されたときだけ）。
+    DB があれば、リングバッファから捨てられた古い発言も含めて DB から少しずつ読み出す。
+    """
+    log = st.session_state["messages"]
+    if DB is not None:
+        save_log()
+        data = DB.export_json(st.session_state["_sid"], st.session_state["_sid_key"])
+    else:
+        data = json.dumps(list(log), ensure_ascii=False, indent=2).encode("utf-8")
+    st.session_state["_export"] = (export_key(), data)
+
+
+def export_key():
+    log = st.session_state["messages"]
+    return (st.session_state["_sid"], len(log), log[-1].id if len(log) else None)
+
+
+export = st.session_state.get("_export")
+if export is not None and export[0] == export_key():
+    st.download_button(
+        "JSON をダウンロード",
+        export[1],
+        file_name="lyra_chat_log.json",
+        mime="application/json",
+        use_container_width=True,
+    )
+else:
+    st.button("JSON を作成", on_click=build_export, use_container_width=True)
 
 st.subheader("会話ログの読み込み")
-up = st.file_uploader("保存した JSON を選択", type=["json"])
+up = st.file_uploader("保存した JSON / JSONL を選択", type=["json", "jsonl"])
 col_l, col_m, col_r = st.columns(3)
 load_mode = col_l.radio("読込モード", ["置き換え", "末尾に追記"], horizontal=True)
 show_preview = col_m.checkbox("内容をプレビュー", value=True)
@@ -280,45 +377,37 @@ do_load = col_r.button(
 
 if up is not None:
     try:
-        imported = json.load(up)
-        ok = isinstance(imported, list) and all(
-            isinstance(x, dict) and "role" in x and "content" in x for x in imported
-        )
-        if not ok:
-            st.error("JSON 形式が不正です。messages の配列（各要素に role と content）が必要です。")
-        else:
-            if show_preview:
-                st.caption("先頭5件プレビュー")
-                st.json(imported[:5])
-            if do_load:
-                # system が先頭にないログには、現在の SYSTEM_PROMPT を補う
-                if not (len(imported) > 0 and imported[0].get("role") == "system"):
-                    imported = [{"role": "system", "content": SYSTEM_PROMPT}] + imported
-
-                if load_mode == "置き換え":
-                    st.session_state["messages"] = imported
-                else:
-                    base = st.session_state.get(
-                        "messages",
-                        [{"role": "system", "content": SYSTEM_PROMPT}],
-                    )
-                    tail = (
-                        imported[1:]
-                        if (len(imported) > 0 and imported[0].get("role") == "system")
-                        else imported
-                    )
-                    st.session_state["messages"] = base + tail
-
-                st.session_state.update({
-                    "_pending_text": "",
-                    "_do_send": False,
-                    "_busy": False,
-                    "_clear_input": False,
-                    "_do_reset": False,
-                })
-                st.session_state.pop("_last_call_meta", None)
-
-                st.success("読込が完了しました。")
-                st.rerun()
-    except Exception as e:
+        # 1 件ずつ読みながら検査する。同じファイルなら rerun では読み直さない
+        imported = import_chat_log(up, max_len=MAX_LOG - 1)
+    except LogImportError as e:
         st.error(f"JSON の読み込みに失敗しました：{e}")
+    else:
+        if show_preview:
+            st.caption(f"先頭{len(imported.preview)}件プレビュー（全 {imported.total} 件）")
+            st.json(list(imported.preview))
+        if imported.dropped:
+            st.caption(f"保持上限（{MAX_LOG} 件）を超える古い {imported.dropped} 件は読み込みません。")
+        if do_load:
+            if load_mode == "置き換え":
+                # system が先頭にないログには、現在の SYSTEM_PROMPT を補う
+                head = list(imported.head_messages()) or [ChatMessage("system", SYSTEM_PROMPT)]
+                st.session_state["messages"] = new_log(head)
+                st.session_state["messages"].extend(imported.tail_messages())
+                # 読み込んだログは別の会話として保存する
+                st.session_state.update(new_session())
+            else:
+                # 先頭の system は今のログのものを使い、残りを末尾に追記する
+                st.session_state["messages"].extend(imported.tail_messages())
+            save_log()
+
+            st.session_state.update({
+                "_pending_text": "",
+                "_do_send": False,
+                "_busy": False,
+                "_clear_input": False,
+                "_do_reset": False,
+            })
+            st.session_state.pop("_last_call_meta", None)
+
+            st.success("読込が完了しました。")
+            st.rerun()
@@ -1,5 +1,6 @@
 from .preflight import PreflightChecker
 from .chat_log import ChatLog
 from .player_input import PlayerInput
+from .session_link import session_link_from_url, set_session_link_in_url
 
-__all__ = { "PreflightChecker", "ChatLog", "PlayerInput" }
+__all__ = { "PreflightChecker", "ChatLog", "PlayerInput", "session_link_from_url", "set_session_link_in_url" }
@@ -1,85 +1,163 @@
-from typing import List, Dict
+from functools import lru_cache
+from typing import Any, Callable, List, Dict, Tuple
 import streamlit as st
-import html
+import time
+
+from message_store import DISPLAY_LIMIT, ChatMessage, render_body_html
+
+
+# 吹き出しのスタイル。rerun のたびに組み立て直さないよう、モジュール読み込み時に 1 度だけ作る
+_CHAT_LOG_STYLE = """
+<style>
+.chat-bubble-container {
+    margin: 10px 0;
+}
+
+.chat-bubble {
+    border: 1px solid #ccc;
+    border-radius: 8px;
+
+    /* ← 上の余白を限界まで削る */
+    padding: 0px 20px 8px 20px;   /* 上0, 右10, 下8, 左10 */
+
+    margin: 0;
+    background-color: #f9f9f9;
+    white-space: pre-wrap;
+    text-align: left;
+    line-height: 1.5;
+}
+
+.chat-name {
+    font-weight: bold;
+    line-height: 0;   /* 1行目の高さを詰める */
+    margin: 0;
+    padding-top: 0px;   /* ほんの少しだけ余裕、もっと詰めたければ 0 に */
+    display: inline-block;
+}
+
+.chat-bubble.assistant {
+    background-color: #f2f2f2;
+    border-color: #999;
+}
+.chat-bubble.user {
+    background-color: #e8f2ff;
+    border-color: #66aaff;
+}
+</style>
+"""
+
+
+def _bubble(name: str, role_class: str, body_html: str) -> str:
+    return (
+        f'<div class="chat-bubble-container"><div class="chat-bubble {role_class}">'
+        f'<span class="chat-name">{name}:</span><br><br>{body_html}</div></div>\n'
+    )
+
+
+# ChatMessage でない発言（古いセッションの dict など）の本文 HTML はここでキャッシュする
+_cached_body_html = lru_cache(maxsize=4096)(render_body_html)
 
 
 class ChatLog:
-    def __init__(self, partner_name: str, display_limit: int = 20000):
+    """
+    会話ログの吹き出し表示。
+
+    - 表示するのは末尾の page_size 件だけ（「さらに前を表示」で 1 ページずつ遡る）
+    - 本文の HTML は ChatMessage が追加時に作ったもの（body_html）をそのまま使う
+    - 表示範囲の吹き出しは 1 つの st.markdown にまとめて描く
+    - display_limit は 1 発言あたりの表示文字数の上限（保存はフル）
+    """
+
+    def __init__(
+        self,
+        partner_name: str,
+        display_limit: int = DISPLAY_LIMIT,
+        page_size: int = 30,
+        state_key: str = "chat_log_pages",
+    ):
         self.partner_name = partner_name
         self.display_limit = display_limit
+        self.page_size = max(1, int(page_size))
+        # 何ページ分さかのぼって表示しているか（session_state に保持）
+        self.state_key = state_key
 
-        st.markdown(
-            """
-            <style>
-            .chat-bubble-container {
-                margin: 10px 0;
-            }
-
-            .chat-bubble {
-                border: 1px solid #ccc;
-                border-radius: 8px;
-
-                /* ← 上の余白を限界まで削る */
-                padding: 0px 20px 8px 20px;   /* 上0, 右10, 下8, 左10 */
-
-                margin: 0;
-                background-color: #f9f9f9;
-                white-space: pre-wrap;
-                text-align: left;
-                line-height: 1.5;
-            }
-
-            .chat-name {
-                font-weight: bold;
-                line-height: 0;   /* 1行目の高さを詰める */
-                margin: 0;
-                padding-top: 0px;   /* ほんの少しだけ余裕、もっと詰めたければ 0 に */
-                display: inline-block;
-            }
-
-            .chat-bubble.assistant {
-                background-color: #f2f2f2;
-                border-color: #999;
-            }
-            .chat-bubble.user {
-                background-color: #e8f2ff;
-                border-color: #66aaff;
-            }
-            </style>
-            """,
-            unsafe_allow_html=True,
-        )
+    def _name_and_class(self, role: str) -> Tuple[str, str]:
+        if role == "assistant":
+            return self.partner_name, "assistant"
+        if role == "user":
+            return "あなた", "user"
+        return role or "system", "assistant"
+
+    def _bubble_html(self, role: str, txt: str) -> str:
+        """書きかけの返答など、その場限りの吹き出し（キャッシュしない）。"""
+        name, role_class = self._name_and_class(role)
+        return _bubble(name, role_class, render_body_html(txt, self.display_limit))
+
+    def _message_html(self, msg: Dict[str, Any]) -> str:
+        name, role_class = self._name_and_class(msg.get("role", ""))
+        if isinstance(msg, ChatMessage) and self.display_limit == DISPLAY_LIMIT:
+            body = msg.body_html
+        else:
+            body = _cached_body_html(str(msg.get("content", "")), self.display_limit)
+        return _bubble(name, role_class, body)
+
+    def _load_older(self) -> None:
+        st.session_state[self.state_key] = st.session_state.get(self.state_key, 1) + 1
 
     def render(self, messages: List[Dict[str, str]]) -> None:
+        # Streamlit は rerun で出さなかった要素を消すので、スタイルは毎回同じ位置に出す
+        # （中身は定数なので、前回と同じ要素としてそのまま使われる）
+        st.markdown(_CHAT_LOG_STYLE, unsafe_allow_html=True)
         st.subheader("💬 会話ログ")
 
         if not messages:
             st.text("（まだ会話は始まっていません）")
             return
 
-        for msg in messages[-self.display_limit:]:
-            role = msg.get("role", "")
-            txt = msg.get("content", "")
-
-            if role == "assistant":
-                name = self.partner_name
-                role_class = "assistant"
-            elif role == "user":
-                name = "あなた"
-                role_class = "user"
-            else:
-                name = role or "system"
-                role_class = "assistant"
-
-            safe_txt = html.escape(txt)
-
-            st.markdown(
-                f"""
-                <div class="chat-bubble-container">
-                    <div class="chat-bubble {role_class}">
-                        <span class="chat-name">{name}:</span><br><br>{safe_txt}
-                    </div>
-                </div>
-                """,
+        pages = max(1, int(st.session_state.get(self.state_key, 1)))
+        start = max(0, len(messages) - pages * self.page_size)
+        if start > 0:
+            st.button(
+                f"さらに前の {min(start, self.page_size)} 件を表示（全 {len(messages)} 件）",
+                key=f"{self.state_key}_older",
+                on_click=self._load_older,
+            )
+
+        st.markdown(
+            "".join(self._message_html(msg) for msg in messages[start:]),
+            unsafe_allow_html=True,
+        )
+
+    def render_pending(
+        self,
+        user_text: str,
+        waiting_text: str = "……",
+        min_interval: float = 0.05,
+    ) -> Callable[[str], None]:
+        """
+        送信直後のユーザー発言と、これから伸びていくアシスタント吹き出しを描画する。
+        戻り値の関数に delta（差分テキスト）を渡すと、吹き出しが少しずつ更新される。
+        再描画が多すぎないよう、min_interval 秒より短い間隔の更新はまとめる。
+        """
+        st.markdown(self._bubble_html("user", user_text), unsafe_allow_html=True)
+        placeholder = st.empty()
+        placeholder.markdown(
+            self._bubble_html("assistant", waiting_text),
+            unsafe_allow_html=True,
+        )
+
+        parts: List[str] = []
+        last_drawn = [0.0]
+
+        def on_delta(delta: str) -> None:
+            parts.append(delta)
+            now = time.monotonic()
+            if now - last_drawn[0] < min_interval:
+                return
+            last_drawn[0] = now
+            placeholder.markdown(
+                self._bubble_html("assistant", "".join(parts)),
                 unsafe_allow_html=True,
             )
+
+        return on_delta
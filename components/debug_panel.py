@@ -5,6 +5,8 @@ import json
 import streamlit as st
 
 from deliberation.multi_ai_response import MultiAIResponse
+from deliberation.judge_cache import get_judge_cache
+from llm_cache import cache_stats
 
 
 class DebugPanel:
@@ -43,6 +45,35 @@ class DebugPanel:
                 ct = usage_main.get("completion_tokens", "？")
                 tt = usage_main.get("total_tokens", "？")
                 st.write(f"- tokens: total={tt}, prompt={pt}, completion={ct}")
+                if usage_main.get("cached_tokens") is not None:
+                    st.write(f"- cached prompt tokens: {usage_main['cached_tokens']}")
+
+        # --- キャッシュ統計（プロセス全体） ---
+        with st.expander("キャッシュ統計", expanded=False):
+            for label, stats in (
+                ("Judge 判定キャッシュ", get_judge_cache().stats()),
+                ("LLM 応答キャッシュ", cache_stats()),
+            ):
+                st.write(
+                    f"- {label}: hit={stats['hits']}, miss={stats['misses']}, "
+                    f"hit_rate={stats['hit_rate']:.0%}（{stats['backend']}）"
+                )
+
+        # --- モデル選択（ModelSelector） ---
+        selection = llm_meta.get("selection")
+        if isinstance(selection, dict):
+            with st.expander("モデル選択", expanded=False):
+                st.write(f"- policy: `{selection.get('policy')}`")
+                st.write(f"- queried: {', '.join(selection.get('queried') or [])}")
+                if selection.get("explore"):
+                    st.write(f"- explore: {', '.join(selection['explore'])}（見切らない）")
+                for key, reason in (selection.get("skipped") or {}).items():
+                    st.write(f"- skipped: `{key}`（{reason}）")
+                abandoned = (llm_meta.get("fanout") or {}).get("abandoned") or {}
+                for key, reason in abandoned.items():
+                    st.write(f"- abandoned: `{key}`（{reason}）")
+                if selection.get("samples"):
+                    st.json(selection["samples"])
 
         # --- マルチAIレスポンス（表示も審議も全部ここに委譲） ---
         with st.expander("🧪 マルチAIレスポンスシステム", expanded=True):
@@ -53,6 +53,22 @@ class MultiAIJudgeResultView:
         else:
             st.caption("（理由テキストなし）")
 
+        # トーナメント審議のときは、各モデルの強さスコアと対戦結果も出す
+        tournament = judge.get("tournament")
+        if isinstance(tournament, dict):
+            with st.expander("🏆 トーナメント（ペア審議）", expanded=False):
+                scores = tournament.get("scores") or {}
+                eliminated = set(tournament.get("eliminated") or [])
+                st.caption(f"ラウンド数: {tournament.get('rounds', 0)}（Bradley-Terry スコア順）")
+                for key, score in sorted(scores.items(), key=lambda kv: -kv[1]):
+                    mark = "（脱落）" if key in eliminated else ""
+                    st.markdown(f"- `{key}`: {score:.3f}{mark}")
+                for m in tournament.get("matches") or []:
+                    pair = m.get("pair") or {}
+                    st.caption(
+                        f"R{m.get('round')}: {pair.get('A')} vs {pair.get('B')} → {m.get('winner')}"
+                    )
+
         raw_json = judge.get("raw_json")
         raw_text = judge.get("raw_text")
         pair = judge.get("pair")
@@ -70,3 +86,8 @@ class MultiAIJudgeResultView:
             if isinstance(pair, dict):
                 st.caption("比較ペア")
                 st.write(pair)
+
+            pre_judge = judge.get("pre_judge")
+            if isinstance(pre_judge, dict):
+                st.caption("ローカル足切り（PreJudge）")
+                st.json(pre_judge)
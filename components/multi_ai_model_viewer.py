@@ -46,6 +46,8 @@ class MultiAIModelViewer:
                 pt = usage.get("prompt_tokens", "？")
                 ct = usage.get("completion_tokens", "？")
                 tt = usage.get("total_tokens", "？")
-                st.caption(f"tokens: total={tt}, prompt={pt}, completion={ct}")
+                cached = usage.get("cached_tokens")
+                cached_txt = f", cached={cached}" if cached is not None else ""
+                st.caption(f"tokens: total={tt}, prompt={pt}, completion={ct}{cached_txt}")
 
             st.markdown("---")
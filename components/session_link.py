@@ -0,0 +1,39 @@
+# components/session_link.py
+# 会話のセッション ID と持ち主の鍵を URL（?sid=...&key=...）に載せる。
+# 再起動後やタブを開き直したときに、同じ URL なら ConversationDB から会話を再開できる。
+# 鍵が合わない sid は開けない（ConversationDB 側で確かめる）。
+
+from typing import Optional, Tuple
+import streamlit as st
+
+SID_KEY = "sid"
+OWNER_KEY = "key"
+
+
+def _get(name: str) -> Optional[str]:
+    params = getattr(st, "query_params", None)
+    if params is not None:
+        value = params.get(name)
+    else:
+        # 古い Streamlit
+        value = (st.experimental_get_query_params().get(name) or [None])[0]
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return str(value) if value else None
+
+
+def session_link_from_url() -> Tuple[Optional[str], Optional[str]]:
+    """URL の (?sid=..., ?key=...) を返す（無ければ None）。"""
+    return _get(SID_KEY), _get(OWNER_KEY)
+
+
+def set_session_link_in_url(session_id: str, owner_key: str) -> None:
+    """URL の ?sid= / ?key= を書き換える（同じなら何もしない）。"""
+    if session_link_from_url() == (session_id, owner_key):
+        return
+    params = getattr(st, "query_params", None)
+    if params is not None:
+        params[SID_KEY] = session_id
+        params[OWNER_KEY] = owner_key
+    else:
+        st.experimental_set_query_params(**{SID_KEY: session_id, OWNER_KEY: owner_key})
@@ -0,0 +1,116 @@
+# context_builder.py
+# LLM に渡す履歴を「トークン予算」に収まるように詰める層
+#
+#   ・トークン数はローカルのトークナイザ（tiktoken があれば）で数える
+#   ・無ければ文字種ベースの高速な見積もりにフォールバック
+#   ・max_tokens（出力分）を先に確保し、残りに新しい履歴から順に詰める
+#
+# ログが MAX_LOG = 500 件に近づいても、プロンプトサイズと料金が一定に保たれる。
+
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+# あるなら使う（無ければ文字数ベースの見積もり）
+try:
+    import tiktoken
+except Exception:  # ライブラリ未導入 / 壊れている場合も想定
+    tiktoken = None
+
+
+# 1 メッセージあたりの役割タグ等のオーバーヘッド（OpenAI chat 形式の目安）
+MESSAGE_OVERHEAD_TOKENS = 4
+# 返答の前置き（assistant の開始トークン）分
+REPLY_PRIMING_TOKENS = 3
+
+
+@lru_cache(maxsize=16)
+def _encoding_for(model: str) -> Any:
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:  # noqa: BLE001
+        # OpenRouter 経由のモデルなど tiktoken が知らない名前は o200k で近似
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:  # noqa: BLE001
+            return None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークナイザ無しの高速見積もり。
+    英数字は 4 文字 ≒ 1 トークン、日本語などの非 ASCII は 1 文字 ≒ 1 トークンとみなす。
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return (ascii_chars + 3) // 4 + other_chars
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    enc = _encoding_for(model) if model else _encoding_for("gpt-4o")
+    if enc is None:
+        return estimate_tokens(text)
+    try:
+        return len(enc.encode(text))
+    except Exception:  # noqa: BLE001
+        return estimate_tokens(text)
+
+
+def count_message_tokens(message: Dict[str, Any], model: str = "") -> int:
+    return MESSAGE_OVERHEAD_TOKENS + count_tokens(str(message.get("content") or ""), model)
+
+
+def pack_history(
+    prefix: List[Dict[str, str]],
+    history: Sequence[Dict[str, Any]],
+    budget_tokens: int,
+    reserve_tokens: int,
+    model: str = "",
+    roles: Sequence[str] = ("user", "assistant"),
+) -> List[Dict[str, str]]:
+    """
+    prefix（system など、必ず入れるもの）の後ろに、
+    history の新しい方から順に budget に収まるだけ詰めて返す。
+
+    - reserve_tokens（= max_tokens）は出力用に先に確保する
+    - roles に含まれない発言（system など）は履歴から除外する
+    - 最新の 1 件は予算を超えていても必ず入れる（返答の起点になるため）
+    """
+    used = REPLY_PRIMING_TOKENS + int(reserve_tokens)
+    used += sum(count_message_tokens(m, model) for m in prefix)
+    available = int(budget_tokens) - used
+
+    picked: List[Dict[str, str]] = []
+    for m in reversed(history):
+        if m.get("role") not in roles:
+            continue
+        cost = count_message_tokens(m, model)
+        if picked and cost > available:
+            break
+        picked.append({"role": str(m.get("role")), "content": str(m.get("content") or "")})
+        available -= cost
+
+    picked.reverse()
+    return list(prefix) + picked
+
+
+def total_tokens(messages: List[Dict[str, str]], model: str = "") -> int:
+    return REPLY_PRIMING_TOKENS + sum(count_message_tokens(m, model) for m in messages)
+
+
+def tokenizer_name() -> Optional[str]:
+    """デバッグ表示用：実際に使っている数え方。"""
+    return "tiktoken" if tiktoken is not None else "estimate"
+
+
+__all__ = [
+    "estimate_tokens",
+    "count_tokens",
+    "count_message_tokens",
+    "pack_history",
+    "total_tokens",
+    "tokenizer_name",
+]
@@ -0,0 +1,384 @@
+# conversation_db.py — 会話ログをサーバ側の SQLite に残す永続化層
+#
+# これまで会話は st.session_state["messages"] にしか無く、再起動やタブを閉じると消えていた。
+# ここでは 1 ターンごとに、増えた発言と llm_meta だけを SQLite（WAL モード）に追記する。
+#
+#   ・書き込みはターンごとの差分だけ（MessageStore の通し番号 seq をそのまま主キーに使う）
+#   ・審議後の差し替えは同じ seq の行を上書き
+#   ・セッションの再開時（URL の ?sid=...&key=...）に、末尾 max_len 件だけを読み込む
+#   ・会話ごとに持ち主の鍵（key）のハッシュを持ち、鍵が合わなければ読み出しも書き込みもしない
+#     （sid だけ知っていても、他人の会話は開けない）
+#   ・ダウンロード用の JSON は、押されたときに DB から少しずつ読み出して作る
+#
+# パスは環境変数 CONVERSATION_DB_PATH、CONVERSATION_DB=off で無効化。
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import warnings
+from typing import Any, Dict, Iterator, Optional
+
+from message_store import ChatMessage, MessageStore
+
+
+def new_owner_key() -> str:
+    """会話の持ち主の鍵（URL の ?key= に載せる。DB にはハッシュだけ持つ）。"""
+    return secrets.token_urlsafe(24)
+
+
+def _key_hash(owner_key: str) -> str:
+    return hashlib.sha256(str(owner_key).encode("utf-8")).hexdigest()
+
+
+class ConversationAccessError(PermissionError):
+    """持ち主の鍵が合わない会話に書き込もうとした。"""
+
+
+class ConversationDB:
+    """
+    session_id ごとの発言（messages）と、アシスタント発言ごとの llm_meta（turn_meta）を持つ。
+    Streamlit のスクリプトスレッドから呼ぶ前提で、接続は 1 本 + 自前ロック。
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            # WAL: 書き込み中も読み出しを止めない。1 ターン分の追記なら NORMAL で十分
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " session_id TEXT PRIMARY KEY,"
+                " persona TEXT NOT NULL DEFAULT '',"
+                " owner_hash TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " session_id TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " msg_id TEXT NOT NULL,"
+                " role TEXT NOT NULL,"
+                " content TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (session_id, seq));"
+                "CREATE TABLE IF NOT EXISTS turn_meta ("
+                " session_id TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " meta TEXT NOT NULL,"
+                " PRIMARY KEY (session_id, seq));"
+            )
+            # 鍵を持つ前に作った DB には列を足す（そのころの会話は鍵が無いので再開できない）
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+            if "owner_hash" not in columns:
+                self._conn.execute("ALTER TABLE conversations ADD COLUMN owner_hash TEXT")
+            self._conn.commit()
+
+    # ===== 持ち主の確認 =====
+    def _owner_hash(self, session_id: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT owner_hash FROM conversations WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _owns(self, session_id: str, owner_key: Optional[str]) -> bool:
+        """呼び出し側で self._lock を取っておくこと。"""
+        if not owner_key:
+            return False
+        stored = self._owner_hash(session_id)
+        return stored is not None and hmac.compare_digest(stored, _key_hash(owner_key))
+
+    def can_open(self, session_id: str, owner_key: Optional[str]) -> bool:
+        """owner_key で session_id の会話を開けるか。"""
+        with self._lock:
+            return self._owns(session_id, owner_key)
+
+    # ===== 書き込み =====
+    def sync(
+        self,
+        session_id: str,
+        owner_key: str,
+        messages: MessageStore,
+        meta: Optional[Dict[str, Any]] = None,
+        rewrite_last: bool = False,
+        persona: str = "",
+    ) -> int:
+        """
+        まだ保存していない発言を追記する（書いた件数を返す）。
+        rewrite_last=True なら末尾の発言も上書きする（審議後の差し替え用）。
+        meta を渡すと、末尾の発言の llm_meta として保存する。
+
+        前回の sync から今回までにリングバッファから捨てられた発言は、
+        MessageStore.hold_evicted() で残してもらった分から書く。
+        それでも抜けがあれば（保存を始める前に捨てられていたなど）RuntimeWarning を出す。
+
+        初めて書く会話は owner_key を持ち主の鍵として登録する。
+        別の鍵で登録済みの会話なら ConversationAccessError。
+        """
+        if not len(messages):
+            return 0
+        now = time.time()
+        with self._lock:
+            stored = self._owner_hash(session_id)
+            if stored is None:
+                # 新しい会話（鍵を持つ前の版で作った会話も、書いているセッションが持ち主になる）
+                self._conn.execute(
+                    "INSERT INTO conversations (session_id, persona, owner_hash, created_at, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT(session_id) DO UPDATE SET owner_hash = excluded.owner_hash",
+                    (session_id, persona, _key_hash(owner_key), now, now),
+                )
+            elif not hmac.compare_digest(stored, _key_hash(owner_key)):
+                raise ConversationAccessError(f"会話 {session_id} の持ち主の鍵が一致しません")
+            row = self._conn.execute(
+                "SELECT MAX(seq) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            saved_until = -1 if row[0] is None else int(row[0])
+            start = messages.index_of_seq(saved_until + 1)
+            if rewrite_last:
+                start = min(start, len(messages) - 1)
+            rows = [
+                (session_id, seq, m.id, m["role"], m["content"], now)
+                for seq, m in messages.held_evicted()
+                if seq > saved_until
+            ]
+            rows.extend(
+                (session_id, messages.seq_of_index(i), m.id, m["role"], m["content"], now)
+                for i, m in enumerate(messages[start:], start)
+            )
+            if rows and rows[0][1] > saved_until + 1:
+                warnings.warn(
+                    f"ConversationDB: {session_id} の通し番号 {saved_until + 1}〜{rows[0][1] - 1} は保存前に"
+                    " MessageStore から捨てられていたため書けません",
+                    RuntimeWarning,
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages"
+                " (session_id, seq, msg_id, role, content, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            if meta is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO turn_meta (session_id, seq, meta) VALUES (?, ?, ?)",
+                    (
+                        session_id,
+                        messages.seq_of_index(len(messages) - 1),
+                        json.dumps(meta, ensure_ascii=False, default=str),
+                    ),
+                )
+            self._conn.execute(
+                "UPDATE conversations SET updated_at = ? WHERE session_id = ?",
+                (now, session_id),
+            )
+            self._conn.commit()
+        # ここまでは保存済み。これから捨てられる発言は次の sync まで残してもらう
+        messages.hold_evicted(messages.next_seq)
+        return len(rows)
+
+    def save_turn_meta(
+        self, session_id: str, owner_key: str, message_id: str, meta: Dict[str, Any]
+    ) -> bool:
+        """
+        保存済みの発言（message_id）の llm_meta を書き直す。
+        次のターンへ進んだ後に審議が終わったとき（status="late"）用。
+        その発言がまだ保存されていなければ何もせず False。
+        """
+        with self._lock:
+            if not self._owns(session_id, owner_key):
+                raise ConversationAccessError(f"会話 {session_id} の持ち主の鍵が一致しません")
+            row = self._conn.execute(
+                "SELECT seq FROM messages WHERE session_id = ? AND msg_id = ?",
+                (session_id, message_id),
+            ).fetchone()
+            if row is None:
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO turn_meta (session_id, seq, meta) VALUES (?, ?, ?)",
+                (session_id, int(row[0]), json.dumps(meta, ensure_ascii=False, default=str)),
+            )
+            self._conn.commit()
+        return True
+
+    # ===== 再開 =====
+    def load_store(
+        self,
+        session_id: str,
+        owner_key: Optional[str],
+        max_len: Optional[int] = None,
+        pinned: int = 0,
+    ) -> Optional[MessageStore]:
+        """
+        保存済みの会話を MessageStore にして返す（無い / 鍵が合わなければ None）。
+        読むのは先頭 pinned 件と末尾 max_len - pinned 件だけ。
+        """
+        tail_len = None if max_len is None else max(1, int(max_len) - int(pinned))
+        with self._lock:
+            if not self._owns(session_id, owner_key):
+                return None
+            head_rows = self._conn.execute(
+                "SELECT seq, msg_id, role, content FROM messages"
+                " WHERE session_id = ? AND seq < ? ORDER BY seq",
+                (session_id, int(pinned)),
+            ).fetchall()
+            tail_rows = self._conn.execute(
+                "SELECT seq, msg_id, role, content FROM messages"
+                " WHERE session_id = ? AND seq >= ? ORDER BY seq DESC LIMIT ?",
+                (session_id, int(pinned), -1 if tail_len is None else tail_len),
+            ).fetchall()
+        if not head_rows and not tail_rows:
+            return None
+        tail_rows.reverse()
+        store = MessageStore.restore(
+            [ChatMessage(role, content, id=msg_id) for _seq, msg_id, role, content in head_rows],
+            [ChatMessage(role, content, id=msg_id) for _seq, msg_id, role, content in tail_rows],
+            tail_seq=tail_rows[0][0] if tail_rows else int(pinned),
+            max_len=max_len,
+            pinned=pinned,
+        )
+        # 読み込んだ分は保存済み。以降に捨てられる発言は次の sync まで残してもらう
+        store.hold_evicted(store.next_seq)
+        return store
+
+    def last_meta(self, session_id: str, owner_key: Optional[str]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if not self._owns(session_id, owner_key):
+                return None
+            row = self._conn.execute(
+                "SELECT meta FROM turn_meta WHERE session_id = ? ORDER BY seq DESC LIMIT 1",
+                (session_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            meta = json.loads(row[0])
+        except Exception:  # noqa: BLE001
+            return None
+        return meta if isinstance(meta, dict) else None
+
+    # ===== 書き出し =====
+    def iter_export(
+        self,
+        session_id: str,
+        owner_key: Optional[str],
+        batch_size: int = 500,
+    ) -> Iterator[str]:
+        """
+        会話全体（MessageStore から捨てられた古い発言も含む）を JSON 配列として少しずつ返す。
+        形式は "JSON をダウンロード" と同じ [{"role": ..., "content": ...}, ...]。
+        鍵が合わなければ ConversationAccessError。
+        """
+        if not self.can_open(session_id, owner_key):
+            raise ConversationAccessError(f"会話 {session_id} の持ち主の鍵が一致しません")
+        yield "["
+        last_seq = -1
+        first = True
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT seq, role, content FROM messages"
+                    " WHERE session_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (session_id, last_seq, int(batch_size)),
+                ).fetchall()
+            if not rows:
+                break
+            for seq, role, content in rows:
+                item = json.dumps({"role": role, "content": content}, ensure_ascii=False)
+                yield ("\n  " if first else ",\n  ") + item
+                first = False
+                last_seq = seq
+        yield "\n]"
+
+    def export_json(self, session_id: str, owner_key: Optional[str]) -> bytes:
+        return "".join(self.iter_export(session_id, owner_key)).encode("utf-8")
+
+    # ===== ターンごとの llm_meta（審議し直し用） =====
+    def iter_turn_records(
+        self,
+        session_id: Optional[str] = None,
+        batch_size: int = 200,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        保存済みの llm_meta を 1 ターンずつ返す（session_id を省くと全会話）。
+        {"session_id", "seq", "turn_id", "llm_meta"} の形で、deliberation.rejudge の入力になる。
+        サーバ側の運用向け（持ち主の鍵は確かめない）。
+        """
+        last = ("", -1)
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT session_id, seq, meta FROM turn_meta"
+                    " WHERE (session_id, seq) > (?, ?) AND (? IS NULL OR session_id = ?)"
+                    " ORDER BY session_id, seq LIMIT ?",
+                    (last[0], last[1], session_id, session_id, int(batch_size)),
+                ).fetchall()
+            if not rows:
+                return
+            for sid, seq, raw in rows:
+                last = (sid, seq)
+                try:
+                    meta = json.loads(raw)
+                except Exception:  # noqa: BLE001
+                    continue
+                if not isinstance(meta, dict):
+                    continue
+                yield {
+                    "session_id": sid,
+                    "seq": seq,
+                    "turn_id": meta.get("turn_id") or f"{sid}:{seq}",
+                    "llm_meta": meta,
+                }
+
+    def export_turns_jsonl(self, path: str, session_id: Optional[str] = None) -> int:
+        """iter_turn_records() を JSONL に書き出す（書いた件数を返す）。"""
+        count = 0
+        with open(path, "w", encoding="utf-8") as f:
+            for record in self.iter_turn_records(session_id):
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                count += 1
+        return count
+
+
+# ========= プロセス全体で共有する DB =========
+
+_DB: Optional[ConversationDB] = None
+_DB_LOCK = threading.Lock()
+
+
+def get_conversation_db() -> Optional[ConversationDB]:
+    """
+    共有の ConversationDB（最初に使われたときに開く）。CONVERSATION_DB=off なら None。
+    """
+    global _DB
+    if os.getenv("CONVERSATION_DB", "on").lower() in ("off", "none", "0", ""):
+        return None
+    with _DB_LOCK:
+        if _DB is None:
+            _DB = ConversationDB(
+                os.getenv(
+                    "CONVERSATION_DB_PATH",
+                    os.path.join(".lyra_data", "conversations.sqlite3"),
+                )
+            )
+        return _DB
+
+
+__all__ = [
+    "ConversationDB",
+    "ConversationAccessError",
+    "new_owner_key",
+    "get_conversation_db",
+]
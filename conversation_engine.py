@@ -1,12 +1,27 @@
 # conversation_engine.py — LLM 呼び出しを統括する会話エンジン層
 
-from typing import Any, Dict, List, Tuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from llm_router import (
-    call_with_fallback,   # GPT-4o（物語本体）
-    call_hermes,          # Hermes
-    call_gpt5_candidate,  # GPT-5.1（3人目候補）
-)
+from context_builder import pack_history, total_tokens
+from conversation_summarizer import summary_message
+from deliberation.ai_response_collector import PRIMARY_KEY, AIResponseCollector
+from deliberation.early_exit import EarlyExit
+from deliberation.participating_models import PARTICIPATING_MODELS
+from personas.persona_floria_ja import Persona
+
+
+@lru_cache(maxsize=32)
+def frozen_system_prefix(system_prompt: str, style_hint: str) -> str:
+    """
+    人格（system_prompt）＋文体指針の system ブロックを組み立てる。
+
+    プロバイダ側のプロンプトキャッシュは「先頭からバイト単位で同じ」部分にしか効かない。
+    同じペルソナなら毎ターン必ず同一の文字列（同一オブジェクト）を返すよう、
+    ここで 1 度だけ組み立ててキャッシュする。ターンごとに変わるもの
+    （あらすじ・履歴）は必ずこの後ろに並べること。
+    """
+    return system_prompt.rstrip() + "\n\n" + style_hint.strip()
 
 
 class LLMConversation:
@@ -15,7 +30,9 @@ class LLMConversation:
 
     現状：
       - メイン応答は GPT-4o（call_with_fallback）
-      - 裏画面用に「gpt4o」「hermes」「gpt5」の3モデル分を llm_meta["models"] に詰める
+      - 裏画面用に PARTICIPATING_MODELS の各モデル分を llm_meta["models"] に詰める
+      - 実際の呼び出しは AIResponseCollector に任せる（モデルごとの temperature /
+        max_tokens / top_p は persona.model_params から解決、既定で同時投げ）
       - MultiAIResponse / JudgeAI / ComposerAI はこの models を前提に動く
     """
 
@@ -25,12 +42,24 @@ class LLMConversation:
         temperature: float = 0.7,
         max_tokens: int = 800,
         style_hint: str = "",
+        concurrent: bool = True,
+        model_timeout: float = 60.0,
+        persona: Optional[Persona] = None,
     ) -> None:
         self.system_prompt = system_prompt
         self.temperature = float(temperature)
         self.max_tokens = int(max_tokens)
         self.style_hint = style_hint.strip() if style_hint else ""
 
+        # モデルへの実際の投げ分け（temperature / max_tokens は persona に指定が無いときの既定値）
+        self.collector = AIResponseCollector(
+            persona=persona,
+            default_temperature=self.temperature,
+            default_max_tokens=self.max_tokens,
+            concurrent=concurrent,
+            model_timeout=model_timeout,
+        )
+
         # デフォルトのスタイル指針（persona に style_hint がない場合のみ使用）
         self.default_style_hint = (
             "あなたは上記の system プロンプトで定義されたキャラクターとして振る舞います。\n"
@@ -40,33 +69,36 @@ class LLMConversation:
             "純粋な日本語の物語文として出力してください。"
         )
 
+        # system ブロックはペルソナごとに 1 度だけ組み立て、以後バイト単位で固定
+        self.system_prefix = frozen_system_prefix(
+            self.system_prompt,
+            self.style_hint or self.default_style_hint,
+        )
+
     # ===== LLM に渡す messages を構築 =====
-    def build_messages(self, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    def build_messages(
+        self,
+        history: List[Dict[str, str]],
+        model_key: str = "gpt4o",
+        summary: str = "",
+    ) -> List[Dict[str, str]]:
         """
-        「system（人格＋文体指針）」＋「最新 user 発言」だけを LLM に渡す。
+        「system（人格＋文体指針）」＋「あらすじ（あれば）」＋「直近の履歴」を LLM に渡す。
+        履歴は PARTICIPATING_MODELS[model_key] のトークン予算に収まるだけ、
+        新しい方から詰める（そのモデルの出力用 max_tokens は先に確保）。
+        summary は ConversationSummarizer が畳み込んだ古い会話のあらすじ。
         """
 
-        # 1) system（ペルソナ＋スタイルヒント）
-        system_content = self.system_prompt
-        effective_style_hint = self.style_hint or self.default_style_hint
-        system_content += "\n\n" + effective_style_hint
-
-        messages: List[Dict[str, str]] = [
-            {"role": "system", "content": system_content}
+        # 1) system（ペルソナ＋スタイルヒント）… __init__ で固定済みの先頭ブロック
+        prefix: List[Dict[str, str]] = [
+            {"role": "system", "content": self.system_prefix}
         ]
+        if summary:
+            prefix.append(summary_message(summary))
 
-        # 2) 最新の user メッセージのみ抽出
-        last_user_content: str | None = None
-        for m in reversed(history):
-            if m.get("role") == "user":
-                last_user_content = m.get("content", "")
-                break
-
-        if last_user_content:
-            messages.append({"role": "user", "content": last_user_content})
-        else:
-            # user が存在しない場合（初期起動時など）
-            messages.append(
+        # 2) user が存在しない場合（初期起動時など）は自己紹介を促す
+        if not any(m.get("role") == "user" for m in history):
+            return prefix + [
                 {
                     "role": "user",
                     "content": (
@@ -74,71 +106,70 @@ class LLMConversation:
                         "あなた＝フローリアとして、軽く自己紹介してください）"
                     ),
                 }
-            )
-
-        return messages
+            ]
+
+        # 3) 予算内で直近の履歴を詰める
+        info = PARTICIPATING_MODELS.get(model_key)
+        budget = info.context_budget if info else 6000
+        tokenizer_model = info.tokenizer_model if info else "gpt-4o"
+        return pack_history(
+            prefix,
+            history,
+            budget_tokens=budget,
+            reserve_tokens=self.collector.resolve_params(model_key)["max_tokens"],
+            model=tokenizer_model,
+        )
 
     # ===== 実際に LLM へ投げる =====
     def generate_reply(
         self,
         history: List[Dict[str, str]],
+        on_delta: Optional[Callable[[str], None]] = None,
+        summary: str = "",
+        model_keys: Optional[List[str]] = None,
+        early_exit: Optional[EarlyExit] = None,
     ) -> Tuple[str, Dict[str, Any]]:
-        messages = self.build_messages(history)
-
-        # 1) GPT-4o 本体（物語の表側）
-        text_gpt, meta_gpt = call_with_fallback(
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-        )
-
-        # 2) Hermes（OpenRouter）
-        text_hermes, meta_hermes = call_hermes(
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-        )
+        """
+        on_delta を渡すと、GPT-4o の返答を差分ごとにコールバックする
+        （表側の吹き出しを少しずつ伸ばす用）。usage などは最後にまとめて meta に入る。
+        summary を渡すと、あらすじとして system の直後に差し込む
+        （history 側には畳み込み済みの発言を含めない想定）。
+        model_keys で今回呼ぶモデルを絞れる（ModelSelector 用。メインモデルは常に呼ぶ）。
+        early_exit を渡すと、勝ち目の薄い遅いモデルは待たずに打ち切る。
+        """
+        keys = [
+            key for key in self.collector.model_keys
+            if model_keys is None or key in model_keys or key == PRIMARY_KEY
+        ]
+        # モデルごとのトークン予算で履歴を詰める
+        messages_by_key: Dict[str, List[Dict[str, str]]] = {
+            key: self.build_messages(history, key, summary)
+            for key in keys
+        }
+        messages = messages_by_key[PRIMARY_KEY]
 
-        # 3) GPT-5.1（3人目候補フローリア）
-        text_gpt5, meta_gpt5 = call_gpt5_candidate(
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-        )
+        result = self.collector.collect(messages_by_key, on_delta, early_exit)
+        primary = result.responses[PRIMARY_KEY]
 
-        # Debug 用共通情報
-        meta: Dict[str, Any] = dict(meta_gpt)
+        # Debug 用共通情報（トップレベルは GPT-4o 本体の meta）
+        meta: Dict[str, Any] = dict(primary.meta)
         meta["prompt_messages"] = messages
         meta["prompt_preview"] = "\n\n".join(
             f"[{m['role']}] {m['content'][:300]}"
             for m in messages
         )
-
-        usage_gpt = meta_gpt.get("usage_main") or {}
-        usage_hermes = meta_hermes.get("usage_main") or {}
-        usage_gpt5 = meta_gpt5.get("usage_main") or {}
+        meta["fanout"] = result.fanout_info()
 
         # 裏画面用 models セクション
-        meta["models"] = {
-            "gpt4o": {
-                "reply": text_gpt,
-                "usage": usage_gpt,
-                "route": meta_gpt.get("route", "gpt"),
-                "model_name": meta_gpt.get("model_main", "gpt-4o"),
-            },
-            "hermes": {
-                "reply": text_hermes,
-                "usage": usage_hermes,
-                "route": meta_hermes.get("route", "openrouter"),
-                "model_name": meta_hermes.get("model_main", "Hermes"),
-            },
-            "gpt5": {
-                "reply": text_gpt5,
-                "usage": usage_gpt5,
-                "route": meta_gpt5.get("route", "gpt5-candidate"),
-                "model_name": meta_gpt5.get("model_main", "gpt-5.1"),
-            },
-        }
+        models = result.models_dict()
+        for key, info in models.items():
+            model_info = PARTICIPATING_MODELS.get(key)
+            info["prompt_tokens_est"] = total_tokens(
+                messages_by_key[key],
+                model_info.tokenizer_model if model_info else "gpt-4o",
+            )
+            info["history_messages"] = len(messages_by_key[key]) - 1
+        meta["models"] = models
 
-        # 表側に返すのは従来どおり GPT-4o の返答（Composer は Backstage 側で見る）
-        return text_gpt, meta
+        # 表側に返すのは GPT-4o の返答（差し替えの判断は LyraCore 側の Composer）
+        return primary.reply, meta
@@ -0,0 +1,184 @@
+# conversation_summarizer.py — 長い会話履歴を「あらすじ」に畳み込む層
+#
+# 役割：
+#   ・履歴が一定量を超えたら、古いターンを running summary（あらすじ）に畳み込む
+#   ・要約は裏のスレッドで作る（プレイヤーの待ち時間には乗せない）
+#   ・できあがった要約は次のターンの頭で session_state に取り込む
+#   ・LLMConversation.build_messages が system の直後にあらすじを差し込み、
+#     畳み込み済みの古い発言は送らない
+#
+# これで、セッションがどれだけ長くなっても 1 ターンのプロンプト量はほぼ一定になる。
+
+from __future__ import annotations
+
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from llm_router import call_with_fallback
+from message_store import index_of_seq, seq_of_index
+
+
+# 要約専用の小さなスレッドプール（会話本体のファンアウトとは分ける）
+_SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="lyra-summary")
+
+
+class ConversationSummarizer:
+    """
+    state[STATE_KEY] = {
+        "text": "これまでのあらすじ…",
+        "covered": 12,   # 通し番号 12 より前の発言まであらすじに畳み込み済み
+        "store": "...",  # MessageStore.store_id（別の会話のログに当てはめないため）
+    }
+
+    covered は MessageStore の通し番号（seq）で持つので、古い発言が
+    リングバッファから捨てられても位置がずれない（ただの list なら添字と同じ）。
+    current() / maybe_schedule() は、その時点の messages の添字に直して使う。
+    """
+
+    STATE_KEY = "conversation_summary"
+    PENDING_KEY = "_conversation_summary_job"
+
+    def __init__(
+        self,
+        keep_recent: int = 20,
+        fold_threshold: int = 20,
+        max_chars: int = 800,
+        max_tokens: int = 900,
+    ) -> None:
+        # 直近 keep_recent 件は常に生のまま残す
+        self.keep_recent = int(keep_recent)
+        # 畳み込める古い発言が fold_threshold 件たまったら要約を作り直す
+        self.fold_threshold = int(fold_threshold)
+        self.max_chars = int(max_chars)
+        self.max_tokens = int(max_tokens)
+
+    # ===== 状態の読み出し =====
+    def current(self, state: Dict[str, Any], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        いま使ってよい要約を返す（無ければ text="" / covered=0）。
+        covered は messages の添字（ここより前はあらすじに畳み込み済み）。
+        履歴がリセットされていたら（別のログ / covered が履歴の先）捨てる。
+        """
+        summary = state.get(self.STATE_KEY)
+        if not isinstance(summary, dict):
+            return {"text": "", "covered": 0}
+        covered_seq = int(summary.get("covered", 0))
+        store_id = getattr(messages, "store_id", None)
+        if (
+            summary.get("store", store_id) != store_id
+            or covered_seq > seq_of_index(messages, len(messages))
+        ):
+            state.pop(self.STATE_KEY, None)
+            state.pop(self.PENDING_KEY, None)
+            return {"text": "", "covered": 0}
+        return {
+            "text": str(summary.get("text") or ""),
+            "covered": index_of_seq(messages, covered_seq),
+        }
+
+    # ===== 裏で終わった要約の取り込み =====
+    def harvest(self, state: Dict[str, Any]) -> bool:
+        """終わっている要約ジョブがあれば state に反映する。反映したら True。"""
+        job: Optional[Future] = state.get(self.PENDING_KEY)
+        if job is None or not job.done():
+            return False
+        state.pop(self.PENDING_KEY, None)
+        try:
+            result = job.result()
+        except Exception:  # noqa: BLE001
+            return False
+        if not result:
+            return False
+        state[self.STATE_KEY] = result
+        return True
+
+    def is_pending(self, state: Dict[str, Any]) -> bool:
+        job = state.get(self.PENDING_KEY)
+        return job is not None and not job.done()
+
+    # ===== 要約ジョブの投入 =====
+    def maybe_schedule(self, state: Dict[str, Any], messages: List[Dict[str, Any]]) -> bool:
+        """
+        畳み込める古い発言が fold_threshold 件以上あれば、裏で要約を作り始める。
+        投入したら True。
+        """
+        if self.is_pending(state):
+            return False
+
+        summary = self.current(state, messages)
+        covered = summary["covered"]
+        fold_until = len(messages) - self.keep_recent
+        if fold_until - covered < self.fold_threshold:
+            return False
+
+        # 裏のスレッドには、ここ（追記の前）でコピーした発言だけを渡す。
+        # MessageView のままだと、次の追記で古い発言がリングから捨てられて読めなくなる
+        to_fold = [
+            {"role": str(m.get("role")), "content": str(m.get("content") or "")}
+            for m in messages[covered:fold_until]
+            if m.get("role") in ("user", "assistant")
+        ]
+        ctx = contextvars.copy_context()
+        state[self.PENDING_KEY] = _SUMMARY_EXECUTOR.submit(
+            ctx.run,
+            self._summarize,
+            summary["text"],
+            to_fold,
+            seq_of_index(messages, fold_until),
+            getattr(messages, "store_id", None),
+        )
+        return True
+
+    # ===== 要約本体（ワーカースレッドで実行。state には触らない） =====
+    def _summarize(
+        self,
+        previous: str,
+        to_fold: List[Dict[str, str]],
+        covered: int,
+        store_id: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        lines: List[str] = []
+        for m in to_fold:
+            speaker = "プレイヤー" if m["role"] == "user" else "キャラクター"
+            lines.append(f"{speaker}：{m['content']}")
+
+        prompt = (
+            "以下は、ロールプレイ会話の「これまでのあらすじ」と、その続きの会話です。\n"
+            "両方を統合して、新しいあらすじを日本語で書いてください。\n"
+            "・固有名詞、約束、関係や感情の変化、未解決の出来事は落とさない\n"
+            "・会話文の引用はせず、地の文で簡潔にまとめる\n"
+            f"・{self.max_chars}字以内。見出しや箇条書きは使わない\n\n"
+            "=== これまでのあらすじ ===\n"
+            f"{previous or '（まだありません）'}\n\n"
+            "=== 続きの会話 ===\n"
+            + "\n".join(lines)
+        )
+        messages = [
+            {"role": "system", "content": "あなたは物語の要約係です。指示された形式のあらすじだけを返してください。"},
+            {"role": "user", "content": prompt},
+        ]
+        text, _meta = call_with_fallback(
+            messages,
+            temperature=0.0,
+            max_tokens=self.max_tokens,
+        )
+        text = text.strip()
+        if not text:
+            # 失敗時は前の要約を維持（covered も進めない）
+            return None
+        result: Dict[str, Any] = {"text": text, "covered": covered}
+        if store_id is not None:
+            result["store"] = store_id
+        return result
+
+
+def summary_message(text: str) -> Dict[str, str]:
+    """build_messages が system の直後に差し込む、あらすじ用メッセージ。"""
+    return {
+        "role": "system",
+        "content": "これまでのあらすじ（古い会話の要約）：\n" + text,
+    }
+
+
+__all__ = ["ConversationSummarizer", "summary_message"]
@@ -1,3 +1,3 @@
-from .ai_response_collector import AIResponseCollector
+from .ai_response_collector import AIResponseCollector, CollectionResult, ModelResponse
 
-__all__ = ["AIResponseCollector"]
+__all__ = ["AIResponseCollector", "CollectionResult", "ModelResponse"]
@@ -1,23 +1,145 @@
 # deliberation/ai_response_collector.py
 
 from __future__ import annotations
-from typing import Any, Dict, Optional
 
-from deliberation.multi_ai_response import PARTICIPATING_MODELS
+import contextvars
+import os
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from deliberation.early_exit import EarlyExit
+from deliberation.participating_models import PARTICIPATING_MODELS, ModelInfo
+from llm_router import (
+    call_with_fallback,   # GPT-4o（物語本体）
+    stream_with_fallback, # GPT-4o（ストリーミング版）
+    call_hermes,          # Hermes
+    call_gpt5_candidate,  # GPT-5.1（3人目候補）
+)
+from llm_ratelimit import max_in_flight_total
+from llm_resilience import error_info
 from personas.persona_floria_ja import Persona
 
 
+# PARTICIPATING_MODELS のキーごとの呼び出し先
+#   (呼び出し関数, route の既定値, model_name の既定値)
+MODEL_CALLERS: Dict[str, Tuple[Callable[..., Tuple[str, Dict[str, Any]]], str, str]] = {
+    "gpt4o": (call_with_fallback, "gpt", "gpt-4o"),
+    "hermes": (call_hermes, "openrouter", "Hermes"),
+    "gpt5": (call_gpt5_candidate, "gpt5-candidate", "gpt-5.1"),
+}
+
+# 表側に出す（ストリーミング対象の）モデル
+PRIMARY_KEY = "gpt4o"
+
+# OpenAI 互換 API にそのまま渡す追加のサンプリング指定
+SAMPLING_KEYS = ("top_p", "presence_penalty", "frequency_penalty")
+
+# プロセス全体で共有するファンアウト用スレッドプール
+# （Streamlit の rerun ごとに作り直さないようモジュールレベルで保持）
+# 大きさは FANOUT_WORKERS、無ければプロバイダごとの同時実行数の上限の合計。
+# タイムアウト・見切りで手放した呼び出しも終わるまでワーカーを使うので、
+# 関所（llm_ratelimit）が通せる数より小さいと、他のセッションの呼び出しがプールの前で詰まる。
+_FANOUT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FANOUT_WORKERS", "0")) or max_in_flight_total(),
+    thread_name_prefix="lyra-fanout",
+)
+
+
+@dataclass
+class ModelResponse:
+    """1 モデル分の収集結果。"""
+    key: str
+    reply: str
+    params: Dict[str, Any]          # 実際に使った temperature / max_tokens / top_p など
+    meta: Dict[str, Any]            # llm_router が返した meta（route / usage_main / error ...）
+    elapsed_ms: float
+    default_route: str = ""
+    default_name: str = ""
+
+    @property
+    def error(self) -> Any:
+        return self.meta.get("error") or self.meta.get("gpt_error")
+
+    def to_model_info(self) -> Dict[str, Any]:
+        """llm_meta["models"][key] に入れる形。"""
+        info: Dict[str, Any] = {
+            "reply": self.reply,
+            "usage": self.meta.get("usage_main") or {},
+            "route": self.meta.get("route", self.default_route),
+            "model_name": self.meta.get("model_main", self.default_name),
+            "elapsed_ms": round(self.elapsed_ms, 1),
+            "params": dict(self.params),
+        }
+        if "queue_wait_ms" in self.meta:
+            info["queue_wait_ms"] = self.meta["queue_wait_ms"]
+        if self.error:
+            info["error"] = self.error
+        return info
+
+
+@dataclass
+class CollectionResult:
+    """1 ターン分の収集結果（全モデル）。"""
+    responses: Dict[str, ModelResponse] = field(default_factory=dict)
+    mode: str = "concurrent"
+    streaming: bool = False
+    elapsed_ms: float = 0.0
+    timeout_s: float = 0.0
+    # EarlyExit で待つのをやめたモデル -> 理由
+    abandoned: Dict[str, str] = field(default_factory=dict)
+
+    def models_dict(self) -> Dict[str, Dict[str, Any]]:
+        return {key: r.to_model_info() for key, r in self.responses.items()}
+
+    def fanout_info(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "streaming": self.streaming,
+            "elapsed_ms": round(self.elapsed_ms, 1),
+            "timeout_s": self.timeout_s,
+            "abandoned": dict(self.abandoned),
+        }
+
+
 class AIResponseCollector:
     """
-    将来的に「複数AIから一括でレスポンスを集める」係。
-    今は最低限、llm_meta["models"] を組み立てる実装。
+    「複数AIから一括でレスポンスを集める」係。
 
-    ★ persona.model_params から、モデルごとの temperature 等を読み取り、
-      llm_meta["models"][key]["params"] に入れておく。
+    - PARTICIPATING_MODELS のうち MODEL_CALLERS に呼び出し先があるモデルを全部呼ぶ
+    - モデルごとの temperature / max_tokens / top_p などは persona.model_params から解決
+      （指定が無い項目は default_temperature / default_max_tokens）
+    - 既定では全モデルを同時に投げる。1ターンの待ち時間は「一番遅いモデル」程度
+    - on_delta を渡すと、PRIMARY_KEY のモデルだけは呼び出し元スレッドでストリーミングする
+      （Streamlit の描画を触るため）
     """
 
-    def __init__(self) -> None:
-        self.participating_models = PARTICIPATING_MODELS
+    def __init__(
+        self,
+        persona: Optional[Persona] = None,
+        default_temperature: float = 0.7,
+        default_max_tokens: int = 800,
+        concurrent: bool = True,
+        model_timeout: float = 60.0,
+        participating_models: Optional[Dict[str, ModelInfo]] = None,
+        max_queue_wait: float = float(os.getenv("FANOUT_MAX_QUEUE_WAIT", "15")),
+    ) -> None:
+        self.persona = persona
+        self.default_temperature = float(default_temperature)
+        self.default_max_tokens = int(default_max_tokens)
+        # True: 全モデル同時投げ / False: 1モデルずつ順番に（旧来の挙動）
+        self.concurrent = bool(concurrent)
+        # 1モデルあたりの待ち時間上限（秒）。遅いモデルが他を巻き込まないようにする
+        self.model_timeout = float(model_timeout)
+        # スレッドプールの空き待ちの上限（秒）。model_timeout は実際に走り出してから数える
+        self.max_queue_wait = float(max_queue_wait)
+        self.participating_models = participating_models or PARTICIPATING_MODELS
+
+    # ---- 参加モデル ----
+    @property
+    def model_keys(self) -> List[str]:
+        return [k for k in self.participating_models if k in MODEL_CALLERS]
 
     # ---- モデル別パラメータ抽出 ----
     def _resolve_params_for_model(
@@ -51,43 +173,232 @@ class AIResponseCollector:
             except Exception:
                 pass
 
-        for k in ("top_p", "presence_penalty", "frequency_penalty"):
+        for k in SAMPLING_KEYS:
             if k in mp:
                 result[k] = mp[k]
 
         return result
 
-    # ---- models セクション構築 ----
-    def attach_models(
-        self,
-        llm_meta: Dict[str, Any],
-        base_reply_text: str,
-        base_usage: Dict[str, Any] | None,
-        persona: Optional[Persona] = None,
-    ) -> None:
-        if base_usage is None:
-            base_usage = {}
-
-        models: Dict[str, Any] = {}
-
-        # GPT-4o
-        gpt_params = self._resolve_params_for_model(persona, "gpt4o")
-        models["gpt4o"] = {
-            "reply": base_reply_text,
-            "usage": base_usage,
-            "route": llm_meta.get("route", "gpt"),
-            "model_name": llm_meta.get("model_main", "gpt-4o"),
-            "params": gpt_params,
+    def resolve_params(self, model_key: str) -> Dict[str, Any]:
+        """persona の指定に既定値を補った、実際に使うパラメータ。"""
+        params: Dict[str, Any] = {
+            "temperature": self.default_temperature,
+            "max_tokens": self.default_max_tokens,
         }
+        params.update(self._resolve_params_for_model(self.persona, model_key))
+        return params
+
+    @staticmethod
+    def _split_params(params: Dict[str, Any]) -> Tuple[float, int, Dict[str, Any]]:
+        sampling = {k: params[k] for k in SAMPLING_KEYS if k in params}
+        return float(params["temperature"]), int(params["max_tokens"]), sampling
+
+    # ---- 1モデル分の呼び出し（ワーカースレッド内で実行） ----
+    def _call_model(self, key: str, messages: List[Dict[str, str]]) -> ModelResponse:
+        """例外はここで meta["error"] に落とし、他モデルの収集を止めない。"""
+        fn, default_route, default_name = MODEL_CALLERS[key]
+        params = self.resolve_params(key)
+        temperature, max_tokens, sampling = self._split_params(params)
+
+        started = time.perf_counter()
+        try:
+            text, meta = fn(
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=self.model_timeout,
+                sampling=sampling or None,
+            )
+        except Exception as e:  # noqa: BLE001
+            text, meta = "", {"route": "error", "error": error_info(e)}
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        return ModelResponse(key, text, params, meta, elapsed_ms, default_route, default_name)
+
+    # ---- メインモデルのストリーミング呼び出し（呼び出し元スレッドで実行） ----
+    def _stream_primary(
+        self,
+        messages: List[Dict[str, str]],
+        on_delta: Callable[[str], None],
+    ) -> ModelResponse:
+        _fn, default_route, default_name = MODEL_CALLERS[PRIMARY_KEY]
+        params = self.resolve_params(PRIMARY_KEY)
+        temperature, max_tokens, sampling = self._split_params(params)
+
+        started = time.perf_counter()
+        meta: Dict[str, Any] = {}
+        parts: List[str] = []
+        for delta in stream_with_fallback(
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=self.model_timeout,
+            meta=meta,
+            sampling=sampling or None,
+        ):
+            parts.append(delta)
+            on_delta(delta)
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        return ModelResponse(
+            PRIMARY_KEY, "".join(parts), params, meta, elapsed_ms, default_route, default_name
+        )
+
+    # ---- 全モデルへの同時投げ ----
+    def _timeout_response(self, key: str, error: str, elapsed_ms: float) -> ModelResponse:
+        _fn, default_route, default_name = MODEL_CALLERS[key]
+        return ModelResponse(
+            key,
+            "",
+            self.resolve_params(key),
+            {"route": "timeout", "error": error},
+            elapsed_ms,
+            default_route,
+            default_name,
+        )
+
+    def _fan_out(
+        self,
+        messages_by_key: Dict[str, List[Dict[str, str]]],
+        on_delta: Optional[Callable[[str], None]] = None,
+        early_exit: Optional[EarlyExit] = None,
+        abandoned: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, ModelResponse]:
+        """
+        全モデルを同時に投げ、各モデルが走り出してから model_timeout 秒で打ち切る。
+        間に合わなかったモデルは reply="" / error="timeout" として扱う
+        （スレッド自体は OpenAI クライアント側の timeout で後から終わる）。
+        スレッドプールが混んでいて max_queue_wait 秒たっても走り出さなかったモデルは
+        error="queue_timeout"。
+        early_exit を渡すと、届いた順に見切りを判定し、見切ったモデルは結果に入れず
+        abandoned に理由を書く。
+        """
+        started = time.perf_counter()
+        streaming_primary = on_delta is not None and PRIMARY_KEY in messages_by_key
+        # ワーカーが実際に走り出した時刻（プールの空き待ちは model_timeout に数えない）
+        run_started: Dict[str, float] = {}
+
+        def run(key: str, messages: List[Dict[str, str]]) -> ModelResponse:
+            run_started[key] = time.perf_counter()
+            return self._call_model(key, messages)
 
-        # Hermes
-        hermes_params = self._resolve_params_for_model(persona, "hermes")
-        models["hermes"] = {
-            "reply": base_reply_text,
-            "usage": base_usage,
-            "route": "openrouter",
-            "model_name": "nousresearch/hermes-4-70b",
-            "params": hermes_params,
+        # contextvars（レート制限用のセッション ID）をワーカーへ引き継ぐ
+        futures: Dict[Future, str] = {
+            _FANOUT_EXECUTOR.submit(contextvars.copy_context().run, run, key, messages): key
+            for key, messages in messages_by_key.items()
+            if not (streaming_primary and key == PRIMARY_KEY)
         }
 
-        llm_meta["models"] = models
+        def deadline(fut: Future) -> float:
+            begun = run_started.get(futures[fut])
+            if begun is None:
+                return started + self.max_queue_wait
+            return begun + self.model_timeout
+
+        results: Dict[str, ModelResponse] = {}
+        if streaming_primary:
+            results[PRIMARY_KEY] = self._stream_primary(messages_by_key[PRIMARY_KEY], on_delta)
+
+        not_done = set(futures)
+        while not_done:
+            # 届いている返答は先に取り込む（待ち時間切れや見切りで、払い済みの返答を捨てない）
+            for fut in [f for f in not_done if f.done()]:
+                not_done.discard(fut)
+                results[futures[fut]] = fut.result()
+            if not not_done:
+                break
+
+            # 時間切れのモデルは待つのをやめる
+            now = time.perf_counter()
+            for fut in [f for f in not_done if deadline(f) <= now]:
+                not_done.discard(fut)
+                key = futures[fut]
+                begun = run_started.get(key)
+                if begun is None and fut.cancel():
+                    results[key] = self._timeout_response(
+                        key, "queue_timeout", (now - started) * 1000.0
+                    )
+                elif begun is not None:
+                    results[key] = self._timeout_response(key, "timeout", (now - begun) * 1000.0)
+                else:
+                    # cancel() の直前に走り出していた。走り出した時刻から数え直す
+                    not_done.add(fut)
+            if not not_done:
+                break
+
+            elapsed = now - started
+            remaining = max(0.0, min(deadline(f) for f in not_done) - now)
+            if early_exit is not None:
+                # 見切りの対象は、まだ走っているモデルだけ。
+                # PRIMARY_KEY は表に出す返答の既定なので、どれだけ遅くても見切らない
+                dropped = early_exit.abandon(
+                    {k: r.to_model_info() for k, r in results.items()},
+                    [futures[f] for f in not_done if futures[f] != PRIMARY_KEY],
+                    elapsed,
+                )
+                if dropped:
+                    for fut in [f for f in not_done if futures[f] in dropped]:
+                        fut.cancel()
+                        not_done.discard(fut)
+                    if abandoned is not None:
+                        abandoned.update(dropped)
+                    continue
+                check = early_exit.next_check_s(elapsed)
+                if check is not None:
+                    remaining = min(remaining, check)
+            # 走り出す前のモデルがいると期限が延びうるので、FIRST_COMPLETED で起きて見直す
+            queued = any(futures[f] not in run_started for f in not_done)
+            wait(
+                not_done,
+                timeout=remaining,
+                return_when=FIRST_COMPLETED if early_exit is not None or queued else ALL_COMPLETED,
+            )
+        return results
+
+    # ---- 1モデルずつ順番に投げる（旧来の挙動） ----
+    def _run_serial(
+        self,
+        messages_by_key: Dict[str, List[Dict[str, str]]],
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, ModelResponse]:
+        results: Dict[str, ModelResponse] = {}
+        for key, messages in messages_by_key.items():
+            if on_delta is not None and key == PRIMARY_KEY:
+                results[key] = self._stream_primary(messages, on_delta)
+            else:
+                results[key] = self._call_model(key, messages)
+        return results
+
+    # ---- 収集本体 ----
+    def collect(
+        self,
+        messages_by_key: Dict[str, List[Dict[str, str]]],
+        on_delta: Optional[Callable[[str], None]] = None,
+        early_exit: Optional[EarlyExit] = None,
+    ) -> CollectionResult:
+        """
+        messages_by_key（モデルごとに組んだプロンプト）を各モデルに投げ、結果を集める。
+        並び順は messages_by_key の順（＝ PARTICIPATING_MODELS の順）にそろえる。
+        early_exit は同時投げのときだけ効く（順番に投げるときは全モデルを待つ）。
+        """
+        started = time.perf_counter()
+        abandoned: Dict[str, str] = {}
+        if self.concurrent:
+            results = self._fan_out(messages_by_key, on_delta, early_exit, abandoned)
+        else:
+            results = self._run_serial(messages_by_key, on_delta)
+        return CollectionResult(
+            responses={key: results[key] for key in messages_by_key if key in results},
+            mode="concurrent" if self.concurrent else "serial",
+            streaming=on_delta is not None,
+            elapsed_ms=(time.perf_counter() - started) * 1000.0,
+            timeout_s=self.model_timeout,
+            abandoned=abandoned,
+        )
+
+
+__all__ = [
+    "MODEL_CALLERS",
+    "PRIMARY_KEY",
+    "ModelResponse",
+    "CollectionResult",
+    "AIResponseCollector",
+]
@@ -17,6 +17,8 @@ class ComposerAI:
     def __init__(self, mode: str = "winner_only") -> None:
         # mode:
         #   - "winner_only": Judge の winner モデルの返答をそのまま採用
+        #   - "speculative": まず速い候補を表に出し、審議後に winner と差し替える
+        #                    （LyraCore.proceed_turn / reconcile が使う）
         self.mode = mode
 
     def decide_final_reply(
@@ -65,6 +67,31 @@ class ComposerAI:
             "final_reply": final_reply,
         }
 
+    def pick_speculative(
+        self,
+        models: Dict[str, Any],
+        pre_scores: Dict[str, Dict[str, Any]],
+        primary_key: str = "gpt4o",
+    ) -> str:
+        """
+        審議を待たずに表側へ出す候補を選ぶ。
+
+        - メインモデル（ストリーミングで既に見せている）が足切りを通っていればそれ
+        - 落ちていれば（エラー・空など）、足切りを通った中で一番早く返ってきたもの
+        pre_scores は PreJudgeDecision.scores_dict() の形。
+        """
+        acceptable = [
+            k for k in models
+            if not (pre_scores.get(k) or {}).get("disqualified")
+            and not (pre_scores.get(k) or {}).get("duplicate_of")
+        ]
+        if primary_key in acceptable or not acceptable:
+            return primary_key
+        return min(
+            acceptable,
+            key=lambda k: float((models.get(k) or {}).get("elapsed_ms") or float("inf")),
+        )
+
     def _default_chosen_model(self, models: Dict[str, Any]) -> str:
         """
         何も決められなかった場合の「とりあえずのモデル名」。
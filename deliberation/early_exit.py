@@ -0,0 +1,85 @@
+# deliberation/early_exit.py
+# ファンアウト中に「もう待たなくていい」候補を見切る判定
+#
+# 同時投げでも、審議（PreJudge / JudgeAI）は一番遅いモデルの返答を待ってから始まる。
+# 遅いモデルほど勝たないことが多いので、届いた候補から順に PreJudge で採点し、
+#
+#   ・先頭（いま一番良い候補）がきれいな応答（pre-score が leader_score 以上）で、
+#     まだ届いていないモデルの過去の勝率が max_rival_win_rate 未満なら、それ以上待たない
+#   ・weak_deadline_s を過ぎても届かないモデルは、勝率が weak_win_rate 未満なら見切る
+#
+# 勝率は ModelSelector の統計（審議回数が warmup に満たないモデルは「不明」＝見切らない）。
+# 見切ったモデルは CollectionResult の responses に入らず、fanout["abandoned"] に理由が残る。
+# （スレッド自体は止められないので、OpenAI クライアント側の timeout で後から終わる）
+
+from __future__ import annotations
+
+import os
+from typing import Any, Dict, List, Optional
+
+from deliberation.pre_judge import PreJudge
+
+
+EARLY_EXIT = os.getenv("EARLY_EXIT", "1") == "1"
+
+
+class EarlyExit:
+    def __init__(
+        self,
+        win_rates: Dict[str, float],
+        pre_judge: Optional[PreJudge] = None,
+        leader_score: float = float(os.getenv("EARLY_EXIT_LEADER_SCORE", "0.9")),
+        max_rival_win_rate: float = float(os.getenv("EARLY_EXIT_MAX_RIVAL_WIN_RATE", "0.2")),
+        weak_deadline_s: float = float(os.getenv("EARLY_EXIT_WEAK_DEADLINE_S", "8")),
+        weak_win_rate: float = float(os.getenv("EARLY_EXIT_WEAK_WIN_RATE", "0.3")),
+    ) -> None:
+        # 統計が十分あるモデルだけ入っている（無いモデルは見切らない）
+        self.win_rates = dict(win_rates)
+        self.pre_judge = pre_judge or PreJudge()
+        self.leader_score = float(leader_score)
+        self.max_rival_win_rate = float(max_rival_win_rate)
+        # 0 以下なら締め切りでの見切りはしない
+        self.weak_deadline_s = float(weak_deadline_s)
+        self.weak_win_rate = float(weak_win_rate)
+
+    def _leader(self, arrived: Dict[str, Dict[str, Any]]) -> Optional[str]:
+        scores = {k: self.pre_judge.score_one(k, info) for k, info in arrived.items()}
+        ok = [s for s in scores.values() if not s.disqualified]
+        if not ok:
+            return None
+        best = max(ok, key=lambda s: s.score)
+        return best.key if best.score >= self.leader_score else None
+
+    def abandon(
+        self,
+        arrived: Dict[str, Dict[str, Any]],
+        pending: List[str],
+        elapsed_s: float,
+    ) -> Dict[str, str]:
+        """
+        arrived: 届いたモデルの model_info（reply / error など）
+        pending: まだ届いていないモデル
+        見切るモデルと理由を返す。
+        """
+        dropped: Dict[str, str] = {}
+        known = [k for k in pending if k in self.win_rates]
+        if not known:
+            return dropped
+
+        leader = self._leader(arrived)
+        for key in known:
+            rate = self.win_rates[key]
+            if leader is not None and rate < self.max_rival_win_rate:
+                dropped[key] = f"leader:{leader}"
+            elif 0 < self.weak_deadline_s <= elapsed_s and rate < self.weak_win_rate:
+                dropped[key] = "weak_deadline"
+        return dropped
+
+    def next_check_s(self, elapsed_s: float) -> Optional[float]:
+        """締め切りまでの残り秒数（届くのを待つ wait の timeout に使う）。"""
+        if self.weak_deadline_s <= 0 or elapsed_s >= self.weak_deadline_s:
+            return None
+        return self.weak_deadline_s - elapsed_s
+
+
+__all__ = ["EARLY_EXIT", "EarlyExit"]
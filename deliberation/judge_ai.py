@@ -3,13 +3,17 @@
 
 from __future__ import annotations
 
-import json
 import os
+from contextlib import closing
 from typing import Any, Dict, List, Tuple
 
 from openai import OpenAI, BadRequestError
 
-from deliberation.participating_models import PARTICIPATING_MODELS
+from deliberation.judge_cache import get_judge_cache, judge_cache_key, ordered_model_keys
+from deliberation.pre_judge import PreJudge
+from deliberation.verdict_parser import VerdictStreamParser
+from llm_router import get_openai_client, stream_chat_completion
+from llm_resilience import ProviderCallError, error_info
 
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -17,6 +21,21 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MAIN_MODEL = os.getenv("OPENAI_MAIN_MODEL", "gpt-4o")
 OPENAI_JUDGE_MODEL = os.getenv("OPENAI_JUDGE_MODEL", OPENAI_MAIN_MODEL)
 
+# "single"    : 全応答を 1 プロンプトに並べて一発で判定（従来方式）
+# "tournament": ペア審議を並列に回して Bradley-Terry で集約
+# "auto"      : 参加モデルが JUDGE_TOURNAMENT_MIN_MODELS 以上ならトーナメント
+JUDGE_MODE = os.getenv("JUDGE_MODE", "auto")
+JUDGE_TOURNAMENT_MIN_MODELS = int(os.getenv("JUDGE_TOURNAMENT_MIN_MODELS", "4"))
+
+LABEL_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# "json_schema"（strict な structured output）/ "json_object"（JSON モードのみ）
+JUDGE_RESPONSE_FORMAT = os.getenv("JUDGE_RESPONSE_FORMAT", "json_schema")
+# 出力は短い JSON だけなので小さめに（comment も 60 字程度）
+JUDGE_MAX_TOKENS = int(os.getenv("JUDGE_MAX_TOKENS", "200"))
+# 1 回審議（single）でも comment を待たずに切るか。トーナメントのペア審議は常に切る
+JUDGE_EARLY_STOP = os.getenv("JUDGE_EARLY_STOP", "0") == "1"
+
 
 class JudgeAI:
     """
@@ -26,19 +45,34 @@ class JudgeAI:
     - 参照: llm_meta["models"] = { model_key: {"reply": "..."} }
     - 出力: dict
         {
-          "winner": "gpt4o" | "hermes" | "judge" | "tie",
+          "winner": "gpt4o" | "hermes" | "gpt5" | "tie",
           "score_diff": 0.8,
-          "comment": "～～～"
+          "comment": "～～～",
+          "pair": {"A": "gpt4o", "B": "hermes", ...},   # single のとき
+          "tournament": {...},                          # tournament のとき
         }
     """
 
     def __init__(self) -> None:
-        if not OPENAI_API_KEY:
+        if not (os.getenv("OPENAI_API_KEY") or OPENAI_API_KEY):
             raise RuntimeError("OPENAI_API_KEY が設定されていないため JudgeAI を初期化できません。")
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        self.pre_judge = PreJudge()
+
+    @property
+    def client(self) -> OpenAI:
+        # llm_router の共有クライアントを毎回引く（キーローテーションにも追従）
+        return get_openai_client()
 
     # ===== 外向け API =====
-    def run(self, llm_meta: Dict[str, Any]) -> Dict[str, Any]:
+    def run(self, llm_meta: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+        """
+        判定を返す。
+
+        - まず PreJudge で足切りし、勝負が明らかならその場で返す（LLM は呼ばない）
+        - 接戦なら、足切りを通った候補だけで Judge を呼ぶ
+        - 同じ返答の組 × 同じ Judge モデルの結果は judge_cache から返す
+          （その場合は result["cache"] = "hit"）。失敗した判定はキャッシュしない。
+        """
         models: Dict[str, Any] = llm_meta.get("models", {})
         if not isinstance(models, dict) or len(models) < 2:
             return {
@@ -49,57 +83,120 @@ class JudgeAI:
                 "parsed": None,
             }
 
-        messages = self._build_messages(models)
-        raw_text, ok, parsed = self._call_judge(messages)
+        decision = self.pre_judge.decide(models)
+        if decision.result is not None:
+            return decision.result
+        models = {k: models[k] for k in decision.survivors}
+        result = self._run_llm(models, use_cache)
+        result["pre_judge"] = decision.scores_dict()
+        return result
+
+    def _run_llm(self, models: Dict[str, Any], use_cache: bool) -> Dict[str, Any]:
+        mode = self._mode_for(models)
+        cache = get_judge_cache()
+        cache_key = judge_cache_key(models, OPENAI_JUDGE_MODEL, mode=mode)
+        if use_cache:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return dict(cached, cache="hit")
+
+        if mode == "tournament":
+            from deliberation.judge_tournament import JudgeTournament
+
+            result = JudgeTournament(self).run(models, use_cache=use_cache)
+            result["mode"] = mode
+            if "error" not in result and result.get("winner") != "none":
+                cache.put(cache_key, result)
+            return result
+
+        result = self._judge_once(models, ordered_model_keys(models))
+        result["mode"] = mode
+        if "error" not in result and result.get("parsed") is not None:
+            cache.put(cache_key, result)
+        return result
+
+    def judge_pair(
+        self,
+        models: Dict[str, Any],
+        key_a: str,
+        key_b: str,
+        use_cache: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        2 モデルだけを比べる（トーナメントの 1 試合）。key_a が A、key_b が B に並ぶ。
+        ペア単位でも judge_cache を使うので、同じ組の再審議は課金されない。
+        """
+        sub = {key_a: models.get(key_a) or {}, key_b: models.get(key_b) or {}}
+        cache = get_judge_cache()
+        cache_key = judge_cache_key(sub, OPENAI_JUDGE_MODEL, mode=f"pair:{key_a}>{key_b}")
+        if use_cache:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return dict(cached, cache="hit")
+
+        result = self._judge_once(sub, [key_a, key_b], stop_early=True)
+        if "error" not in result and result.get("parsed") is not None:
+            cache.put(cache_key, result)
+        return result
+
+    def _mode_for(self, models: Dict[str, Any]) -> str:
+        if JUDGE_MODE in ("single", "tournament"):
+            return JUDGE_MODE
+        return "tournament" if len(models) >= JUDGE_TOURNAMENT_MIN_MODELS else "single"
+
+    def _judge_once(
+        self,
+        models: Dict[str, Any],
+        order: List[str],
+        stop_early: bool = JUDGE_EARLY_STOP,
+    ) -> Dict[str, Any]:
+        """order の順に A, B, C... を振って 1 回だけ判定し、winner をモデルキーに戻す。"""
+        label_map = self._label_map(order)
+        messages = self._build_messages(models, label_map)
+        raw_text, ok, parsed, error = self._call_judge(messages, label_map, stop_early=stop_early)
 
         if not ok or not isinstance(parsed, dict):
             # 失敗時は簡単な fallback
-            return {
+            result = {
                 "winner": "none",
                 "score_diff": 0.0,
                 "comment": "Judge モデルから有効な JSON を得られませんでした。",
                 "raw_text": raw_text,
                 "parsed": parsed,
+                "pair": label_map,
             }
+            if error:
+                result["error"] = error
+            return result
+
+        # Judge はラベル（"A" など）で答えるので、モデルキーに戻す
+        label = str(parsed.get("winner", "none")).strip()
+        winner = label_map.get(label.upper(), label)
 
-        # parsed に winner などが入っている前提
-        result = {
-            "winner": parsed.get("winner", "none"),
+        return {
+            "winner": winner,
             "score_diff": parsed.get("score_diff", 0.0),
             "comment": parsed.get("comment", ""),
             "raw_text": raw_text,
             "parsed": parsed,
+            "pair": label_map,
         }
-        return result
 
     # ===== プロンプト構築 =====
-    def _build_messages(self, models: Dict[str, Any]) -> List[Dict[str, str]]:
+    @staticmethod
+    def _label_map(order: List[str]) -> Dict[str, str]:
+        """order の先頭から A, B, C... を割り当てる（ラベル -> モデルキー）。"""
+        return {label: key for label, key in zip(LABEL_CHARS, order)}
+
+    def _build_messages(
+        self,
+        models: Dict[str, Any],
+        label_map: Dict[str, str],
+    ) -> List[Dict[str, str]]:
         """
-        各モデルの応答を A, B, C... として列挙し、
+        各モデルの応答を label_map の A, B, C... として列挙し、
         どれが良いか JSON で答えてもらう。
         """
-
-        # キーの順序は PARTICIPATING_MODELS をベースに整える
-        ordered_keys: List[str] = []
-        for k in PARTICIPATING_MODELS.keys():
-            if k in models:
-                ordered_keys.append(k)
-        # 念のため、その他のキーも後ろに追加
-        for k in models.keys():
-            if k not in ordered_keys:
-                ordered_keys.append(k)
-
-        # A, B, C... に割り当て
-        label_map: Dict[str, str] = {}
-        rev_label_map: Dict[str, str] = {}
-        label_chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        for idx, key in enumerate(ordered_keys):
-            if idx >= len(label_chars):
-                break
-            label = label_chars[idx]
-            label_map[label] = key
-            rev_label_map[key] = label
-
         lines: List[str] = []
         lines.append(
             "あなたは複数の AI 応答を比較し、物語としてより優れているものを選ぶ審判です。"
@@ -126,7 +223,7 @@ class JudgeAI:
             "{\n"
             '  "winner": "A" または "B" など、一番良いと判断したラベル,\n'
             '  "score_diff": 0.0 〜 1.0 程度のスコア差（自信の度合い）, \n'
-            '  "comment": "日本語で、なぜそれを選んだかの短い説明"\n'
+            '  "comment": "日本語で、なぜそれを選んだかの短い説明（60字以内）"\n'
             "}\n"
             "同点で優劣がつけられない場合は winner を \"tie\" にしてください。"
         )
@@ -143,38 +240,97 @@ class JudgeAI:
         return messages
 
     # ===== モデル呼び出し =====
-    def _call_judge(self, messages: List[Dict[str, str]]) -> Tuple[str, bool, Any]:
-        try:
-            resp = self.client.chat.completions.create(
-                model=OPENAI_JUDGE_MODEL,
-                messages=messages,
+    @staticmethod
+    def _response_format(label_map: Dict[str, str], kind: str) -> Dict[str, Any]:
+        """
+        JSON モードの指定。json_schema では winner をラベル + "tie" の enum に縛る。
+        フィールド順は winner → score_diff → comment（早期打ち切りのため）。
+        """
+        if kind == "json_object":
+            return {"type": "json_object"}
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "judge_verdict",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "winner": {"type": "string", "enum": list(label_map.keys()) + ["tie"]},
+                        "score_diff": {"type": "number"},
+                        "comment": {"type": "string"},
+                    },
+                    "required": ["winner", "score_diff", "comment"],
+                    "additionalProperties": False,
+                },
+            },
+        }
+
+    def _call_judge(
+        self,
+        messages: List[Dict[str, str]],
+        label_map: Dict[str, str],
+        stop_early: bool = False,
+    ) -> Tuple[str, bool, Any, Dict[str, Any] | None]:
+        """
+        戻り値: (生テキスト, JSON パース成功か, パース結果, 構造化エラー情報 or None)
+
+        structured output でストリーミングし、届いた分から VerdictStreamParser で読む。
+        stop_early=True なら winner と score_diff がそろった時点で接続を切る（comment は払わない）。
+        json_schema 非対応のモデルで response_format の 400 が返ったら、json_object で 1 回だけ取り直す。
+        429 / 5xx は llm_resilience のリトライ・サーキットブレーカー、
+        流量は llm_ratelimit の関所経由で扱う。
+        """
+        kinds = [JUDGE_RESPONSE_FORMAT]
+        if JUDGE_RESPONSE_FORMAT == "json_schema":
+            kinds.append("json_object")
+
+        for i, kind in enumerate(kinds):
+            parser = VerdictStreamParser()
+            usage: Dict[str, Any] = {}
+            stream = stream_chat_completion(
+                messages,
+                OPENAI_JUDGE_MODEL,
                 temperature=0.3,
-                max_tokens=800,
+                max_tokens=JUDGE_MAX_TOKENS,
+                usage_out=usage,
+                client=self.client,
+                response_format=self._response_format(label_map, kind),
             )
-        except BadRequestError as e:
-            text = f"[Judge BadRequestError: {e}]"
-            return text, False, None
-        except Exception as e:  # noqa: BLE001
-            text = f"[Judge Error: {e}]"
-            return text, False, None
-
-        text = resp.choices[0].message.content or ""
-
-        # JSON パースを試みる
-        parsed: Any
-        ok = True
-        try:
-            parsed = json.loads(text)
-        except json.JSONDecodeError:
-            # ```json ... ``` で返ってくるケースへの簡易対応
-            cleaned = text.strip()
-            if cleaned.startswith("```"):
-                cleaned = cleaned.strip("`")
-                cleaned = cleaned.replace("json", "", 1).strip()
             try:
-                parsed = json.loads(cleaned)
-            except Exception:  # noqa: BLE001
-                ok = False
-                parsed = None
+                # 途中で抜けたら close() で接続と関所の枠をすぐ返す
+                with closing(stream):
+                    for delta in stream:
+                        parser.feed(delta)
+                        if stop_early and parser.has("winner", "score_diff"):
+                            break
+            except ProviderCallError as e:
+                if isinstance(e.__cause__, BadRequestError):
+                    # 取り直すのは response_format が原因の 400 だけ（他の 400 は何度投げても同じ）
+                    if i + 1 < len(kinds) and _is_response_format_error(e.__cause__):
+                        continue
+                    text = f"[Judge BadRequestError: {e.__cause__}]"
+                else:
+                    text = f"[Judge Error: {e}]"
+                return text, False, None, e.info
+            except Exception as e:  # noqa: BLE001
+                # ストリーム途中の切断。winner まで読めていればそれを使う
+                parsed = parser.result()
+                if parsed is not None:
+                    return parser.text, True, parsed, None
+                return f"[Judge Error: {e}]", False, None, error_info(e)
+
+            parsed = parser.result()
+            return parser.text, parsed is not None, parsed, None
+
+        return "", False, None, None
+
 
-        return text, ok, parsed
+def _is_response_format_error(e: BadRequestError) -> bool:
+    """400 の原因が response_format（json_schema 非対応など）か。"""
+    param = str(getattr(e, "param", None) or "")
+    code = str(getattr(e, "code", None) or "")
+    if "response_format" in param or "json_schema" in param or "response_format" in code:
+        return True
+    message = str(getattr(e, "message", None) or e).lower()
+    return "response_format" in message or "json_schema" in message
@@ -0,0 +1,108 @@
+# deliberation/judge_cache.py
+# JudgeAI の判定結果キャッシュ
+#
+# Backstage ビューは Streamlit の rerun のたびに描画し直されるため、
+# 同じ返答の組に対して何度も有料の Judge 呼び出しが走っていた。
+# ここでは「並び順をそろえた各モデルの返答」と「Judge モデル名」の
+# 内容ハッシュをキーに、判定結果をプロセス全体で共有して再利用する。
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from deliberation.participating_models import PARTICIPATING_MODELS
+from llm_cache import CacheBackend, MemoryLRUCache, SQLiteCache
+
+
+def ordered_model_keys(models: Dict[str, Any]) -> List[str]:
+    """PARTICIPATING_MODELS の順を基準に、models のキーを並べる（JudgeAI と同じ順）。"""
+    ordered = [k for k in PARTICIPATING_MODELS.keys() if k in models]
+    ordered += [k for k in models.keys() if k not in ordered]
+    return ordered
+
+
+def judge_cache_key(models: Dict[str, Any], judge_model: str, mode: str = "") -> str:
+    payload = {
+        "judge_model": judge_model,
+        "mode": mode,
+        "replies": [
+            [k, str((models.get(k) or {}).get("reply") or "").strip()]
+            for k in ordered_model_keys(models)
+        ],
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class JudgeCache:
+    """
+    判定結果（dict）を backend に JSON で保存する薄いラッパ。
+    ヒット / ミス数を数えて、デバッグパネルに出せるようにする。
+    """
+
+    def __init__(self, backend: CacheBackend) -> None:
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            return None
+        try:
+            result = json.loads(value[0])
+        except Exception:  # noqa: BLE001
+            return None
+        return result if isinstance(result, dict) else None
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        self.backend.set(key, (json.dumps(result, ensure_ascii=False), {}))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+def _backend_from_env() -> CacheBackend:
+    if os.getenv("JUDGE_CACHE_BACKEND", "memory").lower() == "sqlite":
+        return SQLiteCache(
+            os.getenv("JUDGE_CACHE_PATH", os.path.join(".lyra_cache", "judge_cache.sqlite3")),
+            ttl_s=float(os.getenv("JUDGE_CACHE_TTL", "604800")),
+            max_entries=int(os.getenv("JUDGE_CACHE_MAX_ENTRIES", "5000")),
+        )
+    return MemoryLRUCache(
+        max_entries=int(os.getenv("JUDGE_CACHE_MAX_ENTRIES", "256")),
+        ttl_s=float(os.getenv("JUDGE_CACHE_TTL", "86400")),
+    )
+
+
+# プロセス全体で共有（rerun / セッションをまたいで効く）
+_JUDGE_CACHE = JudgeCache(_backend_from_env())
+
+
+def get_judge_cache() -> JudgeCache:
+    return _JUDGE_CACHE
+
+
+__all__ = [
+    "ordered_model_keys",
+    "judge_cache_key",
+    "JudgeCache",
+    "get_judge_cache",
+]
@@ -0,0 +1,100 @@
+# deliberation/judge_jobs.py
+# 裏で Judge を走らせるジョブ管理
+#
+# これまでは Backstage ビューの描画中に JudgeAI.run を同期で呼んでいたため、
+# ビューを開くたびに LLM 1 往復ぶん固まっていた。
+# ここでは LyraCore が候補を集め終えた時点でジョブを投げ、
+# 結果は turn_id をキーにプロセス全体で保持する。
+# ビュー側は status() を見て「審議中」か結果を表示するだけにする。
+
+from __future__ import annotations
+
+import contextvars
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from llm_resilience import error_info
+
+
+def _default_judge(llm_meta: Dict[str, Any]) -> Dict[str, Any]:
+    # JudgeAI は OPENAI_API_KEY が無いと初期化で落ちるので、ワーカー内で作る
+    from deliberation.judge_ai import JudgeAI
+
+    return JudgeAI().run(llm_meta)
+
+
+class JudgeJobManager:
+    """
+    turn_id -> Future を保持する。古いジョブは max_jobs を超えたら捨てる。
+
+    status() の戻り値:
+        ("pending", None) / ("done", result) / ("error", {"error": ...}) / ("unknown", None)
+
+    JudgeAI.run は失敗を例外ではなく {"winner": "none", "error": ...} で返すので、
+    "error" を含む結果も失敗として扱う。失敗したジョブは一度 "error" を返したら捨て、
+    次に submit() されたら審議し直す（失敗した判定を結果として残さない）。
+    """
+
+    def __init__(
+        self,
+        judge_fn: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        max_workers: int = 4,
+        max_jobs: int = 256,
+    ) -> None:
+        self.judge_fn = judge_fn or _default_judge
+        self.max_jobs = int(max_jobs)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="lyra-judge"
+        )
+        self._jobs: "OrderedDict[str, Future]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, turn_id: str, llm_meta: Dict[str, Any]) -> Future:
+        """
+        turn_id の審議を裏で開始する（同じ turn_id が既にあればそれを返す）。
+        llm_meta は呼び出し側で後から書き換えられても影響しないよう、models だけ写して渡す。
+        """
+        with self._lock:
+            job = self._jobs.get(turn_id)
+            if job is not None:
+                return job
+            snapshot = {"models": dict(llm_meta.get("models") or {})}
+            ctx = contextvars.copy_context()
+            job = self._executor.submit(ctx.run, self.judge_fn, snapshot)
+            self._jobs[turn_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+            return job
+
+    def status(self, turn_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        with self._lock:
+            job = self._jobs.get(turn_id)
+        if job is None:
+            return "unknown", None
+        if not job.done():
+            return "pending", None
+        try:
+            result = job.result()
+        except Exception as e:  # noqa: BLE001
+            result = {"error": error_info(e)}
+        if isinstance(result, dict) and "error" not in result:
+            return "done", result
+        self._forget(turn_id, job)
+        return "error", result if isinstance(result, dict) else {"error": "invalid judge result"}
+
+    def _forget(self, turn_id: str, job: Future) -> None:
+        with self._lock:
+            if self._jobs.get(turn_id) is job:
+                del self._jobs[turn_id]
+
+
+_JUDGE_JOBS = JudgeJobManager()
+
+
+def get_judge_jobs() -> JudgeJobManager:
+    return _JUDGE_JOBS
+
+
+__all__ = ["JudgeJobManager", "get_judge_jobs"]
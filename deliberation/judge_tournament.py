@@ -0,0 +1,264 @@
+# deliberation/judge_tournament.py
+# 参加モデルが多いときの「総当たりしない」トーナメント審議
+#
+# 全応答を A〜Z で 1 つのプロンプトに並べる方式は、モデル数に比例して
+# プロンプトも Judge の待ち時間も伸び、位置バイアスも強くなる。
+# ここでは 2 者比較（ペア審議）をラウンドごとに並列で走らせ、
+# 結果を Bradley-Terry モデルで強さスコアに集約する。
+#
+#   ・各ラウンドは「いまのスコアが近いもの同士」を、まだ当たっていない組で組む（スイス式）
+#   ・首位に勝てる見込みが低いモデルはラウンドごとに脱落させる
+#   ・首位が残り全員に十分な確率で勝てると言えたら、その時点で打ち切る
+#
+# 6〜10 モデルでも、ペア審議は 1 ラウンド N/2 本ずつ並列に流れるだけで済む。
+
+from __future__ import annotations
+
+import contextvars
+import hashlib
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+
+from deliberation.judge_cache import ordered_model_keys
+
+if TYPE_CHECKING:
+    from deliberation.judge_ai import JudgeAI
+
+
+# ペア審議専用のプール（judge_jobs のワーカーから呼ばれるので別プールにする）
+_PAIR_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("JUDGE_TOURNAMENT_WORKERS", "6")),
+    thread_name_prefix="lyra-judge-pair",
+)
+
+
+# ========= Bradley-Terry =========
+
+def bradley_terry(
+    keys: List[str],
+    matches: List[Tuple[str, str, float]],
+    iterations: int = 100,
+    prior_games: float = 1.0,
+) -> Dict[str, float]:
+    """
+    (a, b, a の得点) の対戦結果から強さ p_i を推定する（MM 法）。
+    得点は勝ち 1.0 / 引き分け 0.5 / 負け 0.0。
+
+    全勝・全敗でも発散しないよう、各モデルに「強さ 1 の仮想相手と
+    prior_games 戦して五分」という事前分布を入れている。
+    戻り値は幾何平均が 1 になるよう正規化した p_i。
+    """
+    wins: Dict[str, float] = {k: prior_games / 2.0 for k in keys}
+    games: Dict[Tuple[str, str], float] = {}
+    for a, b, score in matches:
+        if a not in wins or b not in wins:
+            continue
+        wins[a] += score
+        wins[b] += 1.0 - score
+        pair = (a, b) if a < b else (b, a)
+        games[pair] = games.get(pair, 0.0) + 1.0
+
+    strength: Dict[str, float] = {k: 1.0 for k in keys}
+    for _ in range(iterations):
+        updated: Dict[str, float] = {}
+        for k in keys:
+            denom = prior_games / (strength[k] + 1.0)
+            for (a, b), n in games.items():
+                if k == a or k == b:
+                    denom += n / (strength[a] + strength[b])
+            updated[k] = wins[k] / denom if denom > 0 else strength[k]
+        log_mean = sum(math.log(v) for v in updated.values()) / max(1, len(updated))
+        norm = math.exp(log_mean)
+        updated = {k: v / norm for k, v in updated.items()}
+        delta = max(abs(updated[k] - strength[k]) for k in keys) if keys else 0.0
+        strength = updated
+        if delta < 1e-6:
+            break
+    return strength
+
+
+def win_probability(strength: Dict[str, float], a: str, b: str) -> float:
+    """Bradley-Terry での P(a が b に勝つ)。"""
+    pa, pb = strength.get(a, 1.0), strength.get(b, 1.0)
+    return pa / (pa + pb)
+
+
+# ========= トーナメント本体 =========
+
+class JudgeTournament:
+    """
+    JudgeAI.judge_pair を使ったペア審議トーナメント。
+
+    戻り値は JudgeAI.run と同じ形（winner はモデルキー）で、
+    追加で result["tournament"] に scores / matches / eliminated / rounds を載せる。
+    """
+
+    def __init__(
+        self,
+        judge: "JudgeAI",
+        clear_prob: float = float(os.getenv("JUDGE_TOURNAMENT_CLEAR_PROB", "0.75")),
+        eliminate_prob: float = float(os.getenv("JUDGE_TOURNAMENT_ELIMINATE_PROB", "0.25")),
+        min_games_before_elimination: int = 2,
+        max_rounds: Optional[int] = None,
+    ) -> None:
+        self.judge = judge
+        # 首位が残り全員にこの確率以上で勝てるなら打ち切り
+        self.clear_prob = float(clear_prob)
+        # 首位に勝てる確率がこれ未満なら脱落
+        self.eliminate_prob = float(eliminate_prob)
+        # 1 回負けただけで落とさない（判定のブレ対策）
+        self.min_games = int(min_games_before_elimination)
+        self.max_rounds = max_rounds
+
+    # ===== ペアの組み方 =====
+    @staticmethod
+    def _pairings(
+        alive: List[str],
+        strength: Dict[str, float],
+        played: Set[Tuple[str, str]],
+    ) -> List[Tuple[str, str]]:
+        """
+        スコア順に並べ、まだ当たっていない一番近い相手と組む。
+        組めなかったモデルはこのラウンドは不戦（bye）。
+        """
+        ranked = sorted(alive, key=lambda k: -strength.get(k, 1.0))
+        pairs: List[Tuple[str, str]] = []
+        used: Set[str] = set()
+        for i, a in enumerate(ranked):
+            if a in used:
+                continue
+            for b in ranked[i + 1:]:
+                if b in used or tuple(sorted((a, b))) in played:
+                    continue
+                pairs.append((a, b))
+                used.update((a, b))
+                break
+        return pairs
+
+    @staticmethod
+    def _presentation_order(a: str, b: str) -> Tuple[str, str]:
+        """
+        位置バイアス対策で、どちらを A に置くかをペアごとにばらけさせる
+        （ハッシュで決めるので、同じペアなら毎回同じ順＝キャッシュも効く）。
+        """
+        first, second = sorted((a, b))
+        digest = hashlib.sha256(f"{first}|{second}".encode("utf-8")).digest()
+        return (first, second) if digest[0] % 2 == 0 else (second, first)
+
+    # ===== 実行 =====
+    def run(self, models: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+        keys = ordered_model_keys(models)
+        max_rounds = self.max_rounds or (math.ceil(math.log2(max(2, len(keys)))) + 2)
+
+        alive: List[str] = list(keys)
+        eliminated: List[str] = []
+        played: Set[Tuple[str, str]] = set()
+        outcomes: List[Tuple[str, str, float]] = []
+        match_log: List[Dict[str, Any]] = []
+        strength: Dict[str, float] = {k: 1.0 for k in keys}
+        rounds = 0
+
+        while len(alive) > 1 and rounds < max_rounds:
+            pairs = self._pairings(alive, strength, played)
+            if not pairs:
+                break
+            rounds += 1
+
+            futures = []
+            for a, b in pairs:
+                first, second = self._presentation_order(a, b)
+                ctx = contextvars.copy_context()
+                futures.append(
+                    _PAIR_EXECUTOR.submit(
+                        ctx.run, self.judge.judge_pair, models, first, second, use_cache
+                    )
+                )
+
+            for (a, b), future in zip(pairs, futures):
+                played.add(tuple(sorted((a, b))))
+                verdict = future.result()
+                verdict["round"] = rounds
+                match_log.append(verdict)
+                winner = verdict.get("winner")
+                if winner == a:
+                    outcomes.append((a, b, 1.0))
+                elif winner == b:
+                    outcomes.append((a, b, 0.0))
+                elif winner == "tie":
+                    outcomes.append((a, b, 0.5))
+                # 失敗したペア（"none"）は集計に入れない
+
+            strength = bradley_terry(keys, outcomes)
+            leader = max(alive, key=lambda k: strength[k])
+
+            # 首位に勝てる見込みが薄く、min_games 戦以上しているモデルを脱落させる
+            for k in list(alive):
+                if k == leader or sum(1 for pair in played if k in pair) < self.min_games:
+                    continue
+                if win_probability(strength, k, leader) < self.eliminate_prob:
+                    alive.remove(k)
+                    eliminated.append(k)
+
+            others = [k for k in alive if k != leader]
+            if not others or all(
+                win_probability(strength, leader, k) >= self.clear_prob for k in others
+            ):
+                break
+
+        return self._result(keys, strength, outcomes, match_log, eliminated, rounds)
+
+    def _result(
+        self,
+        keys: List[str],
+        strength: Dict[str, float],
+        outcomes: List[Tuple[str, str, float]],
+        match_log: List[Dict[str, Any]],
+        eliminated: List[str],
+        rounds: int,
+    ) -> Dict[str, Any]:
+        tournament = {
+            "scores": {k: round(strength[k], 4) for k in keys},
+            "matches": match_log,
+            "eliminated": eliminated,
+            "rounds": rounds,
+        }
+        if not outcomes:
+            errors = [m.get("error") for m in match_log if m.get("error")]
+            result: Dict[str, Any] = {
+                "winner": "none",
+                "score_diff": 0.0,
+                "comment": "ペア審議から有効な判定を得られませんでした。",
+                "raw_text": "",
+                "parsed": None,
+                "tournament": tournament,
+            }
+            if errors:
+                result["error"] = errors[0]
+            return result
+
+        ranked = sorted(keys, key=lambda k: -strength[k])
+        leader, runner_up = ranked[0], ranked[1]
+        # 首位が 2 位に勝つ確率を 0〜1 の「自信」に直したもの（0.5 → 0.0）
+        score_diff = max(0.0, 2.0 * win_probability(strength, leader, runner_up) - 1.0)
+
+        # ペア審議は comment を待たずに切るので、コメントは Bradley-Terry の順位から作る
+        standings = " > ".join(f"{k}({strength[k]:.2f})" for k in ranked)
+        comment = (
+            f"ペア審議 {len(outcomes)} 試合の集計で {leader} が首位"
+            f"（{runner_up} に勝つ確率 {win_probability(strength, leader, runner_up):.0%}）。"
+            f"強さ: {standings}"
+        )
+
+        return {
+            "winner": leader,
+            "score_diff": round(score_diff, 3),
+            "comment": comment,
+            "raw_text": "",
+            "parsed": None,
+            "tournament": tournament,
+        }
+
+
+__all__ = ["bradley_terry", "win_probability", "JudgeTournament"]
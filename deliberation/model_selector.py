@@ -0,0 +1,270 @@
+# deliberation/model_selector.py
+# 1 ターンごとに「どのモデルに投げるか」を選ぶ層（バンディット）
+#
+# これまでは毎ターン全モデルに投げていたが、ほとんど勝たないモデルにも
+# 毎回お金と待ち時間を払っていた。ここではペルソナごとに
+#   ・Judge での勝率（勝ち数 / 審議に参加した回数）
+#   ・レイテンシ、トークン数（指数移動平均）
+# を貯めておき、Thompson sampling で「今回メインモデルに勝ちうるモデル」だけを呼ぶ。
+#
+#   ・メインモデル（PRIMARY_KEY）は表側に出すので常に呼ぶ
+#   ・他モデルは Beta(勝ち+1, 負け+1) から引いた勝率が min_win_rate 以上のときだけ呼ぶ
+#     （勝てないモデルはまれにしか呼ばれないが、分布の裾で探索は続く）
+#   ・審議回数が warmup_trials に満たないモデルは必ず呼ぶ（最初のデータ集め）
+#   ・コスト / レイテンシ / モデル数の予算は環境変数で指定できる
+
+from __future__ import annotations
+
+import json
+import os
+import random
+import sqlite3
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from deliberation.ai_response_collector import PRIMARY_KEY
+from deliberation.participating_models import PARTICIPATING_MODELS, ModelInfo
+
+
+@dataclass
+class ModelStats:
+    wins: float = 0.0
+    trials: float = 0.0                  # 審議に参加した回数
+    latency_ms: Optional[float] = None   # 指数移動平均
+    tokens: Optional[float] = None       # 1 回あたり total_tokens の指数移動平均
+    queried: int = 0                     # 実際に呼んだ回数
+    abandoned: int = 0                   # 呼んだが EarlyExit で待たなかった回数
+
+    @property
+    def losses(self) -> float:
+        return max(0.0, self.trials - self.wins)
+
+
+class ModelStatsStore:
+    """
+    (persona, model) -> ModelStats。プロセス全体で共有する。
+    path を渡すと SQLite にも書き出し、再起動後も統計を引き継ぐ。
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], ModelStats] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        if path:
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._lock:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS model_stats ("
+                    " persona TEXT NOT NULL,"
+                    " model TEXT NOT NULL,"
+                    " stats TEXT NOT NULL,"
+                    " PRIMARY KEY (persona, model))"
+                )
+                self._conn.commit()
+                for persona, model, raw in self._conn.execute(
+                    "SELECT persona, model, stats FROM model_stats"
+                ):
+                    try:
+                        self._stats[(persona, model)] = ModelStats(**json.loads(raw))
+                    except Exception:  # noqa: BLE001
+                        continue
+
+    def get(self, persona: str, model: str) -> ModelStats:
+        with self._lock:
+            stats = self._stats.get((persona, model))
+            return ModelStats(**asdict(stats)) if stats else ModelStats()
+
+    def put(self, persona: str, model: str, stats: ModelStats) -> None:
+        with self._lock:
+            self._write(persona, model, stats)
+
+    def update(self, persona: str, model: str, fn: Callable[[ModelStats], None]) -> ModelStats:
+        """
+        fn で統計を書き換えて保存する（読み出しから書き込みまでロックを持ったまま）。
+        セッションや審議ジョブのスレッドから同時に更新しても、互いの更新を上書きしない。
+        """
+        with self._lock:
+            stats = self._stats.get((persona, model))
+            stats = ModelStats(**asdict(stats)) if stats else ModelStats()
+            fn(stats)
+            self._write(persona, model, stats)
+            return ModelStats(**asdict(stats))
+
+    def _write(self, persona: str, model: str, stats: ModelStats) -> None:
+        """self._lock を取った状態で呼ぶ。"""
+        self._stats[(persona, model)] = stats
+        if self._conn is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO model_stats (persona, model, stats) VALUES (?, ?, ?)",
+                (persona, model, json.dumps(asdict(stats))),
+            )
+            self._conn.commit()
+
+    def snapshot(self, persona: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {m: asdict(s) for (p, m), s in self._stats.items() if p == persona}
+
+
+class ModelSelector:
+    def __init__(
+        self,
+        store: Optional[ModelStatsStore] = None,
+        policy: str = os.getenv("MODEL_SELECTION", "thompson"),
+        warmup_trials: int = int(os.getenv("MODEL_SELECT_WARMUP", "5")),
+        min_win_rate: float = float(os.getenv("MODEL_SELECT_MIN_WIN_RATE", "0.15")),
+        max_models: int = int(os.getenv("MODEL_SELECT_MAX_MODELS", "0")),
+        cost_budget: float = float(os.getenv("MODEL_SELECT_COST_BUDGET", "0")),
+        latency_budget_ms: float = float(os.getenv("MODEL_SELECT_LATENCY_MS", "0")),
+        ewma_alpha: float = 0.2,
+        participating_models: Optional[Dict[str, ModelInfo]] = None,
+        rng: Optional[random.Random] = None,
+    ) -> None:
+        self.store = store or get_model_stats_store()
+        # "thompson" / "all"（従来どおり全モデル）
+        self.policy = policy
+        self.warmup_trials = int(warmup_trials)
+        # 引いた勝率がこれ未満のモデルは今回は呼ばない
+        self.min_win_rate = float(min_win_rate)
+        # 0 は「制限なし」
+        self.max_models = int(max_models)
+        self.cost_budget = float(cost_budget)
+        self.latency_budget_ms = float(latency_budget_ms)
+        self.ewma_alpha = float(ewma_alpha)
+        self.participating_models = participating_models or PARTICIPATING_MODELS
+        self.rng = rng or random.Random()
+
+    # ===== 選択 =====
+    def _estimated_cost(self, key: str, stats: ModelStats) -> float:
+        info = self.participating_models.get(key)
+        if info is None or stats.tokens is None:
+            return 0.0
+        return stats.tokens / 1000.0 * info.cost_per_1k_tokens
+
+    def select(self, persona: str, candidates: List[str]) -> Tuple[List[str], Dict[str, Any]]:
+        """
+        今回呼ぶモデルのキー（candidates の順）と、選択の内訳（meta["selection"] 用）を返す。
+        """
+        if self.policy != "thompson" or len(candidates) <= 1:
+            return list(candidates), {"policy": "all", "queried": list(candidates), "skipped": {}}
+
+        stats = {k: self.store.get(persona, k) for k in candidates}
+        samples = {
+            k: self.rng.betavariate(1.0 + s.wins, 1.0 + s.losses) for k, s in stats.items()
+        }
+
+        primary = PRIMARY_KEY if PRIMARY_KEY in candidates else candidates[0]
+        chosen = [primary]
+        cost = self._estimated_cost(primary, stats[primary])
+        skipped: Dict[str, str] = {}
+        # 事後平均より楽観的な勝率を引いて選ばれたモデル（探索）。EarlyExit で見切らない
+        explore: List[str] = []
+
+        for key in sorted((k for k in candidates if k != primary), key=lambda k: -samples[k]):
+            s = stats[key]
+            warming_up = s.trials < self.warmup_trials
+            if not warming_up and samples[key] < self.min_win_rate:
+                skipped[key] = "unlikely_to_win"
+                continue
+            if (
+                not warming_up
+                and self.latency_budget_ms > 0
+                and s.latency_ms is not None
+                and s.latency_ms > self.latency_budget_ms
+            ):
+                skipped[key] = "latency_budget"
+                continue
+            if self.max_models > 0 and len(chosen) >= self.max_models:
+                skipped[key] = "max_models"
+                continue
+            est = self._estimated_cost(key, s)
+            if self.cost_budget > 0 and cost + est > self.cost_budget:
+                skipped[key] = "cost_budget"
+                continue
+            chosen.append(key)
+            cost += est
+            if not warming_up and samples[key] > (s.wins + 1.0) / (s.trials + 2.0):
+                explore.append(key)
+
+        queried = [k for k in candidates if k in chosen]
+        return queried, {
+            "policy": self.policy,
+            "queried": queried,
+            "skipped": skipped,
+            "explore": explore,
+            "samples": {k: round(v, 3) for k, v in samples.items()},
+            "est_cost": round(cost, 5),
+        }
+
+    def win_rates(self, persona: str, keys: List[str]) -> Dict[str, float]:
+        """
+        審議回数が warmup_trials 以上のモデルの勝率（事後平均）。EarlyExit の見切り用。
+        統計の足りないモデルは含めない。
+        """
+        rates: Dict[str, float] = {}
+        for key in keys:
+            s = self.store.get(persona, key)
+            if s.trials >= self.warmup_trials:
+                rates[key] = (s.wins + 1.0) / (s.trials + 2.0)
+        return rates
+
+    # ===== 学習 =====
+    def _ewma(self, old: Optional[float], new: float) -> float:
+        return new if old is None else (1.0 - self.ewma_alpha) * old + self.ewma_alpha * new
+
+    def record_usage(self, persona: str, models: Dict[str, Any]) -> None:
+        """呼んだモデルのレイテンシとトークン数を反映する（タイムアウト・エラーも含む）。"""
+        for key, info in models.items():
+            if not isinstance(info, dict):
+                continue
+            elapsed = info.get("elapsed_ms")
+            total = (info.get("usage") or {}).get("total_tokens")
+
+            def apply(s: ModelStats, elapsed: Any = elapsed, total: Any = total) -> None:
+                s.queried += 1
+                if elapsed is not None:
+                    s.latency_ms = self._ewma(s.latency_ms, float(elapsed))
+                if total:
+                    s.tokens = self._ewma(s.tokens, float(total))
+
+            self.store.update(persona, key, apply)
+
+    def record_abandoned(self, persona: str, abandoned: Dict[str, Any]) -> None:
+        """
+        EarlyExit で待たなかったモデルも「呼んだ」回数には数える（呼び出し自体は裏で続き、課金される）。
+        返答も usage も受け取っていないので、勝率・レイテンシ・トークン数は動かさない。
+        """
+        def apply(s: ModelStats) -> None:
+            s.queried += 1
+            s.abandoned += 1
+
+        for key in abandoned:
+            self.store.update(persona, key, apply)
+
+    def record_verdict(self, persona: str, keys: List[str], winner: Any) -> None:
+        """
+        審議結果を反映する。keys は審議に参加したモデル。
+        勝者がいない（"none"）・引き分け（"tie"）のターンは数えない。
+        """
+        if winner not in keys:
+            return
+        def apply(s: ModelStats, won: bool) -> None:
+            s.trials += 1
+            if won:
+                s.wins += 1
+
+        for key in keys:
+            self.store.update(persona, key, lambda s, won=(key == winner): apply(s, won))
+
+
+_MODEL_STATS_STORE = ModelStatsStore(os.getenv("MODEL_STATS_PATH") or None)
+
+
+def get_model_stats_store() -> ModelStatsStore:
+    return _MODEL_STATS_STORE
+
+
+__all__ = ["ModelStats", "ModelStatsStore", "ModelSelector", "get_model_stats_store"]
@@ -1,14 +1,15 @@
 # deliberation/multi_ai_response.py
 
 from __future__ import annotations
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
+import uuid
 import streamlit as st
 
 from components.multi_ai_display_config import MultiAIDisplayConfig
 from components.multi_ai_model_viewer import MultiAIModelViewer
 from components.multi_ai_judge_result_view import MultiAIJudgeResultView
-from deliberation.judge_ai import JudgeAI
 from deliberation.composer_ai import ComposerAI
+from deliberation.judge_jobs import get_judge_jobs
 from deliberation.participating_models import PARTICIPATING_MODELS
 
 
@@ -21,7 +22,7 @@ class MultiAIResponse:
         self.display_config = MultiAIDisplayConfig(initial={"gpt4o": "GPT-4o", "hermes": "Hermes"})
         self.model_viewer = MultiAIModelViewer(self.display_config)
         self.judge_view = MultiAIJudgeResultView()
-        self.judge_ai = JudgeAI()
+        self.judge_jobs = get_judge_jobs()
         self.composer = ComposerAI(mode="winner_only")
 
     def _ensure_models(self, llm_meta: Dict[str, Any]) -> Dict[str, Any]:
@@ -30,13 +31,34 @@ class MultiAIResponse:
             return models
         return {}
 
-    def _ensure_judge(self, llm_meta: Dict[str, Any], models: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def _ensure_judge(
+        self, llm_meta: Dict[str, Any], models: Dict[str, Any]
+    ) -> Tuple[Optional[Dict[str, Any]], str]:
+        """
+        審議結果と状態（"done" / "pending" / "error" / "skipped"）を返す。
+        Judge は LyraCore が裏で走らせているので、ここでは待たずに結果を見に行くだけ。
+        """
         judge = llm_meta.get("judge")
         if isinstance(judge, dict):
-            return judge
+            return judge, "done"
         if not isinstance(models, dict) or len(models) < 2:
-            return None
-        return self.judge_ai.run(llm_meta)
+            return None, "skipped"
+
+        # 古い llm_meta やプロセス再起動後でジョブが無い場合は、ここで投げ直す
+        turn_id = llm_meta.get("turn_id")
+        if not turn_id:
+            turn_id = uuid.uuid4().hex
+            llm_meta["turn_id"] = turn_id
+        status, result = self.judge_jobs.status(turn_id)
+        if status == "unknown":
+            self.judge_jobs.submit(turn_id, llm_meta)
+            return None, "pending"
+        if status == "done" and isinstance(result, dict) and "error" not in result:
+            # llm_meta（session_state 内）に書き戻し、次の rerun ではジョブを見ない
+            # （失敗したジョブは JudgeJobManager が捨てるので、次の描画で投げ直される）
+            llm_meta["judge"] = result
+            return result, "done"
+        return result, status
 
     def render(self, llm_meta: Dict[str, Any] | None) -> None:
         if not isinstance(llm_meta, dict) or not llm_meta:
@@ -44,7 +66,7 @@ class MultiAIResponse:
             return
 
         models = self._ensure_models(llm_meta)
-        judge = self._ensure_judge(llm_meta, models)
+        judge, judge_status = self._ensure_judge(llm_meta, models)
 
         with st.expander("🤝 モデル応答比較", expanded=True):
             if models:
@@ -53,13 +75,31 @@ class MultiAIResponse:
                 st.caption("（models がありません）")
 
         with st.expander("⚖️ マルチAI審議結果", expanded=True):
-            self.judge_view.render(judge)
+            if judge_status == "pending":
+                st.info("審議中…（Judge を裏で実行しています）")
+                # 押すと rerun され、終わっていれば結果が表示される
+                st.button("🔄 審議結果を更新", key=f"judge_refresh_{llm_meta.get('turn_id')}")
+            elif judge_status == "error":
+                st.warning(f"審議に失敗しました: {(judge or {}).get('error')}")
+            else:
+                self.judge_view.render(judge)
 
         with st.expander("🧬 ベスト回答候補（Composer）", expanded=False):
             if not models:
                 st.caption("（models がないため、Composer は実行していません）")
                 return
 
+            composer = llm_meta.get("composer")
+            if isinstance(composer, dict) and composer.get("mode") == "speculative":
+                # LyraCore が表側に出したもの（審議後に差し替えたかどうか）をそのまま見せる
+                st.markdown(f"- モード: `speculative`（状態: `{composer.get('status')}`）")
+                st.markdown(f"- 先に表示したモデル: `{composer.get('shown_model')}`")
+                st.markdown(f"- 最終採用モデル: `{composer.get('final_model')}`")
+                final = (models.get(composer.get("final_model")) or {}).get("reply")
+                st.markdown("**最終候補テキスト:**")
+                st.write(final or "（候補なし）")
+                return
+
             base_reply = models.get("gpt4o", {}).get("reply") or ""
             final_info = self.composer.decide_final_reply("", models, judge, base_reply)
 
@@ -12,6 +12,9 @@ class ModelInfo:
     key: str          # 内部キー（models dict のキー）
     label: str        # 画面表示名
     description: str  # 説明（デバッグ用）
+    context_budget: int = 6000  # 1 リクエストに使うトークン予算（出力 max_tokens 込み）
+    tokenizer_model: str = "gpt-4o"  # トークン数を数えるときに使うモデル名
+    cost_per_1k_tokens: float = 0.0  # 1000 トークンあたりの料金の目安（USD、モデル選択の予算計算用）
 
 
 PARTICIPATING_MODELS: Dict[str, ModelInfo] = {
@@ -20,18 +23,22 @@ PARTICIPATING_MODELS: Dict[str, ModelInfo] = {
         key="gpt4o",
         label="GPT-4o",
         description="OpenAI メインモデル（物語本文担当）。",
+        cost_per_1k_tokens=0.005,
     ),
     # OpenRouter 経由 Hermes
     "hermes": ModelInfo(
         key="hermes",
         label="Hermes",
         description="OpenRouter / Hermes モデル。",
+        cost_per_1k_tokens=0.0005,
     ),
     # Judge 兼 第3の候補モデル（実体は OPENAI_JUDGE_MODEL）
-    "judge": ModelInfo(
-        key="judge",
+    # ※ キーは conversation_engine が llm_meta["models"] に入れる "gpt5" にそろえる
+    "gpt5": ModelInfo(
+        key="gpt5",
         label="Judge (GPT-5.1)",
         description="審判用モデル（環境変数 OPENAI_JUDGE_MODEL で指定）。",
+        cost_per_1k_tokens=0.005,
     ),
 }
 
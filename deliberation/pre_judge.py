@@ -0,0 +1,185 @@
+# deliberation/pre_judge.py
+# JudgeAI の前に走らせる、ローカルの軽い足切り審査
+#
+# 候補のどれかがエラー文字列（"[Hermes Error: ...]" など）や空文字だったり、
+# ペルソナで禁止している箇条書き・見出しだらけだったりするターンはかなり多い。
+# そういう「見れば分かる」ケースまで有料の Judge に投げていたので、
+# ここで長さ・書式違反・エラー印・重複・言語をざっと採点し、
+#
+#   ・勝負が明らかなら LLM を呼ばずにその場で勝者を決める
+#   ・接戦のときだけ、足切りを通った候補だけを JudgeAI に回す
+#
+# ようにする。処理はすべて文字列操作だけなので、ミリ秒もかからない。
+
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from deliberation.judge_cache import ordered_model_keys
+
+
+# "[Hermes: OPENROUTER_API_KEY 未設定]" / "[Hermes Error: ...]" / "[Judge BadRequestError: ...]" など
+_ERROR_MARKER = re.compile(r"^\[[^\]\n]*(Error|error|未設定|失敗)[^\]\n]*\]")
+# 行頭の装飾記号・箇条書き・見出し（ペルソナで禁止しているもの）
+_FORMAT_VIOLATION = re.compile(
+    r"^\s*(?:[*・•★☆◆◇■□●○▶\-]\s*|\d+[.)．）]\s+|#{1,6}\s)"
+)
+_JA_CHARS = re.compile(r"[぀-ヿ㐀-䶿一-鿿]")
+_LATIN_CHARS = re.compile(r"[A-Za-z]")
+_SPACES = re.compile(r"\s+")
+
+
+@dataclass
+class PreScore:
+    key: str
+    score: float = 1.0                 # 0.0〜1.0（高いほど良い）
+    disqualified: bool = False         # 比べるまでもなく失格
+    duplicate_of: Optional[str] = None
+    reasons: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "score": round(self.score, 3),
+            "disqualified": self.disqualified,
+            "duplicate_of": self.duplicate_of,
+            "reasons": list(self.reasons),
+        }
+
+
+@dataclass
+class PreJudgeDecision:
+    # 勝負が明らかなときだけ入る（JudgeAI.run と同じ形の判定 dict）
+    result: Optional[Dict[str, Any]]
+    # 接戦のとき JudgeAI に回す候補（失格・重複を除いたもの）
+    survivors: List[str]
+    scores: Dict[str, PreScore]
+
+    def scores_dict(self) -> Dict[str, Dict[str, Any]]:
+        return {k: s.to_dict() for k, s in self.scores.items()}
+
+
+class PreJudge:
+    def __init__(
+        self,
+        min_chars: int = 15,
+        max_chars: int = 4000,
+        expected_language: str = "ja",
+        decide_margin: float = float(os.getenv("PRE_JUDGE_MARGIN", "0.3")),
+    ) -> None:
+        self.min_chars = int(min_chars)
+        self.max_chars = int(max_chars)
+        self.expected_language = expected_language
+        # 1 位と 2 位の点差がこれ以上なら、LLM を呼ばずに決める
+        self.decide_margin = float(decide_margin)
+
+    # ===== 1 候補の採点 =====
+    def score_one(self, key: str, info: Dict[str, Any]) -> PreScore:
+        s = PreScore(key=key)
+        reply = str((info or {}).get("reply") or "").strip()
+
+        if (info or {}).get("error") or _ERROR_MARKER.match(reply):
+            s.disqualified = True
+            s.reasons.append("エラー応答")
+            return s
+        if not reply:
+            s.disqualified = True
+            s.reasons.append("空の応答")
+            return s
+
+        length = len(reply)
+        if length < self.min_chars:
+            s.score -= 0.3
+            s.reasons.append(f"短すぎる（{length}字）")
+        elif length > self.max_chars:
+            s.score -= 0.2
+            s.reasons.append(f"長すぎる（{length}字）")
+
+        lines = [ln for ln in reply.splitlines() if ln.strip()]
+        violations = sum(1 for ln in lines if _FORMAT_VIOLATION.match(ln))
+        if violations:
+            s.score -= min(0.5, 0.2 + 0.05 * (violations - 1))
+            s.reasons.append(f"行頭記号・見出し {violations} 行")
+
+        if self.expected_language == "ja":
+            ja = len(_JA_CHARS.findall(reply))
+            latin = len(_LATIN_CHARS.findall(reply))
+            if ja + latin and ja / (ja + latin) < 0.5:
+                s.score -= 0.4
+                s.reasons.append("日本語以外が中心")
+
+        s.score = max(0.0, s.score)
+        return s
+
+    # ===== 全体の判定 =====
+    def decide(self, models: Dict[str, Any]) -> PreJudgeDecision:
+        keys = ordered_model_keys(models)
+        scores: Dict[str, PreScore] = {k: self.score_one(k, models.get(k) or {}) for k in keys}
+
+        # 中身が同じ候補は、並び順で先のものだけ残す
+        seen: Dict[str, str] = {}
+        for k in keys:
+            s = scores[k]
+            if s.disqualified:
+                continue
+            norm = _SPACES.sub("", str((models.get(k) or {}).get("reply") or ""))
+            if norm in seen:
+                s.duplicate_of = seen[norm]
+                s.reasons.append(f"{seen[norm]} と同一")
+            else:
+                seen[norm] = k
+
+        survivors = [k for k in keys if not scores[k].disqualified and scores[k].duplicate_of is None]
+        ranked = sorted(survivors, key=lambda k: -scores[k].score)
+
+        if not ranked:
+            return PreJudgeDecision(
+                self._result("none", 0.0, "有効な候補がありませんでした（全候補がエラーまたは空）。", scores),
+                [],
+                scores,
+            )
+        if len(ranked) == 1:
+            return PreJudgeDecision(
+                self._result(ranked[0], 1.0, self._comment(ranked[0], scores, "他の候補は失格または重複"), scores),
+                ranked,
+                scores,
+            )
+
+        top, second = scores[ranked[0]], scores[ranked[1]]
+        margin = top.score - second.score
+        if margin >= self.decide_margin:
+            return PreJudgeDecision(
+                self._result(top.key, margin, self._comment(top.key, scores, "書式・言語チェックで大差"), scores),
+                ranked,
+                scores,
+            )
+
+        # 接戦 → JudgeAI へ
+        return PreJudgeDecision(None, ranked, scores)
+
+    @staticmethod
+    def _comment(winner: str, scores: Dict[str, PreScore], headline: str) -> str:
+        notes = [f"{k}: {'、'.join(s.reasons)}" for k, s in scores.items() if k != winner and s.reasons]
+        return f"ローカル判定（{headline}）。" + (" / ".join(notes) if notes else "")
+
+    @staticmethod
+    def _result(
+        winner: str,
+        score_diff: float,
+        comment: str,
+        scores: Dict[str, PreScore],
+    ) -> Dict[str, Any]:
+        return {
+            "winner": winner,
+            "score_diff": round(float(score_diff), 3),
+            "comment": comment,
+            "raw_text": "",
+            "parsed": None,
+            "mode": "pre_judge",
+            "pre_judge": {k: s.to_dict() for k, s in scores.items()},
+        }
+
+
+__all__ = ["PreScore", "PreJudgeDecision", "PreJudge"]
@@ -0,0 +1,277 @@
+# deliberation/rejudge.py
+# 書き出した会話ログを、あとからまとめて審議し直すバッチ
+#
+# Judge のプロンプトや審判モデルを変えたとき、過去のターンを採点し直して
+# 勝者がどう変わるかを見たい。JudgeAI はライブの llm_meta 1 件しか見られないので、
+# ここでは JSON / JSONL のログを 1 件ずつ流し読みしながら、
+#
+#   ・スレッドプールで同時に max_in_flight 件まで審議（ログ全体はメモリに載せない）
+#   ・part_size 件たまるごとに Parquet の part ファイルを書き、
+#     書けた turn_id だけをチェックポイント（_done.txt）に追記
+#   ・再実行時はチェックポイント済みの turn_id を飛ばして続きから
+#
+# を行う。失敗したターンはチェックポイントに載らないので、再実行すれば拾い直される。
+#
+# 使い方:
+#   python -m deliberation.rejudge --db .lyra_data/conversations.sqlite3 -o rejudge_out
+#   python -m deliberation.rejudge turns.jsonl [more.json ...] -o rejudge_out --workers 8
+#
+# 入力はターンごとの llm_meta。会話の保存先（ConversationDB の turn_meta）を --db で
+# そのまま読むか、ConversationDB.export_turns_jsonl() で書き出した JSONL を渡す。
+# （"JSON をダウンロード" の会話ログは role / content だけなので、審議し直せない）
+#
+# 1 レコードは llm_meta そのもの（{"turn_id": ..., "models": {...}}）か、
+# {"turn_id": ..., "llm_meta": {...}} の形。models が 2 つ未満のレコードは読み飛ばす。
+# turn_id の無いレコードは models の内容のハッシュを turn_id にする
+# （ファイル内の位置に依らないので、並びが変わっても再開・重複除去がずれない）。
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from log_stream import iter_json_records
+
+
+CHECKPOINT_NAME = "_done.txt"
+PART_PREFIX = "part-"
+
+
+def _content_turn_id(models: Dict[str, Any]) -> str:
+    """turn_id の無いレコード用。各モデルの返答の内容から決まる ID。"""
+    replies = sorted(
+        (str(key), str((info or {}).get("reply") or "") if isinstance(info, dict) else str(info))
+        for key, info in models.items()
+    )
+    raw = json.dumps(replies, ensure_ascii=False, separators=(",", ":"))
+    return "sha256:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def turn_from_record(record: Any) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """ログの 1 レコードから (turn_id, models) を取り出す。審議できないレコードは None。"""
+    if not isinstance(record, dict):
+        return None
+    meta = record.get("llm_meta") if isinstance(record.get("llm_meta"), dict) else record
+    models = meta.get("models")
+    if not isinstance(models, dict) or len(models) < 2:
+        return None
+    turn_id = record.get("turn_id") or meta.get("turn_id") or _content_turn_id(models)
+    return str(turn_id), models
+
+
+class BatchRejudger:
+    """
+    ログを流し読みしながら審議し直し、結果を out_dir に part ファイルとして書く。
+    judge_fn を差し替えれば JudgeAI 以外（別プロンプト・別モデルの審判）でも回せる。
+    """
+
+    def __init__(
+        self,
+        out_dir: str,
+        judge_fn: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        workers: int = 8,
+        part_size: int = 500,
+        use_cache: bool = False,
+        output_format: str = "parquet",
+    ) -> None:
+        self.out_dir = out_dir
+        self.workers = max(1, int(workers))
+        # 同時に抱える審議の上限（ログを先読みしすぎないように）
+        self.max_in_flight = self.workers * 2
+        self.part_size = max(1, int(part_size))
+        # 再審議が目的なので既定では judge_cache を使わない
+        self.use_cache = bool(use_cache)
+        self.output_format = output_format
+        self._judge_fn = judge_fn
+        self._judge_ai: Any = None
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.done: Set[str] = self._load_checkpoint()
+        self._part_no = sum(1 for name in os.listdir(out_dir) if name.startswith(PART_PREFIX))
+        self._pending_rows: List[Dict[str, Any]] = []
+        self.stats: Dict[str, int] = {"judged": 0, "skipped": 0, "resumed": 0, "failed": 0}
+
+    # ===== チェックポイント =====
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(self.out_dir, CHECKPOINT_NAME)
+
+    def _load_checkpoint(self) -> Set[str]:
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def _flush(self) -> None:
+        """たまった行を part ファイルに書き、書けた turn_id だけチェックポイントに載せる。"""
+        if not self._pending_rows:
+            return
+        df = pd.DataFrame(self._pending_rows)
+        path = os.path.join(self.out_dir, f"{PART_PREFIX}{self._part_no:05d}")
+        if self.output_format == "parquet":
+            try:
+                df.to_parquet(path + ".parquet", index=False)
+            except ImportError:
+                # pyarrow / fastparquet が入っていない環境では CSV で続ける
+                print("[rejudge] Parquet エンジンが無いため CSV で書き出します。", file=sys.stderr)
+                self.output_format = "csv"
+        if self.output_format == "csv":
+            df.to_csv(path + ".csv", index=False)
+        self._part_no += 1
+
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            for row in self._pending_rows:
+                f.write(row["turn_id"] + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(row["turn_id"] for row in self._pending_rows)
+        self._pending_rows = []
+
+    # ===== 審議 =====
+    def _judge(self, models: Dict[str, Any]) -> Dict[str, Any]:
+        if self._judge_fn is not None:
+            return self._judge_fn({"models": models})
+        return self._judge_ai.run({"models": models}, use_cache=self.use_cache)
+
+    def _judge_turn(self, turn_id: str, index: int, models: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        result = self._judge(models)
+        return {
+            "turn_id": turn_id,
+            "source_index": index,
+            "winner": str(result.get("winner", "none")),
+            "score_diff": float(result.get("score_diff") or 0.0),
+            "comment": str(result.get("comment", "")),
+            "mode": str(result.get("mode", "")),
+            "cache": str(result.get("cache", "")),
+            "models": ",".join(models.keys()),
+            "error": str(result["error"]) if result.get("error") else "",
+            "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+        }
+
+    def _turns(self, sources: Iterable[Any]) -> Iterator[Tuple[str, int, Dict[str, Any]]]:
+        index = 0
+        seen: Set[str] = set()
+        for source in sources:
+            # ファイルのパスか、レコードをそのまま返す iterable（ConversationDB.iter_turn_records など）
+            records = iter_json_records(source) if isinstance(source, str) else source
+            for record in records:
+                turn = turn_from_record(record)
+                index += 1
+                if turn is None:
+                    self.stats["skipped"] += 1
+                    continue
+                turn_id, models = turn
+                if turn_id in self.done:
+                    self.stats["resumed"] += 1
+                    continue
+                if turn_id in seen:
+                    self.stats["skipped"] += 1
+                    continue
+                seen.add(turn_id)
+                yield turn_id, index - 1, models
+
+    def _collect(self, fut: Future) -> None:
+        try:
+            row = fut.result()
+        except Exception as e:  # noqa: BLE001
+            print(f"[rejudge] 審議に失敗しました: {e}", file=sys.stderr)
+            self.stats["failed"] += 1
+            return
+        if row["error"] or (row["winner"] == "none" and row["mode"] != "pre_judge"):
+            # 判定できなかったターンは書かない（次回の実行で拾い直す）
+            self.stats["failed"] += 1
+            return
+        self._pending_rows.append(row)
+        self.stats["judged"] += 1
+        if len(self._pending_rows) >= self.part_size:
+            self._flush()
+
+    def run(
+        self,
+        sources: Iterable[Any],
+        progress: Optional[Callable[[Dict[str, int]], None]] = None,
+    ) -> Dict[str, int]:
+        if self._judge_fn is None and self._judge_ai is None:
+            from deliberation.judge_ai import JudgeAI
+
+            self._judge_ai = JudgeAI()
+
+        in_flight: Set[Future] = set()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="lyra-rejudge") as pool:
+            try:
+                for turn_id, index, models in self._turns(sources):
+                    if len(in_flight) >= self.max_in_flight:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            self._collect(fut)
+                        if progress is not None:
+                            progress(self.stats)
+                    in_flight.add(pool.submit(self._judge_turn, turn_id, index, models))
+                for fut in in_flight:
+                    self._collect(fut)
+            finally:
+                # 中断（Ctrl-C など）されても、審議済みの分は書いておく
+                self._flush()
+        return dict(self.stats)
+
+
+# ===== CLI =====
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m deliberation.rejudge",
+        description="書き出した会話ログ（JSON / JSONL）を審議し直して、結果を Parquet に書く。",
+    )
+    parser.add_argument(
+        "sources", nargs="*", help="ターンごとの llm_meta のログ（JSON 配列 / JSONL）"
+    )
+    parser.add_argument("--db", help="ConversationDB の SQLite ファイル（turn_meta をそのまま読む）")
+    parser.add_argument("-o", "--out-dir", default="rejudge_out", help="出力先（再実行時は続きから）")
+    parser.add_argument("--workers", type=int, default=8, help="同時に審議する数")
+    parser.add_argument("--part-size", type=int, default=500, help="part ファイル 1 つあたりの行数")
+    parser.add_argument("--use-cache", action="store_true", help="judge_cache の既存判定を使う")
+    parser.add_argument("--format", choices=("parquet", "csv"), default="parquet")
+    args = parser.parse_args(argv)
+    if not args.sources and not args.db:
+        parser.error("ログファイルか --db を指定してください")
+
+    sources: List[Any] = list(args.sources)
+    if args.db:
+        from conversation_db import ConversationDB
+
+        sources.append(ConversationDB(args.db).iter_turn_records())
+
+    rejudger = BatchRejudger(
+        args.out_dir,
+        workers=args.workers,
+        part_size=args.part_size,
+        use_cache=args.use_cache,
+        output_format=args.format,
+    )
+    started = time.perf_counter()
+    last = [0.0]
+
+    def progress(stats: Dict[str, int]) -> None:
+        now = time.perf_counter()
+        if now - last[0] >= 5.0:
+            last[0] = now
+            print(f"[rejudge] {stats}（{now - started:.0f}s）", file=sys.stderr)
+
+    stats = rejudger.run(sources, progress=progress)
+    print(f"[rejudge] 完了: {stats}（{time.perf_counter() - started:.1f}s）→ {args.out_dir}", file=sys.stderr)
+    return 0 if stats["failed"] == 0 else 1
+
+
+__all__ = ["BatchRejudger", "turn_from_record", "main"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# deliberation/verdict_parser.py
+# Judge のストリーミング出力（JSON）を、届いた分から読み進めるパーサ
+#
+# structured output（json_schema）で返させると、フィールドは
+#   {"winner": "...", "score_diff": 0.7, "comment": "..."}
+# の順で流れてくる。winner と score_diff がそろった時点で判定は決まっているので、
+# 呼び出し側はそこでストリームを切って comment の生成ぶんを払わずに済む。
+#
+# 途中の（閉じていない）JSON は json.loads できないので、
+# まだ見つかっていないフィールドだけを正規表現で拾う。確定したフィールドは二度と探さない。
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Any, Dict, Optional, Tuple
+
+_STRING_FIELD = r'"{name}"\s*:\s*"((?:[^"\\]|\\.)*)"'
+# 数値は後ろに , か } が来るまで確定しない（"0.7" の途中で切らない）
+_NUMBER_FIELD = r'"{name}"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\s*[,}}]'
+
+
+class VerdictStreamParser:
+    """
+    feed(delta) を繰り返し呼び、has("winner", "score_diff") で確定を見る。
+    最後に result() で dict を得る（JSON として閉じていなくても、取れたフィールドだけ返す）。
+    """
+
+    def __init__(
+        self,
+        string_fields: Tuple[str, ...] = ("winner", "comment"),
+        number_fields: Tuple[str, ...] = ("score_diff",),
+    ) -> None:
+        self.text = ""
+        self.fields: Dict[str, Any] = {}
+        self._patterns: Dict[str, Tuple[re.Pattern, bool]] = {}
+        for name in string_fields:
+            self._patterns[name] = (re.compile(_STRING_FIELD.format(name=re.escape(name))), True)
+        for name in number_fields:
+            self._patterns[name] = (re.compile(_NUMBER_FIELD.format(name=re.escape(name))), False)
+
+    def feed(self, delta: str) -> None:
+        self.text += delta
+        for name, (pattern, is_string) in self._patterns.items():
+            if name in self.fields:
+                continue
+            m = pattern.search(self.text)
+            if m is None:
+                continue
+            raw = m.group(1)
+            if is_string:
+                try:
+                    self.fields[name] = json.loads(f'"{raw}"')
+                except json.JSONDecodeError:
+                    self.fields[name] = raw
+            else:
+                self.fields[name] = float(raw)
+
+    def has(self, *names: str) -> bool:
+        return all(name in self.fields for name in names)
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        """閉じた JSON ならそれを、途中で切ったなら取れたフィールドを返す。何も無ければ None。"""
+        try:
+            parsed = json.loads(self.text)
+            if isinstance(parsed, dict):
+                return parsed
+        except json.JSONDecodeError:
+            pass
+        return dict(self.fields) if "winner" in self.fields else None
+
+
+__all__ = ["VerdictStreamParser"]
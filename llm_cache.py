@@ -0,0 +1,297 @@
+# llm_cache.py
+# llm_router の下で使う LLM 応答キャッシュ層
+#
+# 同じ messages + model + temperature + max_tokens の組み合わせで
+# 有料 API を何度も叩かないよう、応答テキストと usage を保存しておく。
+#
+#   ・バックエンドは差し替え可能（メモリ LRU / SQLite）
+#   ・キーは正規化したリクエストの安定ハッシュ（sha256）
+#   ・既定では決定的な呼び出し（temperature == 0）だけをキャッシュする
+#   ・ヒット / ミス数を stats() で確認できる
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+
+# キャッシュに入れる値: (応答テキスト, usage)
+CachedValue = Tuple[str, Dict[str, Any]]
+
+
+# ========= バックエンド =========
+
+class CacheBackend(Protocol):
+    def get(self, key: str) -> Optional[CachedValue]: ...
+    def set(self, key: str, value: CachedValue) -> None: ...
+    def clear(self) -> None: ...
+
+
+class MemoryLRUCache:
+    """
+    プロセス内メモリの LRU キャッシュ（TTL 付き）。
+    max_entries を超えたら、最も長く使われていないものから捨てる。
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_s: float = 3600.0) -> None:
+        self.max_entries = int(max_entries)
+        self.ttl_s = float(ttl_s)
+        self._data: "OrderedDict[str, Tuple[float, CachedValue]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedValue]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if self.ttl_s > 0 and time.time() - stored_at > self.ttl_s:
+                self._data.pop(key, None)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: CachedValue) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """
+    ディスク上の SQLite にキャッシュを置くバックエンド。
+    プロセスを再起動しても残るので、Streamlit の再デプロイ後も効く。
+    max_entries を超えたら、書き込み時に古いもの（created_at 順）から消す（0 なら上限なし）。
+    """
+
+    def __init__(self, path: str, ttl_s: float = 86400.0, max_entries: int = 10000) -> None:
+        self.path = path
+        self.ttl_s = float(ttl_s)
+        self.max_entries = int(max_entries)
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        # Streamlit のワーカースレッドから触るので check_same_thread=False + 自前ロック
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY,"
+                " text TEXT NOT NULL,"
+                " usage TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_created_at ON llm_cache (created_at)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[CachedValue]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, usage, created_at FROM llm_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            text, usage_json, created_at = row
+            if self.ttl_s > 0 and time.time() - created_at > self.ttl_s:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+        try:
+            usage = json.loads(usage_json)
+        except Exception:  # noqa: BLE001
+            usage = {}
+        return text, usage
+
+    def set(self, key: str, value: CachedValue) -> None:
+        text, usage = value
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, text, usage, created_at)"
+                " VALUES (?, ?, ?, ?)",
+                (key, text, json.dumps(usage, ensure_ascii=False), time.time()),
+            )
+            self._prune()
+            self._conn.commit()
+
+    def _prune(self) -> None:
+        """期限切れと、max_entries を超えた古い行を消す（self._lock を取った状態で呼ぶ）。"""
+        if self.ttl_s > 0:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl_s,)
+            )
+        if self.max_entries > 0:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+
+# ========= キャッシュ本体（ポリシー + カウンタ） =========
+
+def _normalize_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """role / content だけを残し、改行と前後の空白をそろえる。"""
+    normalized: List[Dict[str, str]] = []
+    for m in messages:
+        content = str(m.get("content") or "").replace("\r\n", "\n").strip()
+        normalized.append({"role": str(m.get("role") or ""), "content": content})
+    return normalized
+
+
+def make_cache_key(
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    base_url: str = "",
+    sampling: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    正規化したリクエストから安定したハッシュキーを作る。
+    sampling（top_p など追加のサンプリング指定）は指定があるときだけキーに含める。
+    """
+    payload: Dict[str, Any] = {
+        "base_url": base_url or "",
+        "model": model,
+        "messages": _normalize_messages(messages),
+        "temperature": round(float(temperature), 4),
+        "max_tokens": int(max_tokens),
+    }
+    if sampling:
+        payload["sampling"] = dict(sampling)
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    バックエンドの前に立って「キャッシュしてよい呼び出しか」を判断し、
+    ヒット / ミスを数える。
+
+    - deterministic_only=True（既定）のときは temperature == 0 の呼び出しだけを対象にする
+    - backend=None ならキャッシュ無効（常にミス扱いにもしない）
+    """
+
+    def __init__(
+        self,
+        backend: Optional[CacheBackend],
+        deterministic_only: bool = True,
+    ) -> None:
+        self.backend = backend
+        self.deterministic_only = bool(deterministic_only)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, temperature: float) -> bool:
+        if self.backend is None:
+            return False
+        if self.deterministic_only and float(temperature) != 0.0:
+            return False
+        return True
+
+    def lookup(self, key: str) -> Optional[CachedValue]:
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def store(self, key: str, text: str, usage: Dict[str, Any]) -> None:
+        if self.backend is None:
+            return
+        self.backend.set(key, (text, dict(usage)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__ if self.backend else "off",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+# ========= プロセス全体で共有するキャッシュ =========
+
+def _backend_from_env() -> Optional[CacheBackend]:
+    kind = os.getenv("LLM_CACHE_BACKEND", "memory").lower()
+    if kind in ("off", "none", "0", ""):
+        return None
+    if kind == "sqlite":
+        return SQLiteCache(
+            os.getenv("LLM_CACHE_PATH", os.path.join(".lyra_cache", "llm_cache.sqlite3")),
+            ttl_s=float(os.getenv("LLM_CACHE_TTL", "86400")),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+        )
+    return MemoryLRUCache(
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512")),
+        ttl_s=float(os.getenv("LLM_CACHE_TTL", "3600")),
+    )
+
+
+_CACHE = LLMCache(
+    _backend_from_env(),
+    deterministic_only=os.getenv("LLM_CACHE_NONDETERMINISTIC", "0") != "1",
+)
+
+
+def get_cache() -> LLMCache:
+    return _CACHE
+
+
+def set_cache_backend(
+    backend: Optional[CacheBackend],
+    deterministic_only: bool = True,
+) -> LLMCache:
+    """キャッシュのバックエンドを差し替える（None で無効化）。"""
+    global _CACHE
+    _CACHE = LLMCache(backend, deterministic_only=deterministic_only)
+    return _CACHE
+
+
+def cache_stats() -> Dict[str, Any]:
+    return _CACHE.stats()
+
+
+__all__ = [
+    "CacheBackend",
+    "MemoryLRUCache",
+    "SQLiteCache",
+    "LLMCache",
+    "make_cache_key",
+    "get_cache",
+    "set_cache_backend",
+    "cache_stats",
+]
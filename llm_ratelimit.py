@@ -0,0 +1,290 @@
+# llm_ratelimit.py
+# プロバイダごとのクライアント側レート制限 / 同時実行数の制御
+#
+# Streamlit のセッションが増えると、各セッションが 1 ターンで
+# 3 モデル + Judge を一斉に投げるため、プロバイダのレート制限に同時にぶつかる。
+# ここではプロセス全体で 1 つの「関所」を持ち、
+#
+#   ・リクエスト数 / 分（RPM）とトークン数 / 分（TPM）のトークンバケット
+#   ・プロバイダごとの同時実行数の上限
+#   ・セッション間で公平な待ち行列（サービス回数の少ないセッションを優先）
+#
+# で流量を整える。上限に当たった呼び出しは失敗させずに少し待たせ、
+# 待ち時間は meta["queue_wait_ms"] として報告する。
+
+from __future__ import annotations
+
+import contextvars
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from llm_resilience import ProviderCallError
+
+
+# どのセッションからの呼び出しかを示す（LyraEngine などが session_scope で設定する）
+_SESSION_ID: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "lyra_session_id", default="-"
+)
+
+
+@contextmanager
+def session_scope(session_id: str) -> Iterator[None]:
+    """この with ブロック内の LLM 呼び出しを session_id の分として数える。"""
+    token = _SESSION_ID.set(str(session_id))
+    try:
+        yield
+    finally:
+        _SESSION_ID.reset(token)
+
+
+def current_session_id() -> str:
+    return _SESSION_ID.get()
+
+
+class RateLimitQueueTimeout(ProviderCallError):
+    """待ち行列で max_wait_s を超えた（プロバイダ側ではなく手元の制限）。"""
+
+
+# ========= トークンバケット =========
+
+class TokenBucket:
+    """
+    capacity まで貯まり、毎秒 refill_per_s ずつ回復するバケット。
+    adjust() で後からの実績補正（返却 / 追加消費）ができる。
+    """
+
+    def __init__(self, capacity: float, refill_per_s: float) -> None:
+        self.capacity = float(capacity)
+        self.refill_per_s = float(refill_per_s)
+        self._level = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(
+            self.capacity, self._level + (now - self._updated) * self.refill_per_s
+        )
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        """amount を取り出せるまでの秒数（0 なら今すぐ取れる）。"""
+        self._refill()
+        amount = min(float(amount), self.capacity)
+        if self._level >= amount:
+            return 0.0
+        if self.refill_per_s <= 0:
+            return float("inf")
+        return (amount - self._level) / self.refill_per_s
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self._level -= float(amount)
+
+    def adjust(self, amount: float) -> None:
+        """正なら返却、負なら追加消費。"""
+        self._refill()
+        self._level = min(self.capacity, self._level + float(amount))
+
+
+# ========= プロバイダ単位の関所 =========
+
+@dataclass
+class _Ticket:
+    session: str
+    seq: int
+
+
+class Lease:
+    """acquire() で得た 1 回分の通行証。終わったら release() する。"""
+
+    def __init__(self, limiter: "ProviderLimiter", est_tokens: int, queue_wait_ms: float) -> None:
+        self.limiter = limiter
+        self.est_tokens = int(est_tokens)
+        self.queue_wait_ms = queue_wait_ms
+        self._released = False
+
+    def release(self, usage: Optional[Dict[str, Any]] = None) -> None:
+        if self._released:
+            return
+        self._released = True
+        actual: Optional[int] = None
+        if isinstance(usage, dict):
+            total = usage.get("total_tokens")
+            if isinstance(total, int):
+                actual = total
+        self.limiter._release(self.est_tokens, actual)
+
+
+class ProviderLimiter:
+    def __init__(
+        self,
+        name: str,
+        rpm: int,
+        tpm: int,
+        max_in_flight: int,
+    ) -> None:
+        self.name = name
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._rpm = TokenBucket(rpm, rpm / 60.0)
+        self._tpm = TokenBucket(tpm, tpm / 60.0)
+        self._cond = threading.Condition()
+        self._waiting: List[_Ticket] = []
+        self._in_flight = 0
+        self._served: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self.total_wait_ms = 0.0
+        self.total_grants = 0
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        if not self._waiting:
+            return None
+        return min(self._waiting, key=lambda t: (self._served.get(t.session, 0), t.seq))
+
+    def acquire(
+        self,
+        est_tokens: int,
+        session: Optional[str] = None,
+        max_wait_s: Optional[float] = None,
+    ) -> Lease:
+        """
+        枠が空くまで待って Lease を返す。
+        max_wait_s を過ぎても空かなければ RateLimitQueueTimeout。
+        """
+        if max_wait_s is None:
+            max_wait_s = float(os.getenv("LLM_LIMIT_MAX_WAIT", "15"))
+        ticket = _Ticket(session or current_session_id(), next(self._seq))
+        started = time.monotonic()
+        deadline = started + max_wait_s
+
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    sleep_for: Optional[float] = None
+                    if self._next_ticket() is ticket and self._in_flight < self.max_in_flight:
+                        need = max(
+                            self._rpm.time_until(1),
+                            self._tpm.time_until(est_tokens),
+                        )
+                        if need <= 0:
+                            self._rpm.take(1)
+                            self._tpm.take(est_tokens)
+                            self._in_flight += 1
+                            self._served[ticket.session] = self._served.get(ticket.session, 0) + 1
+                            break
+                        sleep_for = need
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RateLimitQueueTimeout({
+                            "type": "RateLimitQueueTimeout",
+                            "provider": self.name,
+                            "status": None,
+                            "retryable": False,
+                            "retry_after": None,
+                            "message": f"{self.name} の送信待ちが {max_wait_s:.0f} 秒を超えました",
+                        })
+                    self._cond.wait(timeout=min(sleep_for or remaining, remaining))
+            finally:
+                self._waiting.remove(ticket)
+                if not self._waiting:
+                    # 待ちが捌けたら公平性カウンタはリセット（古い履歴を引きずらない）
+                    self._served.clear()
+                self._cond.notify_all()
+
+        wait_ms = (time.monotonic() - started) * 1000.0
+        with self._cond:
+            self.total_wait_ms += wait_ms
+            self.total_grants += 1
+        return Lease(self, est_tokens, round(wait_ms, 1))
+
+    def _release(self, est_tokens: int, actual_tokens: Optional[int]) -> None:
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            if actual_tokens is not None:
+                # 見積もりとの差分を TPM バケットに返す（超過分は追加で消費）
+                self._tpm.adjust(est_tokens - actual_tokens)
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiting),
+                "grants": self.total_grants,
+                "avg_wait_ms": round(self.total_wait_ms / self.total_grants, 1)
+                if self.total_grants else 0.0,
+            }
+
+
+# ========= プロセス全体のレジストリ =========
+
+_LIMITERS: Dict[str, ProviderLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+_DEFAULT_LIMITS: Dict[str, Dict[str, int]] = {
+    "openai": {"rpm": 500, "tpm": 200_000, "in_flight": 16},
+    "openrouter": {"rpm": 200, "tpm": 100_000, "in_flight": 8},
+}
+
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    """
+    provider ごとの関所。上限は環境変数で上書きできる:
+      LLM_RPM_OPENAI / LLM_TPM_OPENAI / LLM_MAX_INFLIGHT_OPENAI（OPENROUTER も同様）
+    """
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(provider)
+        if limiter is None:
+            defaults = _DEFAULT_LIMITS.get(provider, _DEFAULT_LIMITS["openai"])
+            suffix = provider.upper()
+            limiter = ProviderLimiter(
+                provider,
+                rpm=int(os.getenv(f"LLM_RPM_{suffix}", defaults["rpm"])),
+                tpm=int(os.getenv(f"LLM_TPM_{suffix}", defaults["tpm"])),
+                max_in_flight=int(os.getenv(f"LLM_MAX_INFLIGHT_{suffix}", defaults["in_flight"])),
+            )
+            _LIMITERS[provider] = limiter
+        return limiter
+
+
+def max_in_flight_total() -> int:
+    """全プロバイダの同時実行数の上限の合計（LLM を呼ぶスレッドプールの大きさの目安）。"""
+    return sum(
+        int(os.getenv(f"LLM_MAX_INFLIGHT_{provider.upper()}", defaults["in_flight"]))
+        for provider, defaults in _DEFAULT_LIMITS.items()
+    )
+
+
+def limiter_states() -> Dict[str, Dict[str, Any]]:
+    with _LIMITERS_LOCK:
+        limiters = dict(_LIMITERS)
+    return {name: lim.snapshot() for name, lim in limiters.items()}
+
+
+def estimate_request_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """
+    TPM 予約用のざっくり見積もり（プロンプト + 出力上限）。
+    日本語が多いので 1 文字 ≒ 1 トークン寄りに見積もる。実績は release() で補正される。
+    """
+    chars = sum(len(str(m.get("content") or "")) for m in messages)
+    return int(chars) + int(max_tokens)
+
+
+__all__ = [
+    "session_scope",
+    "current_session_id",
+    "RateLimitQueueTimeout",
+    "TokenBucket",
+    "Lease",
+    "ProviderLimiter",
+    "get_limiter",
+    "limiter_states",
+    "max_in_flight_total",
+    "estimate_request_tokens",
+]
@@ -0,0 +1,292 @@
+# llm_resilience.py
+# プロバイダ呼び出しのリトライ / バックオフ / サーキットブレーカー
+#
+#   ・429 / 5xx / 接続エラー / タイムアウトは指数バックオフ（ジッタ付き）で再試行
+#   ・Retry-After ヘッダがあればそれを優先して待つ
+#   ・プロバイダ（"openai" / "openrouter"）ごとにサーキットブレーカーを持ち、
+#     連続で落ちている間は待たずに即失敗させる（全ターンがタイムアウト待ちになるのを防ぐ）
+#   ・失敗時は ProviderCallError.info に構造化したエラー情報を載せる（meta にそのまま入れられる）
+
+from __future__ import annotations
+
+import email.utils
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+# ========= 例外 =========
+
+class ProviderCallError(RuntimeError):
+    """リトライしても失敗したプロバイダ呼び出し。info に構造化エラー情報を持つ。"""
+
+    def __init__(self, info: Dict[str, Any]) -> None:
+        super().__init__(info.get("message") or info.get("type") or "provider error")
+        self.info = info
+
+
+class CircuitOpenError(ProviderCallError):
+    """サーキットブレーカーが開いている（プロバイダ停止中とみなして即失敗）。"""
+
+
+# ========= ポリシー =========
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+    base_delay_s: float = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+    max_delay_s: float = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+    # Retry-After がこれより長い場合は待たずに諦める
+    max_retry_after_s: float = float(os.getenv("LLM_RETRY_MAX_RETRY_AFTER", "20"))
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目の失敗後の待ち時間（full jitter）。"""
+        cap = min(self.max_delay_s, self.base_delay_s * (2 ** (attempt - 1)))
+        return random.uniform(0.0, cap)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    closed   : 通常運転
+    open     : 連続失敗が threshold を超えた。cooldown_s の間は即失敗
+    half_open: cooldown 明け。1 本だけ試しに通し、成功なら closed に戻す
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+        cooldown_s: float = float(os.getenv("LLM_BREAKER_COOLDOWN", "30")),
+    ) -> None:
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.cooldown_s = float(cooldown_s)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state_locked()
+
+    def _state_locked(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown_s:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state_locked()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.cooldown_s - (time.monotonic() - self._opened_at))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """成功とも失敗とも数えずに、half_open の試行枠だけ返す。"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._state_locked(),
+                "consecutive_failures": self._failures,
+            }
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(provider)
+        if breaker is None:
+            breaker = CircuitBreaker(provider)
+            _BREAKERS[provider] = breaker
+        return breaker
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    with _BREAKERS_LOCK:
+        breakers = dict(_BREAKERS)
+    return {name: b.snapshot() for name, b in breakers.items()}
+
+
+# ========= エラー分類 =========
+
+def _parse_retry_after(headers: Any) -> Optional[float]:
+    if headers is None:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            return float(ms) / 1000.0
+        value = headers.get("retry-after")
+    except Exception:  # noqa: BLE001
+        return None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # HTTP-date 形式
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except Exception:  # noqa: BLE001
+        return None
+
+
+def classify_error(e: BaseException) -> Dict[str, Any]:
+    """
+    例外を構造化した dict にする。
+      type / status / retryable / retry_after / message
+    """
+    if isinstance(e, ProviderCallError):
+        return dict(e.info)
+
+    status = getattr(e, "status_code", None)
+    response = getattr(e, "response", None)
+    retry_after = _parse_retry_after(getattr(response, "headers", None))
+    name = type(e).__name__
+
+    if status is not None:
+        retryable = status == 429 or status == 408 or status >= 500
+    else:
+        # APIConnectionError / APITimeoutError など、ステータスの無い通信系エラー
+        retryable = "Timeout" in name or "Connection" in name
+
+    return {
+        "type": name,
+        "status": status,
+        "retryable": retryable,
+        "retry_after": retry_after,
+        "message": str(e),
+    }
+
+
+def error_info(e: BaseException) -> Dict[str, Any]:
+    """meta に入れる用の構造化エラー情報。"""
+    return classify_error(e)
+
+
+# ========= 本体 =========
+
+def call_with_retry(
+    provider: str,
+    fn: Callable[[], T],
+    policy: Optional[RetryPolicy] = None,
+    deadline_s: Optional[float] = None,
+) -> T:
+    """
+    fn() をリトライ付きで呼ぶ。
+
+    - provider ごとのサーキットブレーカーが open なら即 CircuitOpenError
+    - リトライ可能なエラーはバックオフして再試行（Retry-After 優先）
+    - deadline_s（この呼び出し全体の秒数）を超えそうなら待たずに諦める
+    - 最終的に失敗したら ProviderCallError（info に attempts / circuit 状態込み）
+    """
+    policy = policy or DEFAULT_RETRY_POLICY
+    breaker = get_breaker(provider)
+    started = time.monotonic()
+
+    attempt = 0
+    while True:
+        attempt += 1
+        if not breaker.allow():
+            raise CircuitOpenError({
+                "type": "CircuitOpen",
+                "provider": provider,
+                "status": None,
+                "retryable": False,
+                "retry_after": round(breaker.retry_in(), 1),
+                "message": f"{provider} は一時停止中です（サーキットブレーカー open）",
+                "attempts": attempt - 1,
+                "circuit": "open",
+            })
+
+        try:
+            result = fn()
+        except Exception as e:  # noqa: BLE001
+            info = classify_error(e)
+            info["provider"] = provider
+            info["attempts"] = attempt
+
+            if info["retryable"]:
+                breaker.record_failure()
+            elif info.get("status") is not None:
+                # 4xx はプロバイダ自体は応答している＝停止ではない
+                breaker.record_success()
+            else:
+                # 手元の制限（送信待ちタイムアウトなど）はプロバイダの健康状態と無関係
+                breaker.release_probe()
+            info["circuit"] = breaker.state
+
+            if not info["retryable"] or attempt >= policy.max_attempts:
+                raise ProviderCallError(info) from e
+
+            delay = policy.backoff(attempt)
+            retry_after = info.get("retry_after")
+            if retry_after is not None:
+                if retry_after > policy.max_retry_after_s:
+                    raise ProviderCallError(info) from e
+                delay = max(delay, float(retry_after))
+
+            if deadline_s is not None and (time.monotonic() - started) + delay >= deadline_s:
+                raise ProviderCallError(info) from e
+
+            time.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
+
+
+__all__ = [
+    "ProviderCallError",
+    "CircuitOpenError",
+    "RetryPolicy",
+    "DEFAULT_RETRY_POLICY",
+    "CircuitBreaker",
+    "get_breaker",
+    "breaker_states",
+    "classify_error",
+    "error_info",
+    "call_with_retry",
+]
@@ -3,11 +3,27 @@
 
 from __future__ import annotations
 
+import contextvars
+import hashlib
 import os
-from typing import Any, Dict, List, Tuple
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import httpx
 from openai import OpenAI, BadRequestError
 
+from llm_cache import cache_stats, get_cache, make_cache_key  # noqa: F401  (cache_stats は再公開)
+from llm_resilience import (
+    ProviderCallError,
+    RetryPolicy,
+    call_with_retry,
+    error_info,
+)
+from llm_ratelimit import estimate_request_tokens, get_limiter
+
 # ========= 環境変数 =========
 
 # 会話本体（フローリア）のメインモデル
@@ -23,14 +39,301 @@ OPENROUTER_API_KEY_INITIAL = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
 HERMES_MODEL = os.getenv("OPENROUTER_HERMES_MODEL", "nousresearch/hermes-4-70b")
 
+# HTTP 接続プールの上限（クライアント 1 つあたり）
+HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "120"))
 
-# ========= 共通 OpenAI 呼び出しヘルパ =========
 
-def _ensure_openai_client() -> OpenAI:
+# ========= クライアント共有（接続プール） =========
+#
+# OpenAI(...) を呼ぶたびに新しい HTTP 接続プールが作られ、
+# 毎リクエストで TLS ハンドシェイクからやり直しになる。
+# ここでは (base_url, APIキー) ごとにクライアントを 1 つだけ作って使い回す。
+# モジュールレベルの dict なので、Streamlit の rerun やセッションをまたいで共有される。
+
+_CLIENTS: Dict[Tuple[str, str], OpenAI] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _key_fingerprint(api_key: str) -> str:
+    # キーそのものを dict のキーに残さないよう、ハッシュだけ持つ
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def get_client(api_key: str, base_url: Optional[str] = None) -> OpenAI:
+    """
+    (base_url, api_key) ごとに共有された OpenAI クライアントを返す。
+
+    - keep-alive 付きの接続プールを使い回す
+    - 同じ base_url でキーが変わったら（os.environ でのキーローテーション）、
+      古いクライアントは登録から外し、新しいキーで作り直す
+    """
+    registry_key = (base_url or "", _key_fingerprint(api_key))
+
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(registry_key)
+        if client is not None:
+            return client
+
+        # 古いキーのクライアントは登録から外すだけにする。
+        # 実行中のリクエストが使っている可能性があるので close はしない（GC 任せ）。
+        for k in [k for k in _CLIENTS if k[0] == registry_key[0]]:
+            _CLIENTS.pop(k, None)
+
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        # リトライは llm_resilience 側でまとめて行うので、SDK 内蔵のリトライは切る
+        kwargs: Dict[str, Any] = {
+            "api_key": api_key,
+            "http_client": http_client,
+            "max_retries": 0,
+        }
+        if base_url:
+            kwargs["base_url"] = base_url
+        client = OpenAI(**kwargs)
+        _CLIENTS[registry_key] = client
+        return client
+
+
+def get_openai_client() -> OpenAI:
+    """OpenAI 本家用の共有クライアント（キーは毎回 os.environ から読み直す）。"""
     api_key = os.getenv("OPENAI_API_KEY") or OPENAI_API_KEY_INITIAL
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY が設定されていません。")
-    return OpenAI(api_key=api_key)
+    return get_client(api_key)
+
+
+def get_openrouter_client() -> Optional[OpenAI]:
+    """OpenRouter 用の共有クライアント。キー未設定なら None。"""
+    api_key = os.getenv("OPENROUTER_API_KEY") or OPENROUTER_API_KEY_INITIAL
+    if not api_key:
+        return None
+    return get_client(api_key, base_url=OPENROUTER_BASE_URL)
+
+
+# ========= 共通 OpenAI 呼び出しヘルパ =========
+
+def _ensure_openai_client() -> OpenAI:
+    return get_openai_client()
+
+
+def _usage_to_dict(usage_obj: Any) -> Dict[str, Any]:
+    """
+    レスポンス（またはストリーム最終チャンク）の usage を dict にそろえる。
+    プロバイダ側プロンプトキャッシュに当たったトークン数は cached_tokens に入れる。
+    """
+    if usage_obj is None:
+        return {}
+    usage: Dict[str, Any] = {
+        "prompt_tokens": getattr(usage_obj, "prompt_tokens", None),
+        "completion_tokens": getattr(usage_obj, "completion_tokens", None),
+        "total_tokens": getattr(usage_obj, "total_tokens", None),
+    }
+    details = getattr(usage_obj, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is not None:
+        usage["cached_tokens"] = cached
+    return usage
+
+
+def _cache_lookup(
+    model: str,
+    base_url: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    use_cache: bool,
+    sampling: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, Optional[Tuple[str, Dict[str, Any]]]]:
+    """
+    キャッシュ対象の呼び出しならキーを作って引いてみる。
+    戻り値: (キー or "", ヒットした (text, usage) or None)
+    ヒット時の usage には cache_hit=True を付ける（課金されていない印）。
+    """
+    cache = get_cache()
+    if not use_cache or not cache.is_cacheable(temperature):
+        return "", None
+    key = make_cache_key(model, messages, temperature, max_tokens, base_url, sampling)
+    hit = cache.lookup(key)
+    if hit is None:
+        return key, None
+    text, usage = hit
+    return key, (text, dict(usage, cache_hit=True))
+
+
+def _lift_call_stats(meta: Dict[str, Any], usage: Dict[str, Any]) -> None:
+    """
+    usage に相乗りしてきた呼び出し統計を meta 側に移す。
+      - cache_hit      → meta["cache"] = "hit"（usage 側にも残す＝課金なしの印）
+      - queue_wait_ms  → meta["queue_wait_ms"]（レート制限の待ち時間）
+    """
+    if usage.get("cache_hit"):
+        meta["cache"] = "hit"
+    if "queue_wait_ms" in usage:
+        meta["queue_wait_ms"] = usage.pop("queue_wait_ms")
+
+
+def _limited(
+    provider: str,
+    messages: List[Dict[str, str]],
+    max_tokens: int,
+    waits: List[float],
+    fn: Any,
+) -> Any:
+    """
+    関所（llm_ratelimit）で枠を取ってから fn() を 1 回呼ぶ。
+    待ち時間は waits に積み、TPM は実際の usage で補正して返す。
+    """
+    lease = get_limiter(provider).acquire(estimate_request_tokens(messages, max_tokens))
+    waits.append(lease.queue_wait_ms)
+    resp = None
+    try:
+        resp = fn()
+        return resp
+    finally:
+        if resp is None:
+            # 失敗した呼び出しはトークンを消費していないので全額返す
+            lease.release({"total_tokens": 0})
+        else:
+            lease.release(_usage_to_dict(getattr(resp, "usage", None)))
+
+
+def create_chat_completion(
+    messages: List[Dict[str, Any]],
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    provider: str = "openai",
+    client: Optional[OpenAI] = None,
+    timeout: Optional[float] = None,
+    policy: Optional[RetryPolicy] = None,
+    **extra: Any,
+) -> Tuple[Any, float]:
+    """
+    生のレスポンスが欲しい呼び出し側（JudgeAI など）向けの低レベル API。
+    関所（レート制限）+ リトライ / サーキットブレーカー込みで 1 回叩く。
+    戻り値: (レスポンス, 送信待ち ms)
+    """
+    if client is None:
+        client = _ensure_openai_client()
+    kwargs: Dict[str, Any] = dict(extra)
+    if timeout is not None:
+        kwargs["timeout"] = float(timeout)
+
+    waits: List[float] = []
+    resp = call_with_retry(
+        provider,
+        lambda: _limited(
+            provider,
+            messages,
+            max_tokens,
+            waits,
+            lambda: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=float(temperature),
+                max_tokens=int(max_tokens),
+                **kwargs,
+            ),
+        ),
+        policy=policy,
+        deadline_s=timeout,
+    )
+    return resp, round(sum(waits), 1)
+
+
+def _stream_chat(
+    client: OpenAI,
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    usage_out: Dict[str, Any],
+    timeout: Optional[float] = None,
+    provider: str = "openai",
+    policy: Optional[RetryPolicy] = None,
+    **extra: Any,
+) -> Iterator[str]:
+    """
+    stream=True で叩き、テキストの差分（delta）を順に yield する。
+    usage は最後のチャンクで届くので、usage_out に詰めて返す。
+    途中で呼び出し側がループを抜けた場合もストリームは必ず閉じる。
+    リトライ対象はストリームを開くところまで（途中で切れた分は再送しない）。
+    """
+    kwargs: Dict[str, Any] = dict(extra)
+    if timeout is not None:
+        kwargs["timeout"] = float(timeout)
+
+    # ストリームは流しきるまで同時実行枠を持ち続ける
+    lease = get_limiter(provider).acquire(estimate_request_tokens(messages, max_tokens))
+    usage_out["queue_wait_ms"] = lease.queue_wait_ms
+    try:
+        stream = call_with_retry(
+            provider,
+            lambda: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=float(temperature),
+                max_tokens=int(max_tokens),
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs,
+            ),
+            policy=policy,
+            deadline_s=timeout,
+        )
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage_out.update(_usage_to_dict(chunk.usage))
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            stream.close()
+    finally:
+        lease.release(usage_out if "total_tokens" in usage_out else {"total_tokens": 0})
+
+
+def stream_chat_completion(
+    messages: List[Dict[str, Any]],
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    usage_out: Dict[str, Any],
+    provider: str = "openai",
+    client: Optional[OpenAI] = None,
+    timeout: Optional[float] = None,
+    policy: Optional[RetryPolicy] = None,
+    **extra: Any,
+) -> Iterator[str]:
+    """
+    create_chat_completion のストリーミング版（JudgeAI など向けの低レベル API）。
+    差分を yield する。途中でループを抜ければその時点で接続を閉じ、残りは生成させない。
+    usage / 送信待ち ms は usage_out に入る（途中で抜けた場合 usage は届かないことがある）。
+    """
+    if client is None:
+        client = _ensure_openai_client()
+    return _stream_chat(
+        client,
+        model,
+        messages,
+        temperature,
+        max_tokens,
+        usage_out,
+        timeout=timeout,
+        provider=provider,
+        policy=policy,
+        **extra,
+    )
 
 
 def _call_openai_model(
@@ -38,24 +341,42 @@ def _call_openai_model(
     messages: List[Dict[str, str]],
     temperature: float,
     max_tokens: int,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    client: Optional[OpenAI] = None,
+    provider: str = "openai",
+    base_url: str = "",
+    policy: Optional[RetryPolicy] = None,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
-    client = _ensure_openai_client()
-
-    resp = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=float(temperature),
-        max_tokens=int(max_tokens),
+    """
+    非ストリーミングの 1 回呼び出し（キャッシュ → リトライ付き本番呼び出し）。
+    client を省略すると OpenAI 本家の共有クライアントを使う。
+    sampling は top_p / presence_penalty / frequency_penalty などの追加指定。
+    """
+    cache_key, cached = _cache_lookup(
+        model, base_url, messages, temperature, max_tokens, use_cache, sampling
+    )
+    if cached is not None:
+        return cached
+
+    resp, queue_wait_ms = create_chat_completion(
+        messages,
+        model,
+        temperature,
+        max_tokens,
+        provider=provider,
+        client=client,
+        timeout=timeout,
+        policy=policy,
+        **(sampling or {}),
     )
 
     text = resp.choices[0].message.content or ""
-    usage: Dict[str, Any] = {}
-    if getattr(resp, "usage", None) is not None:
-        usage = {
-            "prompt_tokens": getattr(resp.usage, "prompt_tokens", None),
-            "completion_tokens": getattr(resp.usage, "completion_tokens", None),
-            "total_tokens": getattr(resp.usage, "total_tokens", None),
-        }
+    usage = _usage_to_dict(getattr(resp, "usage", None))
+    if cache_key:
+        get_cache().store(cache_key, text, usage)
+    usage["queue_wait_ms"] = queue_wait_ms
     return text, usage
 
 
@@ -65,8 +386,13 @@ def _call_gpt(
     messages: List[Dict[str, str]],
     temperature: float,
     max_tokens: int,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
-    return _call_openai_model(MAIN_MODEL, messages, temperature, max_tokens)
+    return _call_openai_model(
+        MAIN_MODEL, messages, temperature, max_tokens, timeout, use_cache, sampling=sampling
+    )
 
 
 # ========= Judge 用モデル（GPT-5.1 想定） =========
@@ -75,12 +401,17 @@ def _call_judge_model(
     messages: List[Dict[str, str]],
     temperature: float,
     max_tokens: int,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     """
     審判用モデル呼び出し。
     実際に使うモデル名は環境変数 OPENAI_JUDGE_MODEL で差し替え可能。
     """
-    return _call_openai_model(JUDGE_MODEL, messages, temperature, max_tokens)
+    return _call_openai_model(
+        JUDGE_MODEL, messages, temperature, max_tokens, timeout, use_cache, sampling=sampling
+    )
 
 
 # ========= OpenRouter / Hermes =========
@@ -89,44 +420,309 @@ def _call_hermes(
     messages: List[Dict[str, str]],
     temperature: float,
     max_tokens: int,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
-    api_key = os.getenv("OPENROUTER_API_KEY") or OPENROUTER_API_KEY_INITIAL
-    if not api_key:
+    client_or = get_openrouter_client()
+    if client_or is None:
         # キーが無いなら即ダミー返し
         return "[Hermes: OPENROUTER_API_KEY 未設定]", {
             "error": "OPENROUTER_API_KEY not set",
         }
 
-    client_or = OpenAI(
-        base_url=OPENROUTER_BASE_URL,
-        api_key=api_key,
-    )
     try:
-        resp = client_or.chat.completions.create(
-            model=HERMES_MODEL,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
+        return _call_openai_model(
+            HERMES_MODEL,
+            messages,
+            temperature,
+            max_tokens,
+            timeout,
+            use_cache,
+            client=client_or,
+            provider="openrouter",
+            base_url=OPENROUTER_BASE_URL,
+            sampling=sampling,
         )
-    except BadRequestError as e:
-        # 400 系はここでテキスト化して返す
-        return f"[Hermes BadRequestError: {e}]", {
-            "error": str(e),
-        }
-    except Exception as e:  # noqa: BLE001
+    except ProviderCallError as e:
+        if isinstance(e.__cause__, BadRequestError):
+            # 400 系はここでテキスト化して返す
+            return f"[Hermes BadRequestError: {e.__cause__}]", {
+                "error": str(e.__cause__),
+                "error_info": e.info,
+            }
+        # エラー文言はキャッシュされない（_call_openai_model まで届かないため）
         return f"[Hermes Error: {e}]", {
             "error": str(e),
+            "error_info": e.info,
         }
 
-    text = resp.choices[0].message.content or ""
-    usage: Dict[str, Any] = {}
-    if getattr(resp, "usage", None) is not None:
-        usage = {
-            "prompt_tokens": getattr(resp.usage, "prompt_tokens", None),
-            "completion_tokens": getattr(resp.usage, "completion_tokens", None),
-            "total_tokens": getattr(resp.usage, "total_tokens", None),
+
+# ========= ルーティング（フォールバック / ヘッジ） =========
+#
+# 物語本体の呼び出しは「ルート」の順番付きリストで表す。
+#   ・先頭ルートが失敗したら次のルートへフォールバック
+#   ・hedge_after_ms を指定すると、先頭ルートが N ms 以内に最初のトークンを
+#     返さなかった場合だけ次のルートも並行して投げ、先に終わった方を採用する
+#     （負けた方はストリームを閉じて打ち切るので、コストが毎回 2 倍にはならない）
+
+@dataclass
+class RouteSpec:
+    name: str            # meta["route"] に入る名前（"gpt" / "hermes"）
+    provider: str        # サーキットブレーカー単位（"openai" / "openrouter"）
+    model: str
+    timeout_s: float = 60.0   # このルートの持ち時間
+    max_attempts: int = 2     # このルート内でのリトライ上限
+
+    def retry_policy(self) -> RetryPolicy:
+        return RetryPolicy(max_attempts=self.max_attempts)
+
+
+@dataclass
+class RoutingPolicy:
+    routes: List[RouteSpec] = field(default_factory=list)
+    hedge_after_ms: Optional[int] = None
+
+
+def _route_from_name(name: str) -> Optional[RouteSpec]:
+    name = name.strip().lower()
+    if name == "gpt":
+        return RouteSpec(
+            name="gpt",
+            provider="openai",
+            model=MAIN_MODEL,
+            timeout_s=float(os.getenv("LLM_ROUTE_TIMEOUT_GPT", "60")),
+            max_attempts=int(os.getenv("LLM_ROUTE_ATTEMPTS_GPT", "2")),
+        )
+    if name == "hermes":
+        return RouteSpec(
+            name="hermes",
+            provider="openrouter",
+            model=HERMES_MODEL,
+            timeout_s=float(os.getenv("LLM_ROUTE_TIMEOUT_HERMES", "60")),
+            max_attempts=int(os.getenv("LLM_ROUTE_ATTEMPTS_HERMES", "2")),
+        )
+    return None
+
+
+def default_routing_policy() -> RoutingPolicy:
+    """
+    環境変数からルーティングポリシーを組み立てる。
+      LLM_FALLBACK_ROUTES : "gpt,hermes" のような順番付きリスト
+      LLM_HEDGE_AFTER_MS  : 指定時のみヘッジ有効
+    """
+    names = os.getenv("LLM_FALLBACK_ROUTES", "gpt,hermes").split(",")
+    routes = [r for r in (_route_from_name(n) for n in names) if r is not None]
+    hedge = os.getenv("LLM_HEDGE_AFTER_MS")
+    return RoutingPolicy(
+        routes=routes,
+        hedge_after_ms=int(hedge) if hedge else None,
+    )
+
+
+def _client_for_route(route: RouteSpec) -> Tuple[OpenAI, str]:
+    """ルートに対応する共有クライアントと base_url を返す。"""
+    if route.provider == "openrouter":
+        client = get_openrouter_client()
+        if client is None:
+            raise ProviderCallError({
+                "type": "MissingKey",
+                "provider": route.provider,
+                "status": None,
+                "retryable": False,
+                "retry_after": None,
+                "message": "OPENROUTER_API_KEY not set",
+            })
+        return client, OPENROUTER_BASE_URL
+    return _ensure_openai_client(), ""
+
+
+_END = object()
+
+
+class _RouteRun:
+    """
+    1 ルート分のストリーミング実行（ワーカースレッドで回す）。
+    差分は self.deltas に積み、「最初のトークン」「終了」を events に通知する。
+    cancel が立ったら次のチャンクでストリームを閉じて抜ける。
+    """
+
+    def __init__(
+        self,
+        route: RouteSpec,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        events: "queue.Queue[Tuple[_RouteRun, str]]",
+        sampling: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.route = route
+        self.messages = messages
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.sampling = dict(sampling or {})
+        self.events = events
+        self.deltas: "queue.Queue[Any]" = queue.Queue()
+        self.cancel = threading.Event()
+        self.parts: List[str] = []
+        self.usage: Dict[str, Any] = {}
+        self.error: Optional[BaseException] = None
+        self.started = time.perf_counter()
+        # 持ち時間はルートごとに、走らせ始めた時刻から数える
+        self.deadline = self.started + route.timeout_s
+        self.ttft_ms: Optional[float] = None
+        self.elapsed_ms: Optional[float] = None
+
+    def start(self) -> "_RouteRun":
+        # セッション ID（レート制限の公平性用）を子スレッドに引き継ぐ
+        ctx = contextvars.copy_context()
+        threading.Thread(
+            target=ctx.run,
+            args=(self._run,),
+            name=f"lyra-route-{self.route.name}",
+            daemon=True,
+        ).start()
+        return self
+
+    def _run(self) -> None:
+        try:
+            client, _base_url = _client_for_route(self.route)
+            for delta in _stream_chat(
+                client,
+                self.route.model,
+                self.messages,
+                self.temperature,
+                self.max_tokens,
+                self.usage,
+                timeout=self.route.timeout_s,
+                provider=self.route.provider,
+                policy=self.route.retry_policy(),
+                **self.sampling,
+            ):
+                if self.cancel.is_set():
+                    break
+                if self.ttft_ms is None:
+                    self.ttft_ms = (time.perf_counter() - self.started) * 1000.0
+                    self.events.put((self, "first"))
+                self.parts.append(delta)
+                self.deltas.put(delta)
+        except Exception as e:  # noqa: BLE001
+            self.error = e
+        finally:
+            self.elapsed_ms = (time.perf_counter() - self.started) * 1000.0
+            self.deltas.put(_END)
+            self.events.put((self, "done"))
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def trace(self, status: str) -> Dict[str, Any]:
+        item: Dict[str, Any] = {
+            "route": self.route.name,
+            "model": self.route.model,
+            "status": status,
         }
-    return text, usage
+        if self.ttft_ms is not None:
+            item["ttft_ms"] = round(self.ttft_ms, 1)
+        if self.elapsed_ms is not None:
+            item["elapsed_ms"] = round(self.elapsed_ms, 1)
+        if self.error is not None:
+            item["error"] = error_info(self.error)
+        return item
+
+
+def _race_routes(
+    policy: RoutingPolicy,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    commit_on_first_token: bool,
+    meta: Dict[str, Any],
+    sampling: Optional[Dict[str, Any]] = None,
+) -> Optional[_RouteRun]:
+    """
+    ルートを順に（必要ならヘッジして）走らせ、採用するルートを返す。
+
+    commit_on_first_token=True（ストリーミング表示用）:
+        最初にトークンを出したルートに確定する（途中で乗り換えると表示が壊れるため）
+    commit_on_first_token=False（非ストリーミング）:
+        最初に「正常終了」したルートを採用する
+
+    全ルート失敗なら None。meta["route_trace"] / meta["hedged"] を埋める。
+    """
+    events: "queue.Queue[Tuple[_RouteRun, str]]" = queue.Queue()
+    pending = list(policy.routes)
+    active: List[_RouteRun] = []
+    trace: List[Dict[str, Any]] = []
+    hedged = False
+    got_first = False
+
+    def launch() -> None:
+        route = pending.pop(0)
+        active.append(
+            _RouteRun(route, messages, temperature, max_tokens, events, sampling).start()
+        )
+
+    if not pending:
+        meta["route_trace"] = trace
+        return None
+    launch()
+    hedge_at: Optional[float] = None
+    if policy.hedge_after_ms is not None:
+        hedge_at = time.perf_counter() + policy.hedge_after_ms / 1000.0
+
+    winner: Optional[_RouteRun] = None
+    while active:
+        can_hedge = hedge_at is not None and not got_first and not hedged and pending
+        now = time.perf_counter()
+        wake_at = min(r.deadline for r in active)
+        if can_hedge:
+            wake_at = min(wake_at, hedge_at)
+        try:
+            run, kind = events.get(timeout=max(0.0, wake_at - now))
+        except queue.Empty:
+            now = time.perf_counter()
+            # 持ち時間を使い切ったルートだけ打ち切る（他のルートはそれぞれの期限まで待つ）
+            for r in [r for r in active if r.deadline <= now]:
+                r.cancel.set()
+                trace.append(dict(r.trace("timeout")))
+                active.remove(r)
+            if can_hedge and hedge_at <= now and active:
+                # 先頭ルートが遅い → 次のルートも並行で投げる
+                hedged = True
+                launch()
+            continue
+
+        if run not in active:
+            continue
+
+        if kind == "first":
+            got_first = True
+            if commit_on_first_token:
+                winner = run
+                break
+            continue
+
+        # kind == "done"
+        active.remove(run)
+        if run.error is None and not run.cancel.is_set():
+            winner = run
+            break
+        trace.append(run.trace("error"))
+        if not active and pending:
+            # フォールバック：次のルートへ
+            launch()
+
+    if winner is not None:
+        for r in active:
+            if r is not winner:
+                r.cancel.set()
+                trace.append(r.trace("cancelled"))
+
+    meta["route_trace"] = trace
+    meta["hedged"] = hedged
+    return winner
 
 
 # ========= 公開 API =========
@@ -135,38 +731,188 @@ def call_with_fallback(
     messages: List[Dict[str, str]],
     temperature: float = 0.7,
     max_tokens: int = 800,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    policy: Optional[RoutingPolicy] = None,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     """
-    以前は GPT → Hermes フォールバックだったが、
-    今は GPT-4o 単体のみをメインとして返す。
+    物語本体の呼び出し。RoutingPolicy の順に GPT → Hermes とフォールバックする。
+    policy.hedge_after_ms があれば、遅いターンだけ次のルートも並行で投げる。
+
+    - 採用されたルートは meta["route"]（"gpt" / "hermes"）に入る
+    - 途中経過は meta["route_trace"] に残る
+    - 全ルート失敗時は ("", meta) で、meta["route"] = "error"
+    - timeout はルートごとの持ち時間の上限として効く
+    - use_cache=False でその呼び出しだけ応答キャッシュを使わない
+    - sampling で top_p などの追加サンプリング指定を全ルートに渡す
     """
+    policy = policy or default_routing_policy()
+    if timeout is not None:
+        policy = RoutingPolicy(
+            routes=[
+                RouteSpec(r.name, r.provider, r.model, min(r.timeout_s, float(timeout)), r.max_attempts)
+                for r in policy.routes
+            ],
+            hedge_after_ms=policy.hedge_after_ms,
+        )
     meta: Dict[str, Any] = {}
-    try:
-        text, usage = _call_gpt(messages, temperature, max_tokens)
-        meta["route"] = "gpt"
-        meta["model_main"] = MAIN_MODEL
+
+    if policy.hedge_after_ms is not None:
+        run = _race_routes(policy, messages, temperature, max_tokens, False, meta, sampling)
+        if run is not None:
+            meta["route"] = run.route.name
+            meta["model_main"] = run.route.model
+            meta["usage_main"] = dict(run.usage)
+            _lift_call_stats(meta, meta["usage_main"])
+            meta["route_trace"].append(run.trace("won"))
+            return run.text, meta
+        return "", _route_failure_meta(meta)
+
+    # ヘッジなし：順番に試す（キャッシュも効く非ストリーミング経路）
+    trace: List[Dict[str, Any]] = []
+    for route in policy.routes:
+        started = time.perf_counter()
+        try:
+            client, base_url = _client_for_route(route)
+            text, usage = _call_openai_model(
+                route.model,
+                messages,
+                temperature,
+                max_tokens,
+                route.timeout_s,
+                use_cache,
+                client=client,
+                provider=route.provider,
+                base_url=base_url,
+                policy=route.retry_policy(),
+                sampling=sampling,
+            )
+        except Exception as e:  # noqa: BLE001
+            trace.append({
+                "route": route.name,
+                "model": route.model,
+                "status": "error",
+                "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+                "error": error_info(e),
+            })
+            continue
+
+        trace.append({
+            "route": route.name,
+            "model": route.model,
+            "status": "won",
+            "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+        })
+        meta["route"] = route.name
+        meta["model_main"] = route.model
         meta["usage_main"] = usage
+        meta["route_trace"] = trace
+        _lift_call_stats(meta, usage)
         return text, meta
-    except Exception as e:  # noqa: BLE001
-        meta["route"] = "error"
-        meta["gpt_error"] = str(e)
-        return "", meta
+
+    meta["route_trace"] = trace
+    return "", _route_failure_meta(meta)
+
+
+def _route_failure_meta(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """全ルート失敗時の meta をそろえる（最後のエラーを代表として載せる）。"""
+    meta["route"] = "error"
+    errors = [t["error"] for t in meta.get("route_trace", []) if "error" in t]
+    if errors:
+        meta["error"] = errors[-1]
+        meta["gpt_error"] = str(errors[-1].get("message", ""))
+    else:
+        meta["error"] = {"type": "NoRoute", "message": "利用可能なルートがありません"}
+        meta["gpt_error"] = meta["error"]["message"]
+    return meta
+
+
+def stream_with_fallback(
+    messages: List[Dict[str, str]],
+    temperature: float = 0.7,
+    max_tokens: int = 800,
+    timeout: Optional[float] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    policy: Optional[RoutingPolicy] = None,
+    sampling: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    call_with_fallback のストリーミング版。
+    テキストの差分を順に yield し、終わった時点で meta に
+    route / model_main / usage_main / ttft_ms（最初のトークンまでの ms）/ route_trace を詰める。
+
+    フォールバック・ヘッジは「最初のトークンを出したルートに確定」する方式
+    （表示し始めた後でルートを乗り換えることはしない）。
+
+    例:
+        meta = {}
+        for delta in stream_with_fallback(messages, meta=meta):
+            ...
+        usage = meta["usage_main"]
+    """
+    if meta is None:
+        meta = {}
+    policy = policy or default_routing_policy()
+    if timeout is not None:
+        policy = RoutingPolicy(
+            routes=[
+                RouteSpec(r.name, r.provider, r.model, min(r.timeout_s, float(timeout)), r.max_attempts)
+                for r in policy.routes
+            ],
+            hedge_after_ms=policy.hedge_after_ms,
+        )
+
+    run = _race_routes(policy, messages, temperature, max_tokens, True, meta, sampling)
+    if run is None:
+        _route_failure_meta(meta)
+        return
+
+    try:
+        while True:
+            delta = run.deltas.get()
+            if delta is _END:
+                break
+            yield delta
+    finally:
+        # 呼び出し側がループを途中で抜けた場合もストリームを止める
+        run.cancel.set()
+
+    if run.error is not None:
+        # 表示途中で切れた：ここまでの本文は活かし、エラーだけ残す
+        meta["route_trace"].append(run.trace("error"))
+        meta["error"] = error_info(run.error)
+        meta["gpt_error"] = str(run.error)
+    else:
+        meta["route_trace"].append(run.trace("won"))
+    meta["route"] = run.route.name
+    meta["model_main"] = run.route.model
+    meta["usage_main"] = dict(run.usage)
+    _lift_call_stats(meta, meta["usage_main"])
+    if run.ttft_ms is not None:
+        meta["ttft_ms"] = round(run.ttft_ms, 1)
 
 
 def call_hermes(
     messages: List[Dict[str, str]],
     temperature: float = 0.7,
     max_tokens: int = 800,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     """
     Hermes 単体呼び出し。
     """
-    text, usage = _call_hermes(messages, temperature, max_tokens)
+    text, usage = _call_hermes(messages, temperature, max_tokens, timeout, use_cache, sampling)
     meta: Dict[str, Any] = {
         "route": "openrouter",
         "model_main": HERMES_MODEL,
         "usage_main": usage,
     }
+    if "error_info" in usage:
+        meta["error"] = usage.pop("error_info")
+    _lift_call_stats(meta, usage)
     return text, meta
 
 
@@ -174,16 +920,43 @@ def call_judge_model(
     messages: List[Dict[str, str]],
     temperature: float = 0.7,
     max_tokens: int = 800,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    sampling: Optional[Dict[str, Any]] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     """
     Judge 用モデル（GPT-5.1 想定）呼び出し。
     - Multi AI の 3つ目の候補としても利用可能
     - JudgeAI 内部から審判用としても利用
     """
-    text, usage = _call_judge_model(messages, temperature, max_tokens)
+    text, usage = _call_judge_model(messages, temperature, max_tokens, timeout, use_cache, sampling)
     meta: Dict[str, Any] = {
         "route": "gpt-judge",
         "model_main": JUDGE_MODEL,
         "usage_main": usage,
     }
+    _lift_call_stats(meta, usage)
+    return text, meta
+
+
+def call_gpt5_candidate(
+    messages: List[Dict[str, str]],
+    temperature: float = 0.7,
+    max_tokens: int = 800,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    sampling: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    GPT-5.1（3人目の候補フローリア）呼び出し。
+    実体は Judge 用モデルと同じだが、route を分けて裏画面で区別できるようにする。
+    例外は握りつぶさず呼び出し側（conversation_engine）で扱う。
+    """
+    text, usage = _call_judge_model(messages, temperature, max_tokens, timeout, use_cache, sampling)
+    meta: Dict[str, Any] = {
+        "route": "gpt5-candidate",
+        "model_main": JUDGE_MODEL,
+        "usage_main": usage,
+    }
+    _lift_call_stats(meta, usage)
     return text, meta
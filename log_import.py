@@ -0,0 +1,158 @@
+# log_import.py — 保存した会話ログ（JSON 配列 / JSONL）の読み込み
+#
+# "会話ログの読み込み" は、ファイルが選ばれている間 rerun のたびに json.load で全体を読み直し、
+# all(...) で全要素を検査してからリストをつなぎ直していた。数 MB のログだと画面が固まる。
+#
+#   ・log_stream.iter_json_records で 1 件ずつ読み、その場で role / content を検査する
+#   ・保持するのは先頭の system と、末尾 max_len 件だけ（それより古い発言は件数だけ数える）
+#   ・結果はファイルの sha256 ごとにキャッシュし、同じファイルなら rerun で読み直さない
+#
+# 発言は (role, content) のまま持ち、ChatMessage には読み込むときに作る
+# （同じファイルを 2 回追記しても、発言 ID が重ならないように）。
+
+from __future__ import annotations
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Deque, Dict, Iterator, List, Optional, Tuple
+
+from log_stream import LogFormatError, iter_json_records
+from message_store import ChatMessage
+
+VALID_ROLES = ("system", "user", "assistant")
+PREVIEW_SIZE = 5
+_HASH_CHUNK = 1024 * 1024
+
+
+class LogImportError(ValueError):
+    """会話ログとして読めない（JSON が壊れている / messages の形式でない）。"""
+
+
+@dataclass(frozen=True)
+class ImportedLog:
+    digest: str
+    # 先頭が system ならそれ 1 件（無ければ空）
+    head: Tuple[Tuple[str, str], ...]
+    # それ以降の発言のうち、末尾 max_len 件
+    tail: Tuple[Tuple[str, str], ...]
+    # ファイル内の発言の総数
+    total: int
+    preview: Tuple[Dict[str, str], ...]
+
+    @property
+    def dropped(self) -> int:
+        """保持上限を超えたため読み込まない、古い発言の件数。"""
+        return self.total - len(self.head) - len(self.tail)
+
+    def head_messages(self) -> Iterator[ChatMessage]:
+        for role, content in self.head:
+            yield ChatMessage(role, content)
+
+    def tail_messages(self) -> Iterator[ChatMessage]:
+        for role, content in self.tail:
+            yield ChatMessage(role, content)
+
+
+def file_digest(fp: BinaryIO) -> str:
+    """ファイル全体の sha256（読み終えたら先頭に戻す）。"""
+    h = hashlib.sha256()
+    fp.seek(0)
+    for chunk in iter(lambda: fp.read(_HASH_CHUNK), b""):
+        h.update(chunk)
+    fp.seek(0)
+    return h.hexdigest()
+
+
+def _validate(record: Any, index: int) -> Tuple[str, str]:
+    if not isinstance(record, dict) or "role" not in record or "content" not in record:
+        raise LogImportError(
+            f"{index} 件目が不正です。messages の配列（各要素に role と content）が必要です。"
+        )
+    role = record["role"]
+    if role not in VALID_ROLES:
+        raise LogImportError(f"{index} 件目の role が不正です：{role!r}（{' / '.join(VALID_ROLES)} のみ）")
+    content = record["content"]
+    if not isinstance(content, str):
+        raise LogImportError(f"{index} 件目の content が文字列ではありません。")
+    return role, content
+
+
+def parse_chat_log(fp: BinaryIO, max_len: Optional[int] = None, digest: str = "") -> ImportedLog:
+    """
+    fp（バイナリ）を 1 件ずつ読み、検査しながら ImportedLog にまとめる。
+    max_len を超える古い発言は持たない。
+    """
+    head: List[Tuple[str, str]] = []
+    tail: Deque[Tuple[str, str]] = deque(maxlen=max_len)
+    preview: List[Dict[str, str]] = []
+    total = 0
+
+    fp.seek(0)
+    text = io.TextIOWrapper(fp, encoding="utf-8-sig")
+    try:
+        for record in iter_json_records(text):
+            total += 1
+            role, content = _validate(record, total)
+            if len(preview) < PREVIEW_SIZE:
+                preview.append({"role": role, "content": content})
+            if total == 1 and role == "system":
+                head.append((role, content))
+            else:
+                tail.append((role, content))
+    except LogFormatError as e:
+        raise LogImportError(str(e)) from None
+    except UnicodeDecodeError:
+        raise LogImportError("UTF-8 のテキストとして読めません。") from None
+    finally:
+        # TextIOWrapper が捨てられるときに元のファイルまで閉じないよう切り離す
+        text.detach()
+    fp.seek(0)
+
+    return ImportedLog(
+        digest=digest,
+        head=tuple(head),
+        tail=tuple(tail),
+        total=total,
+        preview=tuple(preview),
+    )
+
+
+# ========= ファイルの sha256 ごとのキャッシュ =========
+
+_CACHE: "OrderedDict[Tuple[str, Optional[int]], ImportedLog]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+_CACHE_MAX_ENTRIES = 4
+
+
+def import_chat_log(fp: BinaryIO, max_len: Optional[int] = None) -> ImportedLog:
+    """
+    アップロードされたログを読む。同じ内容のファイルは 2 回目以降キャッシュから返す
+    （壊れたファイルはキャッシュしないので、毎回 LogImportError になる）。
+    """
+    key = (file_digest(fp), max_len)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+        if cached is not None:
+            _CACHE.move_to_end(key)
+            return cached
+
+    imported = parse_chat_log(fp, max_len=max_len, digest=key[0])
+
+    with _CACHE_LOCK:
+        _CACHE[key] = imported
+        while len(_CACHE) > _CACHE_MAX_ENTRIES:
+            _CACHE.popitem(last=False)
+    return imported
+
+
+__all__ = [
+    "VALID_ROLES",
+    "LogImportError",
+    "ImportedLog",
+    "file_digest",
+    "parse_chat_log",
+    "import_chat_log",
+]
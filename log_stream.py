@@ -0,0 +1,139 @@
+# log_stream.py — 書き出した会話ログ（JSON / JSONL）を 1 件ずつ読むためのストリーミングパーサ
+#
+# ログは何千ターンにもなるので、json.load で丸ごと読むとメモリも待ち時間も膨らむ。
+# ここでは一定サイズずつ読み進めながら json.JSONDecoder.raw_decode で 1 件ずつ取り出す。
+#
+#   ・JSONL（1 行 1 オブジェクト）/ オブジェクトを並べただけのファイル → 各オブジェクト
+#   ・JSON 配列（"JSON をダウンロード" の形式）               → 配列の各要素
+#   ・オブジェクト 1 個だけのファイル（デバッグ画面の llm_meta など） → その 1 件
+#
+# バッファに持つのは「読みかけの 1 件 + 1 チャンク」だけ。
+# 配列の区切り（カンマの抜け・重複・末尾のカンマ、閉じた後ろの余分なデータ）も読みながら確かめる。
+
+from __future__ import annotations
+
+import io
+import json
+from typing import Any, BinaryIO, Iterator, TextIO, Union
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+CHUNK_CHARS = 64 * 1024
+
+
+class LogFormatError(ValueError):
+    """JSON / JSONL として読めない箇所があった。offset は読み始めからの文字位置。"""
+
+    def __init__(self, message: str, offset: int) -> None:
+        super().__init__(f"{message}（{offset} 文字目付近）")
+        self.offset = offset
+
+
+def _as_text(source: Union[str, TextIO, BinaryIO]) -> TextIO:
+    if isinstance(source, str):
+        return open(source, "r", encoding="utf-8-sig")
+    if isinstance(source, io.TextIOBase):
+        return source
+    # バイナリ（Streamlit の UploadedFile など）は UTF-8 として読む
+    return io.TextIOWrapper(source, encoding="utf-8-sig")
+
+
+def iter_json_records(
+    source: Union[str, TextIO, BinaryIO],
+    chunk_chars: int = CHUNK_CHARS,
+) -> Iterator[Any]:
+    """
+    source（パス / テキスト / バイナリのファイルオブジェクト）から JSON 値を 1 件ずつ返す。
+    トップレベルが配列なら要素を、そうでなければ並んでいる値を順に返す。
+    壊れた箇所があれば、それまでの分を返したあと LogFormatError を投げる。
+    """
+    fp = _as_text(source)
+    owns = isinstance(source, str)
+    try:
+        buf = ""
+        pos = 0       # buf の読み位置（1 件ごとに切り詰めず、読み足すときだけ詰める）
+        consumed = 0  # buf より前に読み捨てた文字数（エラー位置の表示用）
+        eof = False
+        in_array: Any = None  # None: 未判定 / True: 配列の中 / False: 値の並び
+        # 配列の中での区切りの状態（[1,,2] / [1 2] / [,1] / [1,] を弾く）
+        need_comma = False    # 直前に要素を読んだ（次はカンマか ]）
+        after_comma = False   # 直前にカンマを読んだ（次は要素）
+
+        def fill() -> bool:
+            nonlocal buf, pos, consumed, eof
+            if eof:
+                return False
+            chunk = fp.read(chunk_chars)
+            if not chunk:
+                eof = True
+                return False
+            consumed += pos
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        while True:
+            # 区切り（空白・配列内のカンマ）を読み飛ばす
+            while True:
+                while pos < len(buf) and buf[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buf) and in_array and buf[pos] == ",":
+                    if not need_comma:
+                        raise LogFormatError("配列のカンマの位置が不正です", consumed + pos)
+                    need_comma = False
+                    after_comma = True
+                    pos += 1
+                    continue
+                if pos < len(buf) or not fill():
+                    break
+
+            if pos >= len(buf):
+                if in_array:
+                    raise LogFormatError("配列が閉じていません", consumed + pos)
+                return
+
+            if in_array is None:
+                in_array = buf[pos] == "["
+                if in_array:
+                    pos += 1
+                    continue
+            elif in_array and buf[pos] == "]":
+                if after_comma:
+                    raise LogFormatError("配列の末尾にカンマがあります", consumed + pos)
+                # 配列を閉じた後ろは空白だけ
+                pos += 1
+                while True:
+                    while pos < len(buf) and buf[pos] in _WHITESPACE:
+                        pos += 1
+                    if pos < len(buf):
+                        raise LogFormatError("配列の後ろに余分なデータがあります", consumed + pos)
+                    if not fill():
+                        return
+            elif in_array and need_comma:
+                raise LogFormatError("配列の要素の間にカンマがありません", consumed + pos)
+
+            # 数値などの裸の値はチャンク境界で切れていても読めてしまうので、区切りまで読み足す
+            if buf[pos] not in "{[\"":
+                while not any(c in buf[pos:] for c in ",]" + _WHITESPACE) and fill():
+                    pass
+
+            # 1 件デコード。途中で切れていたら読み足して再試行する
+            while True:
+                try:
+                    value, end = _DECODER.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    if fill():
+                        continue
+                    raise LogFormatError(f"JSON として読めません: {e.msg}", consumed + e.pos) from None
+                break
+
+            pos = end
+            need_comma = bool(in_array)
+            after_comma = False
+            yield value
+    finally:
+        if owns:
+            fp.close()
+
+
+__all__ = ["LogFormatError", "iter_json_records", "CHUNK_CHARS"]
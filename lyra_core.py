@@ -5,50 +5,83 @@
 #   ・ユーザー発言を履歴に追加
 #   ・LLMConversation に投げて応答と meta をもらう
 #   ・アシスタント発言を履歴に追加して返す
+#   ・履歴が長くなったら、古いターンのあらすじ化を裏で走らせる
+#   ・候補が出そろったら、Judge（審議）を裏で走らせる（結果は turn_id で引ける）
+#   ・表にはすぐ出せる候補を先に出し、審議で別の候補が勝ったら後から差し替える
+#   ・どのモデルに投げるかは、過去の勝率・レイテンシ・コストから ModelSelector が選ぶ
+#   ・勝ち目の薄い遅いモデルは、良い候補が先に届いていれば待たない（EarlyExit）
 #
 #   ★ マルチAIまわりの構造は全部 LLMConversation 側に任せる。
-#     ここでは llm_meta を一切ラップしない。
+#     ここでは llm_meta を一切ラップしない（judge / composer / summary を足すだけ）。
 
 from __future__ import annotations
 
-from typing import Any, Dict, List, Tuple
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from conversation_engine import LLMConversation
+from conversation_engine import PRIMARY_KEY, LLMConversation
+from conversation_summarizer import ConversationSummarizer
+from deliberation.composer_ai import ComposerAI
+from deliberation.early_exit import EARLY_EXIT, EarlyExit
+from deliberation.judge_jobs import JudgeJobManager, get_judge_jobs
+from deliberation.model_selector import ModelSelector
+from deliberation.pre_judge import PreJudge
+from message_store import ChatMessage, MessageStore, ensure_store
+
+# 次のターンへ進んだ時点で審議が終わっていなかったターンの llm_meta（state のキー）
+LATE_JUDGING_KEY = "_late_judging"
 
 
 class LyraCore:
-    def __init__(self, conversation: LLMConversation) -> None:
+    def __init__(
+        self,
+        conversation: LLMConversation,
+        summarizer: Optional[ConversationSummarizer] = None,
+        judge_jobs: Optional[JudgeJobManager] = None,
+        pre_judge: Optional[PreJudge] = None,
+        composer: Optional[ComposerAI] = None,
+        selector: Optional[ModelSelector] = None,
+        early_exit: bool = EARLY_EXIT,
+    ) -> None:
         self.conversation = conversation
+        self.summarizer = summarizer or ConversationSummarizer()
+        self.judge_jobs = judge_jobs or get_judge_jobs()
+        self.pre_judge = pre_judge or PreJudge()
+        self.composer = composer or ComposerAI(mode="speculative")
+        self.selector = selector or ModelSelector()
+        self.early_exit = bool(early_exit)
+        persona = getattr(getattr(conversation, "collector", None), "persona", None)
+        # 統計はペルソナごとに分ける
+        self.persona_id = str(getattr(persona, "char_id", "") or "default")
 
     def proceed_turn(
         self,
         user_text: str,
         state: Dict[str, Any],
-    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[MessageStore, Dict[str, Any]]:
         """
         1ターン分の会話を進める。
 
         入力:
           user_text : ユーザーの最新発言（テキスト）
           state     : st.session_state をそのまま渡してくる想定
+          on_delta  : 指定すると、メイン応答をストリーミングで受け取る（差分ごとに呼ばれる）
 
         戻り値:
-          updated_messages : 更新後の messages リスト
+          updated_messages : 更新後の messages（state["messages"] の MessageStore そのもの）
           llm_meta         : LLM 側メタ情報（LLMConversation から返ってきたものをそのまま）
         """
-        # これまでの履歴を取得（なければ空で初期化）
-        messages: List[Dict[str, str]] = state.get("messages", [])
-        # コピーを作って操作しておくと安心
-        messages = list(messages)
-
-        # ユーザー発言を履歴に追加
-        messages.append({"role": "user", "content": user_text})
-
-        # LLMConversation に丸投げして、応答と meta を受け取る
-        reply_text, meta = self.conversation.generate_reply(messages)
+        # 履歴は追記専用のストア（コピーは作らない）
+        store = ensure_store(state)
 
-        # アシスタント発言を履歴に追加
-        messages.append({"role": "assistant", "content": reply_text})
+        # ユーザー発言を履歴に追加（途中で失敗したら取り消す）
+        user_message = store.append(ChatMessage("user", user_text))
+        try:
+            meta = self._run_turn(state, store, on_delta)
+        except BaseException:
+            store.pop_last(user_message.id)
+            raise
 
         # ここがポイント：
         #   以前のように
@@ -58,4 +91,177 @@ class LyraCore:
         #   generate_reply() が返した meta を、そのまま llm_meta として返す。
         llm_meta: Dict[str, Any] = dict(meta)
 
-        return messages, llm_meta
+        # 前のターンの審議がまだ終わっていなければ、llm_meta が差し替わる前に脇へ退けておく
+        # （結果は reconcile_late() で取り込む。捨てると勝敗が統計に入らない）
+        self._park_pending(state)
+
+        return store, llm_meta
+
+    def _run_turn(
+        self,
+        state: Dict[str, Any],
+        store: MessageStore,
+        on_delta: Optional[Callable[[str], None]],
+    ) -> Dict[str, Any]:
+        """ユーザー発言を追記済みの store に対して、応答を作ってアシスタント発言を追記する。"""
+        messages = store.snapshot()
+
+        # 前のターンの裏で作っていたあらすじが出来ていれば取り込む
+        self.summarizer.harvest(state)
+        summary = self.summarizer.current(state, messages)
+        covered = summary["covered"]
+
+        # 今回呼ぶモデルを選ぶ（勝ち目の薄いモデルは呼ばない）
+        model_keys, selection = self.selector.select(
+            self.persona_id, self.conversation.collector.model_keys
+        )
+
+        # 遅いモデルの見切りは、そのモデルの過去の勝率が分かっているときだけ。
+        # 探索で選んだモデルは見切らない（見切ると審議に出ず、勝率がいつまでも更新されない）。
+        # PRIMARY_KEY も見切らない（表に出す返答の既定で、LLMConversation が必ず参照する）
+        explore = set(selection.get("explore") or ())
+        early_exit = (
+            EarlyExit(
+                self.selector.win_rates(
+                    self.persona_id,
+                    [k for k in model_keys if k not in explore and k != PRIMARY_KEY],
+                ),
+                self.pre_judge,
+            )
+            if self.early_exit
+            else None
+        )
+
+        # LLMConversation に丸投げして、応答と meta を受け取る
+        #   （あらすじに畳み込み済みの古い発言は渡さない）
+        reply_text, meta = self.conversation.generate_reply(
+            messages[covered:],
+            on_delta=on_delta,
+            summary=summary["text"],
+            model_keys=model_keys,
+            early_exit=early_exit,
+        )
+        meta["selection"] = selection
+
+        # 審議はクリティカルパスの外で。ビュー側は turn_id で結果を取りに行く
+        #   （エラー・空応答など見れば分かるケースは、ローカル判定でその場で確定）
+        meta["turn_id"] = uuid.uuid4().hex
+        composer: Dict[str, Any] = {
+            "mode": "speculative",
+            "shown_model": PRIMARY_KEY,
+            "final_model": PRIMARY_KEY,
+            "status": "single",
+        }
+        models = meta.get("models")
+        if isinstance(models, dict):
+            self.selector.record_usage(self.persona_id, models)
+        abandoned = (meta.get("fanout") or {}).get("abandoned")
+        if abandoned:
+            self.selector.record_abandoned(self.persona_id, abandoned)
+        if isinstance(models, dict) and len(models) >= 2:
+            decision = self.pre_judge.decide(models)
+            if decision.result is not None:
+                meta["judge"] = decision.result
+                self.selector.record_verdict(
+                    self.persona_id, list(models), decision.result.get("winner")
+                )
+                winner = decision.result.get("winner")
+                shown = winner if winner in models else PRIMARY_KEY
+                composer.update(shown_model=shown, final_model=shown, status="decided")
+            else:
+                # 審議を待たずに、いま出せる候補を表に出す（審議後に差し替えることがある）
+                shown = self.composer.pick_speculative(models, decision.scores_dict(), PRIMARY_KEY)
+                composer.update(shown_model=shown, final_model=shown, status="pending")
+                self.judge_jobs.submit(meta["turn_id"], meta)
+            shown_reply = str((models.get(shown) or {}).get("reply") or "")
+            if shown_reply.strip():
+                reply_text = shown_reply
+
+        # アシスタント発言を履歴に追加（差し替えは発言 ID で末尾を確かめてから）
+        assistant_message = store.append(ChatMessage("assistant", reply_text))
+        composer["message_id"] = assistant_message.id
+        meta["composer"] = composer
+
+        # あらすじの更新もクリティカルパスの外（裏のスレッド）で
+        scheduled = self.summarizer.maybe_schedule(state, store.snapshot())
+        meta["summary"] = {
+            "covered": covered,
+            "chars": len(summary["text"]),
+            "refreshing": scheduled or self.summarizer.is_pending(state),
+        }
+        return meta
+
+    # ===== 審議結果の取り込み（投機的に出した返答の差し替え） =====
+    def is_judging(self, state: Dict[str, Any]) -> bool:
+        """直近ターンの審議がまだ裏で走っているか。"""
+        meta = state.get("llm_meta")
+        if not isinstance(meta, dict):
+            return False
+        composer = meta.get("composer")
+        return isinstance(composer, dict) and composer.get("status") == "pending"
+
+    def reconcile(self, state: Dict[str, Any]) -> bool:
+        """
+        直近ターンの審議が終わっていれば llm_meta["judge"] に取り込み、
+        winner が表に出した候補と違えば、履歴の返答を winner のものに差し替える。
+
+        差し替えるのは、その返答がまだ履歴の末尾にある（プレイヤーが次の発言を
+        していない）ときだけ。もう先へ進んでいたら履歴は書き換えず、status="late" を残す。
+        履歴を差し替えたら True。
+        """
+        if not self.is_judging(state):
+            return False
+        return self._settle(state, state["llm_meta"])
+
+    def has_late(self, state: Dict[str, Any]) -> bool:
+        """次のターンへ進んだ後も審議が続いている、前のターンがあるか。"""
+        return bool(state.get(LATE_JUDGING_KEY))
+
+    def reconcile_late(self, state: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        _park_pending() で退けておいたターンのうち、審議が終わったものを取り込んで返す
+        （呼び出し側で保存し直す）。返答はもう末尾ではないので、差し替えずに "late" になる。
+        """
+        parked: List[Dict[str, Any]] = state.get(LATE_JUDGING_KEY) or []
+        finished: List[Dict[str, Any]] = []
+        waiting: List[Dict[str, Any]] = []
+        for meta in parked:
+            self._settle(state, meta)
+            composer = meta.get("composer") or {}
+            (waiting if composer.get("status") == "pending" else finished).append(meta)
+        state[LATE_JUDGING_KEY] = waiting
+        return finished
+
+    def _park_pending(self, state: Dict[str, Any]) -> None:
+        if self.is_judging(state):
+            state.setdefault(LATE_JUDGING_KEY, []).append(state["llm_meta"])
+
+    def _settle(self, state: Dict[str, Any], meta: Dict[str, Any]) -> bool:
+        """meta のターンの審議結果を取り込む（まだ走っていれば何もしない）。履歴を差し替えたら True。"""
+        composer: Dict[str, Any] = meta["composer"]
+
+        status, result = self.judge_jobs.status(str(meta.get("turn_id") or ""))
+        if status == "pending":
+            return False
+        if status != "done" or not isinstance(result, dict) or "error" in result:
+            # 審議に失敗したら表の返答のまま（失敗した判定は llm_meta にも統計にも入れない）
+            composer["status"] = "kept"
+            return False
+        meta["judge"] = result
+
+        models = meta.get("models") or {}
+        winner = result.get("winner")
+        self.selector.record_verdict(self.persona_id, list(models), winner)
+        shown = composer.get("shown_model")
+        winner_reply = str((models.get(winner) or {}).get("reply") or "")
+        if winner == shown or winner not in models or not winner_reply.strip():
+            composer["status"] = "kept"
+            return False
+
+        store = ensure_store(state)
+        if not store.replace_last(composer.get("message_id"), ChatMessage("assistant", winner_reply)):
+            composer["status"] = "late"
+            return False
+
+        composer.update(final_model=winner, status="swapped")
+        return True
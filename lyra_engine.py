@@ -2,16 +2,22 @@
 from __future__ import annotations
 from typing import Any, Dict, List, Tuple
 import os
+import uuid
 import streamlit as st
 
 from personas.persona_floria_ja import get_persona
-from components import PreflightChecker, ChatLog, PlayerInput
+from components import PreflightChecker, ChatLog, PlayerInput, session_link_from_url, set_session_link_in_url
+from conversation_db import get_conversation_db, new_owner_key
 from conversation_engine import LLMConversation
 from lyra_core import LyraCore
+from llm_ratelimit import session_scope
+from message_store import DISPLAY_LIMIT, ChatMessage, MessageStore, ensure_store
 
 class LyraEngine:
     MAX_LOG = 500
-    DISPLAY_LIMIT = 20000
+    DISPLAY_LIMIT = DISPLAY_LIMIT
+    # 裏で審議が走っている間、結果を見に行く間隔（秒）
+    JUDGE_POLL_INTERVAL = 1.5
 
     def __init__(self) -> None:
         # ペルソナ
@@ -21,12 +27,13 @@ class LyraEngine:
         self.partner_name  = persona.name
         self.style_hint    = persona.style_hint
 
-        # 会話エンジン
+        # 会話エンジン（モデルごとの temperature 等は persona.model_params が優先）
         self.conversation = LLMConversation(
             system_prompt=self.system_prompt,
             temperature=st.session_state.get("temp_gpt4o", 0.7),
             max_tokens=st.session_state.get("max_gpt4o", 800),
             style_hint=self.style_hint,
+            persona=persona,
         )
         # 1ターン制御
         self.core = LyraCore(self.conversation)
@@ -41,12 +48,73 @@ class LyraEngine:
 
     def _init_state(self) -> None:
         s = st.session_state
+        # 会話の保存先（CONVERSATION_DB=off なら None）
+        self.db = get_conversation_db()
+        if "lyra_session_id" not in s:
+            # プロバイダのレート制限をセッション間で公平に分けるための ID（会話の保存キーも兼ねる）
+            s.lyra_session_id = uuid.uuid4().hex
+        if "lyra_session_key" not in s:
+            # 会話の持ち主の鍵（URL の ?key=。DB はこれが合う会話しか開かない）
+            s.lyra_session_key = new_owner_key()
         if "messages" not in s:
-            s.messages = []
-            if self.starter_hint:
-                s.messages.append({"role": "assistant", "content": self.starter_hint})
+            # URL の sid と鍵が合う保存済みの会話があれば、末尾 MAX_LOG 件だけ読み込んで再開する
+            url_sid, url_key = session_link_from_url()
+            resumed = (
+                self.db.load_store(url_sid, url_key, max_len=self.MAX_LOG)
+                if self.db is not None and url_sid and url_key
+                else None
+            )
+            if resumed is not None:
+                s.lyra_session_id, s.lyra_session_key = url_sid, url_key
+                s.messages = resumed
+                s.llm_meta = self.db.last_meta(url_sid, url_key)
+            else:
+                # 追記専用のリングバッファ（MAX_LOG を超えた古い発言は DB とあらすじ側にだけ残る）
+                s.messages = MessageStore(max_len=self.MAX_LOG)
+                if self.db is not None:
+                    # 最初の保存より前にリングから捨てられる発言も、DB には書けるように残してもらう
+                    s.messages.hold_evicted(0)
+                if self.starter_hint:
+                    s.messages.append(ChatMessage("assistant", self.starter_hint))
+        else:
+            # 以前の list のままのセッションは 1 度だけ移し替える
+            ensure_store(s, max_len=self.MAX_LOG)
         if "llm_meta" not in s:
             s.llm_meta = None
+        if self.db is not None:
+            set_session_link_in_url(s.lyra_session_id, s.lyra_session_key)
+
+    def _persist(self, rewrite_last: bool = False) -> None:
+        """増えた発言と直近の llm_meta を DB に書く（1 ターンに 1 回）。"""
+        if self.db is None:
+            return
+        self.db.sync(
+            self.state.lyra_session_id,
+            self.state.lyra_session_key,
+            self.state.messages,
+            meta=self.state.llm_meta,
+            rewrite_last=rewrite_last,
+            persona=self.partner_name,
+        )
+
+    def _reconcile(self) -> None:
+        """審議結果を取り込み、終わったターンは（差し替えた返答と審議結果ごと）保存し直す。"""
+        was_judging = self.core.is_judging(self.state)
+        swapped = self.core.reconcile(self.state)
+        if was_judging and not self.core.is_judging(self.state):
+            self._persist(rewrite_last=swapped)
+        # 次のターンへ進んだ後に終わった審議は、そのターンの発言の llm_meta として書き直す
+        for meta in self.core.reconcile_late(self.state):
+            if self.db is not None:
+                self.db.save_turn_meta(
+                    self.state.lyra_session_id,
+                    self.state.lyra_session_key,
+                    str(meta["composer"].get("message_id") or ""),
+                    meta,
+                )
+
+    def _is_judging(self) -> bool:
+        return self.core.is_judging(self.state) or self.core.has_late(self.state)
 
     @property
     def state(self): return st.session_state
@@ -56,18 +124,47 @@ class LyraEngine:
         # Preflight
         # self.preflight.render()
 
+        # rerun のたびに、まず審議結果を取り込む（次の発言の処理で llm_meta が差し替わる前に）
+        self._reconcile()
+        fragment = getattr(st, "fragment", None)
+
         # ログ表示
         self.chat_log.render(self.state.messages)
 
         # 入力
         user_text = self.player_in.render()
         if not user_text:
+            if fragment is not None:
+                self._poll_judging(fragment)
             return
 
-        with st.spinner("フローリアが返事を考えています…"):
-            updated_messages, meta = self.core.proceed_turn(user_text, self.state)
+        # 送信した発言と、ストリーミングで伸びていく返答の吹き出しを先に出しておく
+        # （最後の差分は st.rerun() 後のログ表示で反映される）
+        on_delta = self.chat_log.render_pending(user_text)
+        with session_scope(self.state.lyra_session_id):
+            updated_messages, meta = self.core.proceed_turn(
+                user_text, self.state, on_delta=on_delta
+            )
 
         self.state.messages = updated_messages
         self.state.llm_meta = meta
+        self._persist()
         self.state.scroll_to_input = True
         st.rerun()
+
+    def _poll_judging(self, fragment) -> None:
+        """
+        審議が裏で走っている間だけ、JUDGE_POLL_INTERVAL ごとに結果を見に行く。
+        終わったら（winner に差し替えた場合も含めて）画面全体を描き直す。
+        プレイヤーが操作していない間に差し替えるので、読みかけの返答が送信時に変わることはない。
+        """
+        if not self._is_judging():
+            return
+
+        @fragment(run_every=self.JUDGE_POLL_INTERVAL)
+        def _poll() -> None:
+            self._reconcile()
+            if not self._is_judging():
+                st.rerun()
+
+        _poll()
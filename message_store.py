@@ -0,0 +1,375 @@
+# message_store.py — 会話ログ（不変の発言レコードと、追記専用のストア）
+#
+# 会話ログは rerun のたびに全件描き直されるが、発言そのものは一度追加したら変わらない
+# （審議後の差し替えも「別の発言に置き換える」扱い）。そこで発言を追加するときに
+#   ・表示用に DISPLAY_LIMIT で切り詰め、HTML エスケープした本文（body_html）
+#   ・発言 ID
+# を 1 度だけ作って持たせておき、描画側は文字列をつなぐだけにする。
+#
+# ChatMessage は dict のサブクラスなので、これまでどおり m["role"] / m.get("content") で読め、
+# json.dumps や LLM に渡す messages にもそのまま使える（中身は role と content だけ）。
+#
+# MessageStore は session_state["messages"] に置く追記専用のリングバッファ。
+#   ・append は O(1)。max_len を超えたら古い発言から捨てる（先頭 pinned 件は残す）
+#   ・スライスや snapshot() はコピーを作らないビュー（MessageView）を返す
+#     （コピーしない代わりに、リングから捨てられた発言はビューからも読めなくなる）
+#   ・発言には通し番号（seq）が振られ、古い発言が捨てられても番号はずれない
+#     （あらすじの「どこまで畳み込んだか」は seq で持つ）
+# 毎ターン list(messages) でコピーしたり、MAX_LOG のたびにリストを作り直したりしなくて済む。
+
+from __future__ import annotations
+
+import html
+import uuid
+from collections import deque
+from collections.abc import Sequence
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Mapping, MutableMapping, Optional, Tuple, Union
+
+# 1 発言あたりの表示文字数の上限（保存・LLM へはフルで渡す）
+DISPLAY_LIMIT = 20000
+
+
+def render_body_html(content: str, display_limit: int = DISPLAY_LIMIT) -> str:
+    """
+    吹き出しの本文部分の HTML。前後の空白を落とし、display_limit で切り詰めてエスケープする。
+    改行は文字参照にして 1 行にする（pre-wrap なので表示は変わらない）。
+    複数の吹き出しを 1 つの st.markdown にまとめても、本文中の空行で
+    HTML ブロックが途切れて後ろの吹き出しまで崩れることがない。
+    """
+    raw = content.strip()
+    shown = raw if len(raw) <= display_limit else (raw[:display_limit] + " …[truncated]")
+    return html.escape(shown).replace("\n", "&#10;")
+
+
+class MessageEvictedError(IndexError):
+    """MessageView が指している発言が、もう MessageStore から捨てられている。"""
+
+
+class ChatMessage(dict):
+    """
+    不変の発言レコード。{"role": ..., "content": ...} の dict として振る舞い、
+    id と body_html を属性として持つ。書き換えようとすると TypeError。
+    """
+
+    __slots__ = ("id", "body_html")
+
+    def __init__(self, role: str, content: str, id: Optional[str] = None) -> None:
+        dict.__init__(self, role=str(role), content=str(content))
+        object.__setattr__(self, "id", id or uuid.uuid4().hex)
+        object.__setattr__(self, "body_html", render_body_html(self["content"]))
+
+    @classmethod
+    def of(cls, message: Mapping[str, Any]) -> "ChatMessage":
+        """dict（読み込んだログなど）から作る。すでに ChatMessage ならそのまま返す。"""
+        if isinstance(message, ChatMessage):
+            return message
+        return cls(
+            str(message.get("role") or ""),
+            str(message.get("content") or ""),
+            id=message.get("id") or None,
+        )
+
+    @property
+    def role(self) -> str:
+        return self["role"]
+
+    @property
+    def content(self) -> str:
+        return self["content"]
+
+    # ---- 不変にする ----
+    def _readonly(self, *args: Any, **kwargs: Any) -> Any:
+        raise TypeError("ChatMessage は変更できません（新しい ChatMessage を作ってください）")
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    __setattr__ = _readonly
+    __delattr__ = _readonly
+    __ior__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __reduce__(self) -> Any:
+        # pickle / deepcopy は __setitem__ を通さずに作り直す
+        return (ChatMessage, (self["role"], self["content"], self.id))
+
+    def __repr__(self) -> str:
+        return f"ChatMessage(id={self.id!r}, role={self['role']!r}, content={self['content'][:30]!r})"
+
+
+class MessageStore(Sequence):
+    """
+    追記専用の会話ログ。list と同じように len / 添字 / for で読める。
+    書き換えは append / extend と、末尾の差し替え・取り消し（replace_last / pop_last）だけ。
+    """
+
+    def __init__(
+        self,
+        messages: Iterable[Mapping[str, Any]] = (),
+        max_len: Optional[int] = None,
+        pinned: int = 0,
+    ) -> None:
+        # あらすじなどが「別の会話のログ」を指していないか見分けるための ID
+        self.store_id = uuid.uuid4().hex
+        self.max_len = max_len
+        # 先頭の pinned 件（system プロンプトなど）は捨てない
+        self.pinned = max(0, int(pinned))
+        self._head: List[ChatMessage] = []
+        ring_len = None if max_len is None else max(1, int(max_len) - self.pinned)
+        self._ring: Deque[ChatMessage] = deque(maxlen=ring_len)
+        self._evicted = 0
+        self._seq_by_id: Dict[str, int] = {}
+        # hold_evicted() 以降に捨てた発言（ConversationDB が書き終えるまで手元に残す）
+        self._hold_from: Optional[int] = None
+        self._held: List[Tuple[int, ChatMessage]] = []
+        # 直前の append で捨てた発言と、その append で足した発言の ID（pop_last で戻す用）
+        self._last_evicted: Optional[Tuple[int, ChatMessage]] = None
+        self._last_appended: Optional[str] = None
+        self.extend(messages)
+
+    @classmethod
+    def restore(
+        cls,
+        head: Iterable[Mapping[str, Any]],
+        tail: Iterable[Mapping[str, Any]],
+        tail_seq: int,
+        max_len: Optional[int] = None,
+        pinned: int = 0,
+    ) -> "MessageStore":
+        """
+        保存済みのログから作り直す（ConversationDB の再開用）。
+        head は先頭固定の発言、tail は通し番号 tail_seq から続く末尾の発言。
+        間の発言は「捨てられた」扱いになり、通し番号は保存時のまま続く。
+        """
+        store = cls(head, max_len=max_len, pinned=pinned)
+        store._evicted = max(0, int(tail_seq) - len(store._head))
+        store.extend(tail)
+        return store
+
+    # ===== 追記 =====
+    def append(self, message: Mapping[str, Any]) -> ChatMessage:
+        msg = ChatMessage.of(message)
+        seq = self.next_seq
+        self._last_evicted = None
+        if len(self._head) < self.pinned:
+            self._head.append(msg)
+        else:
+            if self._ring.maxlen is not None and len(self._ring) == self._ring.maxlen:
+                old = self._ring[0]
+                old_seq = self._seq_by_id.pop(old.id, len(self._head) + self._evicted)
+                if self._hold_from is not None and old_seq >= self._hold_from:
+                    self._held.append((old_seq, old))
+                self._evicted += 1
+                self._last_evicted = (old_seq, old)
+            self._ring.append(msg)
+        self._seq_by_id[msg.id] = seq
+        self._last_appended = msg.id
+        return msg
+
+    def extend(self, messages: Iterable[Mapping[str, Any]]) -> None:
+        for m in messages:
+            self.append(m)
+
+    def replace_last(self, expected_id: Optional[str], message: Mapping[str, Any]) -> bool:
+        """末尾が expected_id の発言なら差し替える（先へ進んでいたら何もしない）。"""
+        if not self._ring or self._ring[-1].id != expected_id:
+            return False
+        msg = ChatMessage.of(message)
+        old = self._ring.pop()
+        seq = self._seq_by_id.pop(old.id)
+        self._ring.append(msg)
+        self._seq_by_id[msg.id] = seq
+        if self._last_appended == old.id:
+            self._last_appended = msg.id
+        return True
+
+    def pop_last(self, expected_id: Optional[str]) -> bool:
+        """
+        末尾が expected_id の発言なら取り消す（失敗したターンの巻き戻し用）。
+        それが直前の append で、そのとき古い発言を 1 件捨てていたら、その発言を先頭に戻す。
+        それより前の append で捨てた発言は戻らない（取り消せるのは直前の 1 件だけ）。
+        """
+        if not self._ring or self._ring[-1].id != expected_id:
+            return False
+        popped = self._ring.pop()
+        self._seq_by_id.pop(popped.id, None)
+        if self._last_appended == popped.id and self._last_evicted is not None:
+            seq, old = self._last_evicted
+            self._ring.appendleft(old)
+            self._evicted -= 1
+            self._seq_by_id[old.id] = seq
+            self._held = [(q, m) for q, m in self._held if q != seq]
+        self._last_evicted = None
+        self._last_appended = None
+        return True
+
+    # ===== 捨てた発言の引き渡し =====
+    def hold_evicted(self, from_seq: int) -> None:
+        """
+        通し番号 from_seq 以降の発言は、リングから捨てても held_evicted() で読めるように残す。
+        from_seq より前の分はここで手放す（保存が済んだところまで進めていく想定）。
+        """
+        self._hold_from = int(from_seq)
+        self._held = [(seq, m) for seq, m in self._held if seq >= self._hold_from]
+
+    def held_evicted(self) -> List[Tuple[int, ChatMessage]]:
+        """hold_evicted() 以降にリングから捨てた発言（通し番号順）。"""
+        return list(self._held)
+
+    # ===== 読み出し =====
+    def __len__(self) -> int:
+        return len(self._head) + len(self._ring)
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        if isinstance(index, slice):
+            return self.snapshot()[index]
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("MessageStore index out of range")
+        head = len(self._head)
+        return self._head[index] if index < head else self._ring[index - head]
+
+    def __iter__(self) -> Iterator[ChatMessage]:
+        yield from self._head
+        yield from self._ring
+
+    def __repr__(self) -> str:
+        return f"MessageStore(len={len(self)}, max_len={self.max_len}, pinned={self.pinned})"
+
+    def snapshot(self) -> "MessageView":
+        """
+        今の内容のビュー（コピーしない）。後から追記されても範囲は変わらないが、
+        その追記でリングから捨てられた発言は読めなくなる（MessageEvictedError）。
+        追記をまたいで持ち続ける（別スレッドに渡すなど）なら list(...) でコピーすること。
+        """
+        return MessageView(self, 0, len(self), len(self._head), self._evicted)
+
+    def get(self, message_id: str) -> Optional[ChatMessage]:
+        seq = self._seq_by_id.get(message_id)
+        return None if seq is None else self._by_seq(seq)
+
+    # ===== 通し番号 =====
+    @property
+    def next_seq(self) -> int:
+        """次に追記される発言の通し番号（＝これまでに追記した件数）。"""
+        return len(self._head) + self._evicted + len(self._ring)
+
+    def seq_of_index(self, index: int) -> int:
+        return self.snapshot().seq_of_index(index)
+
+    def index_of_seq(self, seq: int) -> int:
+        return self.snapshot().index_of_seq(seq)
+
+    def _by_seq(self, seq: int) -> ChatMessage:
+        head = len(self._head)
+        if seq < head:
+            return self._head[seq]
+        j = seq - head - self._evicted
+        if j < 0:
+            raise MessageEvictedError("この発言は MessageStore から捨てられています")
+        return self._ring[j]
+
+
+class MessageView(Sequence):
+    """
+    MessageStore の一部を指すビュー。スライスしてもコピーせず、ビューを返す。
+    作った後にリングから捨てられた発言は、読むと MessageEvictedError になる
+    （len や通し番号の変換はそのまま使える）。
+    """
+
+    __slots__ = ("_store", "_lo", "_hi", "_head", "_evicted")
+
+    def __init__(self, store: MessageStore, lo: int, hi: int, head: int, evicted: int) -> None:
+        self._store = store
+        self._lo = lo
+        self._hi = hi
+        # 作った時点の先頭固定件数と捨てた件数（添字 → 通し番号の変換に使う）
+        self._head = head
+        self._evicted = evicted
+
+    @property
+    def store_id(self) -> str:
+        return self._store.store_id
+
+    @property
+    def next_seq(self) -> int:
+        return self.seq_of_index(len(self))
+
+    def seq_of_index(self, index: int) -> int:
+        i = self._lo + index
+        return i if i < self._head else i + self._evicted
+
+    def index_of_seq(self, seq: int) -> int:
+        """seq の発言がこのビューの何番目か（範囲外は 0 〜 len に丸める）。"""
+        i = seq if seq < self._head else max(self._head, seq - self._evicted)
+        return min(max(0, i - self._lo), len(self))
+
+    def __len__(self) -> int:
+        return self._hi - self._lo
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        n = len(self)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            stop = max(start, stop)
+            return MessageView(
+                self._store, self._lo + start, self._lo + stop, self._head, self._evicted
+            )
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError("MessageView index out of range")
+        return self._store._by_seq(self.seq_of_index(index))
+
+    def __iter__(self) -> Iterator[ChatMessage]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f"MessageView(len={len(self)})"
+
+
+def ensure_store(
+    state: MutableMapping[str, Any],
+    key: str = "messages",
+    max_len: Optional[int] = None,
+    pinned: int = 0,
+) -> MessageStore:
+    """state[key] を MessageStore にして返す（古いセッションの list はここで 1 度だけ移し替える）。"""
+    messages = state.get(key)
+    if not isinstance(messages, MessageStore):
+        messages = MessageStore(messages or (), max_len=max_len, pinned=pinned)
+        state[key] = messages
+    return messages
+
+
+def seq_of_index(messages: Sequence, index: int) -> int:
+    """messages の index 番目の通し番号。ただの list なら添字そのもの。"""
+    fn = getattr(messages, "seq_of_index", None)
+    return fn(index) if fn is not None else index
+
+
+def index_of_seq(messages: Sequence, seq: int) -> int:
+    """通し番号 seq の発言が messages の何番目か。ただの list なら添字そのもの。"""
+    fn = getattr(messages, "index_of_seq", None)
+    return fn(seq) if fn is not None else seq
+
+
+__all__ = [
+    "DISPLAY_LIMIT",
+    "ChatMessage",
+    "MessageEvictedError",
+    "render_body_html",
+    "MessageStore",
+    "MessageView",
+    "ensure_store",
+    "seq_of_index",
+    "index_of_seq",
+]